@@ -127,7 +127,7 @@ gamepad_t read_buttons() {
 }
 
 
-const uint8_t LZMA_PROP_DATA[5] = {0x5d, 0x00, 0x40, 0x00, 0x00};
+// Probability tables for lc + lp <= 3; must agree with patches/compression.py
 #define LZMA_BUF_SIZE            16256
 
 static void *SzAlloc(ISzAllocPtr p, size_t size) {
@@ -143,6 +143,7 @@ const ISzAlloc g_Alloc = { SzAlloc, SzFree };
 static unsigned char lzma_heap[LZMA_BUF_SIZE];
 /**
  * Dropin replacement for memcpy for loading compressed assets.
+ * The first LZMA_PROPS_SIZE bytes of src are the payload's LZMA properties.
  * @param n Compressed data length. Can be larger than necessary.
  */
 void *memcpy_inflate(uint8_t *dst, const uint8_t *src, size_t n){
@@ -154,7 +155,8 @@ void *memcpy_inflate(uint8_t *dst, const uint8_t *src, size_t n){
 
     ELzmaStatus status;
     size_t dst_len = 393216;
-    LzmaDecode(dst, &dst_len, src, &n, LZMA_PROP_DATA, 5, LZMA_FINISH_ANY, &status, &allocs);
+    n -= LZMA_PROPS_SIZE;
+    LzmaDecode(dst, &dst_len, src + LZMA_PROPS_SIZE, &n, src, LZMA_PROPS_SIZE, LZMA_FINISH_ANY, &status, &allocs);
     return dst;
 }
 
@@ -10,18 +10,77 @@ if sys.version_info[0] < 3 or sys.version_info[1] < 6:
 
 
 import argparse
+import os
 from pathlib import Path
 
 import colorama
 from colorama import Fore, Style
 
-from patches import Device
+from patches import delta
+from patches.assembler import asm_cache
+from patches.base_state import base_state_cache
+from patches.compression import compression_cache, set_lzma_search
+from patches.devices import DEVICES
 from patches.exception import InvalidPatchError
+from patches.extract import export_executor, extraction_cache
+from patches.matrix import (
+    FORK,
+    MatrixResult,
+    format_summary,
+    jobs_per_config,
+    read_matrix,
+    run_matrix,
+)
+from patches.output import output_writer
 
 colorama.init()
 
 
-def main():
+def prepare_device(device, args, debug_dir=Path("build")):
+    """Decrypt, dump debugging data and insert the novel code."""
+    device.crypt()  # Decrypt the external firmware
+
+    # Save the decrypted external firmware for debugging/development purposes.
+    output_writer.write(debug_dir / "decrypt.bin", device.external, debug=True)
+
+    # Dump ITCM and DTCM RAM data
+    if (
+        device.internal.RWDATA_OFFSET is not None
+        and device.internal.RWDATA_ITCM_IDX is not None
+    ):
+        output_writer.write(
+            debug_dir / "itcm_rwdata.bin",
+            device.internal.rwdata.datas[device.internal.RWDATA_ITCM_IDX],
+            debug=True,
+        )
+    if (
+        device.internal.RWDATA_OFFSET is not None
+        and device.internal.RWDATA_DTCM_IDX is not None
+    ):
+        output_writer.write(
+            debug_dir / "dtcm_rwdata.bin",
+            device.internal.rwdata.datas[device.internal.RWDATA_DTCM_IDX],
+            debug=True,
+        )
+
+    # Copy over novel code
+    patch = args.patch.read_bytes()
+    if len(device.internal) != len(patch):
+        raise InvalidPatchError(
+            f"Expected patch length {len(device.internal)}, got {len(patch)}"
+        )
+
+    # novel_code_start = device.internal.address("__do_global_dtors_aux") & 0x00FF_FFF8
+    novel_code_start = device.internal.STOCK_ROM_END
+    device.internal[novel_code_start:] = patch[novel_code_start:]
+    del patch
+
+    if args.extended:
+        device.internal.extend(b"\x00" * 0x20000)
+
+
+def build_parser():
+    """Parser of the global configurations; devices add their own arguments."""
     parser = argparse.ArgumentParser(description="Game and Watch Firmware Patcher.")
 
     #########################
@@ -30,10 +89,7 @@ def main():
     parser.add_argument(
         "--device",
         type=str,
-        choices=[
-            "mario",
-            "zelda",
-        ],
+        choices=list(DEVICES),
         default="mario",
         help="Game and Watch device model",
     )
@@ -78,6 +134,27 @@ def main():
         action="store_true",
         help="Enable RIGHT+GAME to launch 0x08020000.",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes used for compression and encryption. "
+        "With --matrix, shared by the configurations built at once. "
+        "Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--lzma-search",
+        action="store_true",
+        help="Search LZMA parameters (lc/lp/pb, dict_size, preset) per payload "
+        "for the smallest output. Slow on first run; results are cached.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the compression, assembly, decoded stock "
+        "firmware and asset extraction caches in build/cache/.",
+    )
     parser.add_argument(
         "--compression-ratio",
         type=float,
@@ -87,6 +164,64 @@ def main():
         "Otherwise, will fallback to internal flash, then external "
         "flash.",
     )
+    parser.add_argument(
+        "--prescreen",
+        choices=["on", "off", "verify"],
+        default="off",
+        help="Decide blocks whose compression ratio is clearly above or below "
+        "--compression-ratio with a fast deflate estimate instead of an LZMA trial. "
+        "Faster, but may place some blocks differently. "
+        "'verify' always runs the LZMA trial and reports how often they agree.",
+    )
+
+    parser.add_argument(
+        "--optimize-placement",
+        action="store_true",
+        help="Run a greedy survey pass, then search for a better placement of "
+        "relocatable blocks between compressed_memory, internal and external flash.",
+    )
+    parser.add_argument(
+        "--placement-objective",
+        choices=["external", "internal"],
+        default="external",
+        help="With --optimize-placement, minimize external flash usage, or "
+        "maximize free internal flash without using more external flash than greedy.",
+    )
+    parser.add_argument(
+        "--placement-time",
+        type=float,
+        default=5.0,
+        help="Maximum seconds to spend searching placements.",
+    )
+
+    parser.add_argument(
+        "--order-compressed-memory",
+        action="store_true",
+        help="Run a greedy survey pass, then reorder the blocks in "
+        "compressed_memory so similar data compresses together.",
+    )
+
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        help="Also export the stock ROMs, tilesets and backdrops to build/. Assets "
+        "whose source bytes didn't change since they were last exported are skipped.",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Also write the erase sectors that differ from the last flashed images "
+        "to build/delta/, with an openocd script programming only those. See "
+        "'make flash_patched_delta'.",
+    )
+    parser.add_argument(
+        "--matrix",
+        type=Path,
+        default=None,
+        help="Build every configuration listed in this file, one 'name: PATCH_PARAMS' "
+        "per line, into build/matrix/<name>/. The stock firmware is decoded once and "
+        "up to --jobs configurations are patched concurrently.",
+    )
 
     debugging = parser.add_argument_group("Debugging")
     debugging.add_argument(
@@ -97,50 +232,80 @@ def main():
     debugging.add_argument(
         "--debug", action="store_true", help="Install useful debugging fault handlers."
     )
+    debugging.add_argument(
+        "--debug-dumps",
+        action="store_true",
+        help="Also write the decrypted stock and patched external firmware and the "
+        "ITCM/DTCM rwdata to build/.",
+    )
 
-    args, _ = parser.parse_known_args()
+    return parser
+
+
+def parse_global_args(parser, argv=None):
+    args, _ = parser.parse_known_args(argv)
+    _set_backup_paths(args)
+    return args
+
+
+def _set_backup_paths(args):
     args.int_firmware = Path(f"internal_flash_backup_{args.device}.bin")
     args.ext_firmware = Path(f"flash_backup_{args.device}.bin")
 
-    device = Device.registry[args.device](
-        args.int_firmware, args.elf, args.ext_firmware
-    )
-    args = device.argparse(parser)
-    device.crypt()  # Decrypt the external firmware
 
-    # Save the decrypted external firmware for debugging/development purposes.
-    Path("build/decrypt.bin").write_bytes(device.external)
+def load_device(args):
+    # Heavy (NumPy, PIL, ...); not needed for ``--help``.
+    from patches import Device
 
-    # Dump ITCM and DTCM RAM data
-    if (
-        device.internal.RWDATA_OFFSET is not None
-        and device.internal.RWDATA_ITCM_IDX is not None
-    ):
-        Path("build/itcm_rwdata.bin").write_bytes(
-            device.internal.rwdata.datas[device.internal.RWDATA_ITCM_IDX]
-        )
-    if (
-        device.internal.RWDATA_OFFSET is not None
-        and device.internal.RWDATA_DTCM_IDX is not None
-    ):
-        Path("build/dtcm_rwdata.bin").write_bytes(
-            device.internal.rwdata.datas[device.internal.RWDATA_DTCM_IDX]
-        )
+    return Device.registry[args.device](args.int_firmware, args.elf, args.ext_firmware)
 
-    # Copy over novel code
-    patch = args.patch.read_bytes()
-    if len(device.internal) != len(patch):
-        raise InvalidPatchError(
-            f"Expected patch length {len(device.internal)}, got {len(patch)}"
-        )
 
-    # novel_code_start = device.internal.address("__do_global_dtors_aux") & 0x00FF_FFF8
-    novel_code_start = device.internal.STOCK_ROM_END
-    device.internal[novel_code_start:] = patch[novel_code_start:]
-    del patch
+def patch(device, parser, argv=None, output_dir=None):
+    """Parse the device arguments, patch ``device`` and save the outputs.
 
-    if args.extended:
-        device.internal.extend(b"\x00" * 0x20000)
+    Parameters
+    ----------
+    output_dir : Path, optional
+        Save the patched firmware and debugging data here instead of
+        ``--int-output``, ``--ext-output`` and ``build/``.
+
+    Returns
+    -------
+    tuple
+        ``(args, internal_remaining_free, compressed_memory_remaining_free)``
+    """
+    args = device.argparse(parser, argv)
+    _set_backup_paths(args)
+    output_writer.debug = args.debug_dumps
+    debug_dir = Path("build")
+    if output_dir is not None:
+        debug_dir = output_dir
+        args.int_output = output_dir / args.int_output.name
+        args.ext_output = output_dir / args.ext_output.name
+
+    if args.optimize_placement or args.order_compressed_memory:
+        # Survey every relocatable block with a greedy run on a scratch device.
+        survey = load_device(args)
+        survey.args = args
+        prepare_device(survey, args, debug_dir)
+        survey()
+        if args.optimize_placement:
+            device.optimize_placement(
+                survey.placement_log,
+                survey.placement_int_capacity,
+                objective=args.placement_objective,
+                time_budget=args.placement_time,
+            )
+        if args.order_compressed_memory:
+            device.order_compressed_memory(survey.placement_log, survey.placement_data)
+        del survey
+
+    prepare_device(device, args, debug_dir)
+    if args.extract:
+        # Exported in the background while patching.
+        export_executor.max_workers = args.jobs
+        extracted, unchanged = device.extract(debug_dir)
+        print(f"Extracting {extracted} assets, {unchanged} unchanged")
 
     print(Fore.BLUE)
     print("#########################")
@@ -157,13 +322,25 @@ def main():
         device.show()
 
     # Re-encrypt the external firmware
-    Path("build/decrypt_flash_patched.bin").write_bytes(device.external)
+    output_writer.write(
+        debug_dir / "decrypt_flash_patched.bin", device.external, debug=True
+    )
     if args.encrypt:
-        device.external.crypt(device.internal.key, device.internal.nonce)
+        device.encrypt()
 
     # Save patched firmware
-    args.int_output.write_bytes(device.internal)
-    args.ext_output.write_bytes(device.external)
+    output_writer.write(args.int_output, device.internal)
+    output_writer.write(args.ext_output, device.external)
+
+    if args.delta:
+        images = delta.firmware_images(device.internal, device.external)
+        chunks = delta.write_delta(images, debug_dir / "delta")
+        print(delta.summary(chunks, images))
+
+    written, unchanged = output_writer.wait()
+    print(f"Wrote {written} output files, {unchanged} unchanged")
+    export_executor.wait()
+    asm_cache.save()
 
     print(Fore.GREEN)
     print("Binary Patching Complete!")
@@ -178,6 +355,79 @@ def main():
     print(f"    External Firmware Used: {len(device.external)} bytes")
     print(Style.RESET_ALL)
 
+    return args, internal_remaining_free, compressed_memory_remaining_free
+
+
+def build_matrix(args):
+    """Build every configuration of ``args.matrix`` from one decoded base per device."""
+    configs = read_matrix(args.matrix)
+
+    # Decoded and decrypted once per device in this process; every worker
+    # forks with a copy-on-write copy.
+    bases = {}
+    if FORK:
+        for config in configs:
+            config_args = parse_global_args(build_parser(), config.argv)
+            if config_args.device not in bases:
+                base = load_device(config_args)
+                base.args = config_args
+                base.crypt()
+                bases[config_args.device] = base
+
+    # Up to ``args.jobs`` configurations are built at once; each gets its
+    # share of the processes rather than its own ``--jobs`` worth.
+    max_jobs = jobs_per_config(args.jobs, len(configs))
+
+    def build(config, output_dir):
+        from patches.symbols import SymbolIndex
+
+        parser = build_parser()
+        config_args = parse_global_args(parser, config.argv)
+        argv = [*config.argv, f"--jobs={min(config_args.jobs, max_jobs)}"]
+        config_args = parse_global_args(parser, argv)
+        set_lzma_search(config_args.lzma_search, jobs=config_args.jobs)
+        device = bases.get(config_args.device)
+        if device is None:
+            device = load_device(config_args)
+        else:
+            device.internal.symbols = SymbolIndex.load(config_args.elf)
+        _, internal_remaining_free, compressed_memory_remaining_free = patch(
+            device, parser, argv, output_dir
+        )
+        return MatrixResult(
+            config.name,
+            config_args.device,
+            len(device.internal) - internal_remaining_free,
+            internal_remaining_free,
+            compressed_memory_remaining_free,
+            len(device.external),
+            None,
+        )
+
+    results = run_matrix(configs, build, Path("build/matrix"), jobs=args.jobs)
+    print(format_summary(results))
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
+
+def main():
+    parser = build_parser()
+    args = parse_global_args(parser)
+
+    if not args.no_cache:
+        compression_cache.set_directory(Path("build/cache/lzma"))
+        asm_cache.set_path(Path("build/cache/asm.json"))
+        base_state_cache.set_directory(Path("build/cache"))
+        extraction_cache.set_path(Path("build/cache/extract.json"))
+    set_lzma_search(args.lzma_search, jobs=args.jobs)
+
+    if args.matrix is not None:
+        build_matrix(args)
+        return
+
+    device = load_device(args)
+    patch(device, parser)
+
 
 if __name__ == "__main__":
     main()
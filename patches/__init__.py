@@ -1,6 +1,24 @@
+import importlib
+
 import patches.ips
 
-from .compression import lz77_decompress, lzma_compress
-from .firmware import Device, ExtFirmware, Firmware, IntFirmware
-from .mario import MarioGnW
-from .zelda import ZeldaGnW
+# Imported on first access, so importing ``patches.devices`` (or any
+# other light submodule) doesn't load NumPy, PIL, etc.
+_LAZY_ATTRIBUTES = {
+    "lz77_decompress": ".compression",
+    "lzma_compress": ".compression",
+    "Device": ".firmware",
+    "ExtFirmware": ".firmware",
+    "Firmware": ".firmware",
+    "IntFirmware": ".firmware",
+    "MarioGnW": ".mario",
+    "ZeldaGnW": ".zelda",
+}
+
+
+def __getattr__(name):
+    try:
+        module = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    return getattr(importlib.import_module(module, __name__), name)
@@ -0,0 +1,385 @@
+"""Thumb-2 assembly: a built-in encoder plus a persistent keystone cache.
+
+``encode`` covers the handful of instructions the device patches use, so
+keystone is only needed for anything outside of that subset.
+"""
+
+import json
+import os
+import re
+from pathlib import Path
+
+# Identifies the keystone engine configuration in cache keys.
+KS_MODE = "arm-thumb"
+
+# Bump when the cache file format changes.
+_CACHE_VERSION = 1
+
+
+class AsmCache:
+    """Cache of assembled encodings.
+
+    Entries are keyed by the keystone mode, the instruction text and, for
+    PC-relative instructions, the address it's assembled at. If a ``path``
+    is set, entries persist there so repeated builds never load keystone.
+    New entries are only written by ``save``, merged with what other
+    processes saved in the meantime.
+    """
+
+    def __init__(self, path=None):
+        self.path = None
+        self._entries = {}
+        # Keys put since the last ``save``.
+        self._unsaved = set()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.set_path(path)
+
+    @staticmethod
+    def key(text, address=None, mode=KS_MODE) -> str:
+        text = " ".join(text.split())
+        address = "" if address is None else f"0x{address:08X}"
+        return f"{mode}|{address}|{text}"
+
+    def set_path(self, path):
+        """Enable (or disable with ``None``) the on-disk store, loading it if valid."""
+        if path is None:
+            self.path = None
+            return
+
+        self.path = Path(path)
+        self._load()
+
+    def _load(self):
+        try:
+            stored = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        if isinstance(stored, dict) and stored.get("version") == _CACHE_VERSION:
+            for key, encoding in stored["entries"].items():
+                self._entries.setdefault(key, bytes.fromhex(encoding))
+
+    def get(self, key):
+        """Returns the cached encoding, or ``None``."""
+        try:
+            encoding = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return encoding
+
+    def put(self, key, encoding):
+        self._entries[key] = bytes(encoding)
+        self._unsaved.add(key)
+
+    def save(self):
+        """Write the new entries to ``path``, if any.
+
+        The store is re-read first, so concurrent builds only lose entries
+        if they save at the very same time.
+        """
+        if self.path is None or not self._unsaved:
+            return
+        self._load()
+        self._unsaved.clear()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_text(
+            json.dumps(
+                {
+                    "version": _CACHE_VERSION,
+                    "entries": {k: v.hex() for k, v in self._entries.items()},
+                },
+                indent=0,
+            )
+        )
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self._entries.clear()
+        self._unsaved.clear()
+
+
+asm_cache = AsmCache()
+
+
+_CONDS = {
+    "eq": 0,
+    "ne": 1,
+    "cs": 2,
+    "hs": 2,
+    "cc": 3,
+    "lo": 3,
+    "mi": 4,
+    "pl": 5,
+    "vs": 6,
+    "vc": 7,
+    "hi": 8,
+    "ls": 9,
+    "ge": 10,
+    "lt": 11,
+    "gt": 12,
+    "le": 13,
+    "al": 14,
+}
+
+_REGS = {f"r{i}": i for i in range(16)}
+_REGS.update(sb=9, sl=10, fp=11, ip=12, sp=13, lr=14, pc=15)
+
+# Longest first so that e.g. "movw" isn't parsed as "mov" + "w".
+_MNEMONICS = ("movw", "mov", "cmp", "add", "sub", "nop", "bl", "b")
+
+_IT_RE = re.compile(r"it([te]{0,3})$")
+
+# Data-processing (modified immediate) opcodes.
+_OP_ORR = 0b0010
+_OP_ADD = 0b1000
+_OP_SUB = 0b1101
+
+
+class _Unsupported(Exception):
+    """Outside the subset ``encode`` handles."""
+
+
+def modified_immediate(value):
+    """Thumb-2 modified immediate ``i:imm3:imm8`` encoding ``value``, or ``None``."""
+    if not 0 <= value <= 0xFFFF_FFFF:
+        return None
+    if value <= 0xFF:
+        return value
+    low, high = value & 0xFF, (value >> 8) & 0xFF
+    if value == low * 0x0001_0001:
+        return 0x100 | low
+    if value == high * 0x0100_0100:
+        return 0x200 | high
+    if value == low * 0x0101_0101:
+        return 0x300 | low
+    for rotation in range(8, 32):
+        unrotated = ((value << rotation) | (value >> (32 - rotation))) & 0xFFFF_FFFF
+        if 0x80 <= unrotated <= 0xFF:
+            return (rotation << 7) | (unrotated & 0x7F)
+    return None
+
+
+def _halfwords(*halfwords):
+    return b"".join(hw.to_bytes(2, "little") for hw in halfwords)
+
+
+def _reg(operand):
+    try:
+        return _REGS[operand]
+    except KeyError:
+        raise _Unsupported(operand) from None
+
+
+def _imm(operand):
+    try:
+        return int(operand[1:] if operand.startswith("#") else operand, 0)
+    except ValueError:
+        raise _Unsupported(operand) from None
+
+
+def _is_imm(operand):
+    return operand.startswith("#") or operand[:1].isdigit()
+
+
+def _dp_imm(op, rd, rn, value, s=0):
+    imm12 = modified_immediate(value)
+    if imm12 is None:
+        raise _Unsupported(value)
+    return _halfwords(
+        0xF000 | (imm12 >> 11) << 10 | op << 5 | s << 4 | rn,
+        ((imm12 >> 8) & 0x7) << 12 | rd << 8 | (imm12 & 0xFF),
+    )
+
+
+def _movw(rd, value):
+    if not 0 <= value <= 0xFFFF or rd in (13, 15):
+        raise _Unsupported(value)
+    return _halfwords(
+        0xF240 | ((value >> 11) & 0x1) << 10 | value >> 12,
+        ((value >> 8) & 0x7) << 12 | rd << 8 | (value & 0xFF),
+    )
+
+
+def _branch(offset, cond, wide, narrow, link):
+    """``cond`` is ``None`` for an unconditional branch (or one inside an IT block)."""
+    if offset & 1:
+        raise _Unsupported(offset)
+
+    if not link and not wide:
+        if cond is None and -2048 <= offset <= 2046:
+            return _halfwords(0xE000 | (offset >> 1) & 0x7FF)
+        if cond is not None and -256 <= offset <= 254:
+            return _halfwords(0xD000 | cond << 8 | (offset >> 1) & 0xFF)
+    if narrow:
+        raise _Unsupported(offset)
+
+    if cond is None:
+        # T4 (B.W) and BL
+        if not -(1 << 24) <= offset < 1 << 24:
+            raise _Unsupported(offset)
+        s = (offset >> 24) & 1
+        j1 = (~offset >> 23 & 1) ^ s
+        j2 = (~offset >> 22 & 1) ^ s
+        return _halfwords(
+            0xF000 | s << 10 | (offset >> 12) & 0x3FF,
+            (0xD000 if link else 0x9000) | j1 << 13 | j2 << 11 | (offset >> 1) & 0x7FF,
+        )
+
+    # T3 (conditional B.W)
+    if not -(1 << 20) <= offset < 1 << 20:
+        raise _Unsupported(offset)
+    return _halfwords(
+        0xF000 | ((offset >> 20) & 1) << 10 | cond << 6 | (offset >> 12) & 0x3F,
+        0x8000
+        | ((offset >> 18) & 1) << 13
+        | ((offset >> 19) & 1) << 11
+        | (offset >> 1) & 0x7FF,
+    )
+
+
+def _parse_mnemonic(mnemonic):
+    """Returns ``(name, cond, wide, narrow)``."""
+    wide = mnemonic.endswith(".w")
+    narrow = mnemonic.endswith(".n")
+    if wide or narrow:
+        mnemonic = mnemonic[:-2]
+    for name in _MNEMONICS:
+        if not mnemonic.startswith(name):
+            continue
+        suffix = mnemonic[len(name) :]
+        if not suffix:
+            return name, None, wide, narrow
+        if suffix in _CONDS:
+            return name, _CONDS[suffix], wide, narrow
+    raise _Unsupported(mnemonic)
+
+
+def _encode_one(mnemonic, operands, address, in_it):
+    name, cond, wide, narrow = _parse_mnemonic(mnemonic)
+
+    if name in ("b", "bl"):
+        if len(operands) != 1:
+            raise _Unsupported(operands)
+        offset = _imm(operands[0]) - (address + 4)
+        return _branch(offset, None if in_it else cond, wide, narrow, link=name == "bl")
+
+    if name == "nop" and not operands and not wide:
+        return _halfwords(0xBF00)
+
+    if name == "movw" and len(operands) == 2 and not narrow:
+        return _movw(_reg(operands[0]), _imm(operands[1]))
+
+    if name == "mov" and len(operands) == 2:
+        rd = _reg(operands[0])
+        if not _is_imm(operands[1]):
+            rm = _reg(operands[1])
+            if wide and rd not in (13, 15) and rm not in (13, 15):
+                return _halfwords(0xEA4F, rd << 8 | rm)
+            if wide or rd == 15:
+                raise _Unsupported(operands)
+            return _halfwords(0x4600 | (rd >> 3) << 7 | rm << 3 | rd & 0x7)
+        value = _imm(operands[1])
+        if in_it and not wide and rd < 8 and 0 <= value <= 0xFF:
+            # Inside an IT block the narrow form doesn't set flags.
+            return _halfwords(0x2000 | rd << 8 | value)
+        if narrow or rd in (13, 15):
+            raise _Unsupported(operands)
+        if not wide and 0xFF < value <= 0xFFFF:
+            # Like keystone, prefer MOVW for 16 bit values.
+            return _movw(rd, value)
+        return _dp_imm(_OP_ORR, rd, 0xF, value)
+
+    if name == "cmp" and len(operands) == 2 and _is_imm(operands[1]):
+        rn, value = _reg(operands[0]), _imm(operands[1])
+        if not wide and rn < 8 and 0 <= value <= 0xFF:
+            return _halfwords(0x2800 | rn << 8 | value)
+        if narrow:
+            raise _Unsupported(operands)
+        return _dp_imm(_OP_SUB, 0xF, rn, value, s=1)
+
+    if name in ("add", "sub") and len(operands) in (2, 3) and _is_imm(operands[-1]):
+        rd, rn = _reg(operands[0]), _reg(operands[-2])
+        value = _imm(operands[-1])
+        if len(operands) == 2:
+            if rd != 13 or wide:
+                # The narrow, flag setting forms.
+                raise _Unsupported(operands)
+            if not value & 0x3 and 0 <= value <= 508:
+                return _halfwords((0xB080 if name == "sub" else 0xB000) | value >> 2)
+        elif not wide:
+            raise _Unsupported(operands)
+        if narrow:
+            raise _Unsupported(operands)
+        return _dp_imm(_OP_ADD if name == "add" else _OP_SUB, rd, rn, value)
+
+    raise _Unsupported(mnemonic)
+
+
+def encode(text, address=0):
+    """Assemble ``text`` with the built-in encoder.
+
+    Supports ``b``/``bl`` (narrow, wide and conditional), ``movw``,
+    ``mov``, ``cmp``, ``add``/``sub`` with immediates, ``nop`` and IT
+    blocks. Instructions are separated by ``;`` or newlines.
+
+    Parameters
+    ----------
+    address : int
+        Address of the first instruction; branch targets are absolute.
+
+    Returns
+    -------
+    bytes or None
+        ``None`` if any instruction is outside the supported subset.
+    """
+    out = bytearray()
+    it_conds = []
+    try:
+        for statement in re.split(r"[;\n]", text.lower()):
+            statement = statement.strip()
+            if not statement:
+                continue
+            mnemonic, _, operands = statement.partition(" ")
+            operands = [x.strip() for x in operands.split(",")] if operands else []
+
+            match = _IT_RE.match(mnemonic)
+            if match:
+                if it_conds or len(operands) != 1 or operands[0] not in _CONDS:
+                    raise _Unsupported(statement)
+                firstcond = _CONDS[operands[0]]
+                pattern = match.group(1)
+                if firstcond == 14 and "e" in pattern:
+                    raise _Unsupported(statement)
+                mask = 1 << (3 - len(pattern))
+                for i, x in enumerate(pattern):
+                    bit = firstcond & 1 if x == "t" else ~firstcond & 1
+                    mask |= bit << (3 - i)
+                it_conds = [firstcond] + [
+                    firstcond if x == "t" else firstcond ^ 1 for x in pattern
+                ]
+                out += _halfwords(0xBF00 | firstcond << 4 | mask)
+                continue
+
+            name, cond, _, _ = _parse_mnemonic(mnemonic)
+            in_it = bool(it_conds)
+            if in_it:
+                expected = it_conds.pop(0)
+                if cond != expected and not (cond is None and expected == 14):
+                    raise _Unsupported(statement)
+                if name in ("b", "bl") and it_conds:
+                    # A branch has to be last in its IT block.
+                    raise _Unsupported(statement)
+            elif cond is not None and name != "b":
+                raise _Unsupported(statement)
+
+            out += _encode_one(mnemonic, operands, address + len(out), in_it)
+    except _Unsupported:
+        return None
+    if it_conds:
+        return None
+    return bytes(out)
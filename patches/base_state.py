@@ -0,0 +1,155 @@
+"""Cache of the decoded stock firmware.
+
+Every run reads and verifies both flash backups, decrypts the external
+image and decompresses the rwdata. That only depends on the backups, so
+the result (the "base state") is stored in a memory-mappable container
+and reused by later runs.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections import namedtuple
+from pathlib import Path
+
+# Bump when the stored state, or how it's derived, changes.
+_BASE_STATE_VERSION = 1
+
+_MAGIC = b"GWBASE\x00\x00"
+_HEADER_LEN = struct.Struct("<I")
+
+# Sections start page aligned so they can be mapped directly.
+_ALIGN = mmap.ALLOCATIONGRANULARITY
+
+BaseState = namedtuple(
+    "BaseState",
+    [
+        "internal",  # Internal firmware after the rwdata has been parsed out.
+        "external",  # Decrypted external firmware.
+        "rwdata",  # ``(datas, dsts, last_fn)``, or ``None``.
+    ],
+)
+
+
+def write_container(path, sections, meta):
+    """Atomically write named byte ``sections`` and a JSON-able ``meta`` to ``path``."""
+    layout, offset = {}, None
+    header = b""
+    # The header size depends on the offsets, which depend on the header size.
+    for _ in range(2):
+        offset = -(-(len(_MAGIC) + _HEADER_LEN.size + len(header)) // _ALIGN) * _ALIGN
+        layout = {}
+        for name, data in sections.items():
+            layout[name] = [offset, len(data)]
+            offset += -(-len(data) // _ALIGN) * _ALIGN
+        header = json.dumps({"meta": meta, "sections": layout}).encode()
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(_MAGIC + _HEADER_LEN.pack(len(header)) + header)
+        for name, data in sections.items():
+            f.seek(layout[name][0])
+            f.write(data)
+        f.truncate(offset)
+    os.replace(tmp, path)
+
+
+def read_container(path, copy=bytearray):
+    """Read a ``write_container`` file.
+
+    Sections are copied straight out of a read-only mapping of the file
+    with ``copy``.
+
+    Returns
+    -------
+    tuple
+        ``(sections, meta)``.
+
+    Raises
+    ------
+    ValueError
+        If ``path`` isn't a valid container.
+    """
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped, memoryview(mapped) as view:
+        start = len(_MAGIC) + _HEADER_LEN.size
+        if view[: len(_MAGIC)] != _MAGIC or len(view) < start:
+            raise ValueError(f"{path} isn't a container")
+        (header_len,) = _HEADER_LEN.unpack(view[len(_MAGIC) : start])
+        header = json.loads(bytes(view[start : start + header_len]))
+
+        sections = {}
+        for name, (offset, size) in header["sections"].items():
+            if offset + size > len(view):
+                raise ValueError(f"{path} is truncated")
+            with view[offset : offset + size] as section:
+                sections[name] = copy(section)
+    return sections, header["meta"]
+
+
+class BaseStateCache:
+    """Stores one ``BaseState`` per device, keyed by the backups' hashes."""
+
+    def __init__(self, directory=None):
+        self.directory = None
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            self.set_directory(directory)
+
+    @staticmethod
+    def key(name, *images) -> str:
+        h = hashlib.sha256(f"{_BASE_STATE_VERSION}|{name}".encode())
+        for image in images:
+            h.update(hashlib.sha256(image).digest())
+        return h.hexdigest()
+
+    def set_directory(self, directory):
+        """Enable (or disable with ``None``) the cache."""
+        self.directory = None if directory is None else Path(directory)
+
+    def path(self, name):
+        return self.directory / f"base_{name}.bin"
+
+    def load(self, name, key):
+        """Returns the stored ``BaseState``, or ``None``."""
+        if self.directory is None:
+            return None
+        try:
+            sections, meta = read_container(self.path(name))
+        except (OSError, ValueError, KeyError):
+            sections, meta = None, None
+        if not isinstance(meta, dict) or meta.get("key") != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        rwdata = meta["rwdata"]
+        if rwdata is not None:
+            datas = [sections[f"rwdata{i}"] for i in range(len(rwdata["dsts"]))]
+            rwdata = (datas, rwdata["dsts"], rwdata["last_fn"])
+        return BaseState(sections["internal"], sections["external"], rwdata)
+
+    def store(self, name, key, state):
+        if self.directory is None:
+            return
+        sections = {"internal": state.internal, "external": state.external}
+        meta = {"key": key, "rwdata": None}
+        if state.rwdata is not None:
+            datas, dsts, last_fn = state.rwdata
+            for i, data in enumerate(datas):
+                sections[f"rwdata{i}"] = data
+            meta["rwdata"] = {"dsts": list(dsts), "last_fn": last_fn}
+        try:
+            write_container(self.path(name), sections, meta)
+        except OSError:
+            # The cache is only an optimization.
+            pass
+
+
+base_state_cache = BaseStateCache()
@@ -1,23 +1,514 @@
+import hashlib
 import lzma
+import os
+import sys
+import zlib
+from collections import OrderedDict
+from pathlib import Path
 
+LZMA_DICT_SIZE = 16 * 1024
 
-def lzma_compress(data):
+# THIS HAS TO AGREE WITH Core/Src/main.c
+# The decoder's probability tables are allocated from a static buffer of
+# this size, which bounds lc + lp.
+LZMA_BUF_SIZE = 16256
+
+# Every payload starts with the 5 byte LZMA properties header (lc/lp/pb and
+# dict_size) so the firmware can decode payloads with differing settings.
+LZMA_PROPS_SIZE = 5
+
+LZMA_FILTERS = [
+    {
+        "id": lzma.FILTER_LZMA1,
+        "preset": 6,
+        "dict_size": LZMA_DICT_SIZE,
+        "lc": 3,
+        "lp": 0,
+        "pb": 2,
+    }
+]
+
+
+def lzma_probs_size(lc, lp):
+    """Bytes of decoder probability tables; see ``LzmaProps_GetNumProbs``."""
+    return (1984 + (0x300 << (lc + lp))) * 2
+
+
+def lzma_properties(compressed_data):
+    """Decode the properties header of a ``lzma_compress`` payload."""
+    d = compressed_data[0]
+    return {
+        "lc": d % 9,
+        "lp": (d // 9) % 5,
+        "pb": d // 45,
+        "dict_size": int.from_bytes(compressed_data[1:LZMA_PROPS_SIZE], "little"),
+    }
+
+
+def _lzma_search_filters(size):
+    """Candidate filter chains for ``lzma_compress(..., search=True)``."""
+    dict_sizes = sorted({LZMA_DICT_SIZE, max(1 << 12, 1 << (size - 1).bit_length())})
+    for preset in (6, 9 | lzma.PRESET_EXTREME):
+        for dict_size in dict_sizes:
+            for lc in range(4):
+                for lp in range(3):
+                    if lzma_probs_size(lc, lp) > LZMA_BUF_SIZE:
+                        continue
+                    for pb in range(3):
+                        yield [
+                            {
+                                "id": lzma.FILTER_LZMA1,
+                                "preset": preset,
+                                "dict_size": dict_size,
+                                "lc": lc,
+                                "lp": lp,
+                                "pb": pb,
+                            }
+                        ]
+
+
+def _liblzma_version():
+    """Version of the liblzma the ``lzma`` module runs on."""
+    try:
+        import ctypes
+
+        import _lzma
+
+        version_string = ctypes.CDLL(_lzma.__file__).lzma_version_string
+    except (ImportError, OSError, AttributeError):
+        # Not exported on this platform; the Python build is the next best thing.
+        return sys.version
+    version_string.restype = ctypes.c_char_p
+    return version_string().decode()
+
+
+# Part of every cache key; another encoder may produce other output.
+LIBLZMA_VERSION = _liblzma_version()
+
+
+class CompressionCache:
+    """Content-addressed cache of compressed payloads.
+
+    Entries are keyed by a digest of the payload, the compression
+    settings and ``LIBLZMA_VERSION``, and store the compressed bytes. The
+    most recently used entries are kept in memory up to ``max_size``
+    bytes. If a ``directory`` is set, entries put with ``persist`` are
+    also stored there so that repeated runs with the same inputs skip
+    compression entirely.
+    """
+
+    def __init__(self, max_size=64 << 20, directory=None, max_disk_size=256 << 20):
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # Keys put without ``persist``.
+        self._memory_only = set()
+        self.hits = 0
+        self.misses = 0
+
+        self.directory = None
+        if directory is not None:
+            self.set_directory(directory)
+
+    @staticmethod
+    def key(data, settings) -> str:
+        h = hashlib.sha256(f"{LIBLZMA_VERSION};{settings!r}".encode())
+        h.update(data)
+        return h.hexdigest()
+
+    def set_directory(self, directory):
+        """Enable (or disable with ``None``) the on-disk store.
+
+        The store is pruned down to ``max_disk_size`` bytes, least recently
+        used first.
+        """
+        if directory is None:
+            self.directory = None
+            return
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry)
+            for entry in self.directory.glob("*.bin")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_disk_size:
+                break
+            entry.unlink()
+            total -= size
+
+    def _path(self, key):
+        return self.directory / f"{key}.bin"
+
+    def get(self, key, persist=False):
+        """Returns the cached compressed bytes, or ``None``.
+
+        With ``persist``, an entry so far only kept in memory is stored on
+        disk.
+        """
+        try:
+            value = self._memory[key]
+        except KeyError:
+            pass
+        else:
+            self._memory.move_to_end(key)
+            if persist and key in self._memory_only:
+                self.put(key, value)
+            self.hits += 1
+            return value
+
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                value = path.read_bytes()
+            except FileNotFoundError:
+                pass
+            else:
+                os.utime(path)
+                self._remember(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value, persist=True):
+        """Cache ``value``; only in memory unless ``persist``."""
+        value = bytes(value)
+        self._remember(key, value)
+        if not persist:
+            self._memory_only.add(key)
+            return
+        self._memory_only.discard(key)
+
+        if self.directory is not None:
+            path = self._path(key)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_bytes(value)
+            os.replace(tmp, path)
+
+    def _remember(self, key, value):
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = value
+        self._memory_size += len(value)
+
+        while self._memory_size > self.max_size and len(self._memory) > 1:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+            self._memory_only.discard(evicted_key)
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_size = 0
+        self._memory_only.clear()
+
+
+compression_cache = CompressionCache()
+
+
+# Configured via ``set_lzma_search``
+_lzma_search = False
+_lzma_search_jobs = 1
+
+
+def set_lzma_search(enabled, jobs=1):
+    """Enable the per-payload parameter search for ``lzma_compress`` calls
+    that don't explicitly set ``search``.
+    """
+    global _lzma_search, _lzma_search_jobs
+    _lzma_search = enabled
+    _lzma_search_jobs = jobs
+
+
+def _lzma_compress(data, filters=LZMA_FILTERS):
     # https://svn.python.org/projects/external/xz-5.0.3/doc/lzma-file-format.txt
     compressed_data = lzma.compress(
         data,
         format=lzma.FORMAT_ALONE,
-        filters=[
-            {
-                "id": lzma.FILTER_LZMA1,
-                "preset": 6,
-                "dict_size": 16 * 1024,
-            }
-        ],
+        filters=filters,
     )
-    compressed_data = compressed_data[13:]
+    # Keep the properties, strip the 8 byte uncompressed length.
+    compressed_data = compressed_data[:LZMA_PROPS_SIZE] + compressed_data[13:]
     return compressed_data
 
 
+def lzma_compress(data, search=None, persist=True):
+    """
+    Parameters
+    ----------
+    search : bool
+        Try many lc/lp/pb, dict_size and preset combinations and keep the
+        smallest result. Defaults to the ``set_lzma_search`` setting.
+    persist : bool
+        Store the result in the on-disk cache. Disable for size probes,
+        which are rarely compressed again.
+
+    Returns
+    -------
+    bytes
+        LZMA properties header followed by the compressed stream.
+    """
+    return lzma_compress_many(
+        [data], jobs=_lzma_search_jobs, search=search, persist=persist
+    )[0]
+
+
+def lzma_compress_many(datas, jobs=1, search=None, persist=True):
+    """Compress several independent payloads.
+
+    Cache misses are compressed in a process pool of ``jobs`` workers.
+    Results are returned in input order and are identical to calling
+    ``lzma_compress`` on each payload.
+    """
+    if search is None:
+        search = _lzma_search
+    settings = ("search", LZMA_BUF_SIZE) if search else LZMA_FILTERS
+
+    datas = [bytes(data) for data in datas]
+    keys = [compression_cache.key(data, settings) for data in datas]
+    results = [compression_cache.get(key, persist=persist) for key in keys]
+
+    misses = {}
+    for key, data, result in zip(keys, datas, results):
+        if result is None:
+            misses.setdefault(key, data)
+
+    # Flatten to (payload, filters) jobs
+    tasks = []
+    for key, data in misses.items():
+        if search:
+            candidates = _lzma_search_filters(len(data))
+        else:
+            candidates = [LZMA_FILTERS]
+        tasks.extend((key, data, filters) for filters in candidates)
+
+    if jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(min(jobs, len(tasks))) as executor:
+            outputs = list(
+                executor.map(
+                    _lzma_compress,
+                    [task[1] for task in tasks],
+                    [task[2] for task in tasks],
+                    chunksize=max(1, len(tasks) // (4 * jobs)),
+                )
+            )
+    else:
+        outputs = [_lzma_compress(data, filters) for _, data, filters in tasks]
+
+    # Keep the smallest; ties go to the earliest candidate so results are
+    # deterministic.
+    compressed = {}
+    for (key, _, _), output in zip(tasks, outputs):
+        if key not in compressed or len(output) < len(compressed[key]):
+            compressed[key] = output
+
+    for key, value in compressed.items():
+        compression_cache.put(key, value, persist=persist)
+        if search:
+            props = lzma_properties(value)
+            print(
+                f"    lzma search: lc={props['lc']} lp={props['lp']} pb={props['pb']} "
+                f"dict_size=0x{props['dict_size']:X} -> {len(value)} bytes"
+            )
+
+    return [
+        compressed[key] if result is None else result
+        for key, result in zip(keys, results)
+    ]
+
+
+def lzma_decompress(compressed_data):
+    """Inverse of ``lzma_compress``; mirrors ``memcpy_inflate``."""
+    header = bytes(compressed_data[:LZMA_PROPS_SIZE]) + b"\xFF" * 8
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    return decompressor.decompress(header + bytes(compressed_data[LZMA_PROPS_SIZE:]))
+
+
+def _probe_len(data):
+    """Compressed size of ``data``; only cached in memory."""
+    return len(lzma_compress(data, search=False, persist=False))
+
+
+class LzmaSizeEstimator:
+    """Incrementally estimates ``len(lzma_compress(blob))`` of a growing blob.
+
+    Recompressing the whole blob for every candidate block is quadratic.
+    Since the encoder can never reference data further back than
+    ``LZMA_DICT_SIZE``, the marginal cost of a block is estimated by
+    compressing it primed with only the trailing dictionary window of the
+    accepted data.
+
+    The estimate drifts slightly from the true size because the range
+    coder's probability models see the whole stream; ``compressed_len``
+    returns the exact value and resynchronizes the estimate.
+    """
+
+    def __init__(self, window=LZMA_DICT_SIZE):
+        self.window = window
+        self.data = bytearray()
+        self.estimate = 0
+
+        # Compressed length of the current trailing window.
+        self._context_len = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def price(self, block) -> int:
+        """Estimated number of compressed bytes ``block`` would add."""
+        if not block:
+            return 0
+        context = bytes(self.data[-self.window :])
+        if self._context_len is None:
+            self._context_len = _probe_len(context)
+        return _probe_len(context + bytes(block)) - self._context_len
+
+    def checkpoint(self):
+        return len(self.data), self.estimate, self._context_len
+
+    def rollback(self, checkpoint):
+        """Forget all blocks pushed after ``checkpoint`` was taken."""
+        n_bytes, self.estimate, self._context_len = checkpoint
+        del self.data[n_bytes:]
+
+    def push(self, block, cost=None) -> int:
+        """Accept ``block``; returns its estimated marginal compressed size.
+
+        If ``cost`` is given, it's used instead of pricing ``block``, and the
+        trailing window is only compressed on the next ``price``.
+        """
+        if cost is None:
+            cost = self.price(block)
+            self.data.extend(block)
+            self._context_len = _probe_len(bytes(self.data[-self.window :]))
+        else:
+            self.data.extend(block)
+            self._context_len = None
+        self.estimate += cost
+        return cost
+
+    def compressed_len(self) -> int:
+        """Exact compressed length of all accepted data."""
+        if not self.data:
+            self.estimate = 0
+        else:
+            self.estimate = _probe_len(bytes(self.data))
+        return self.estimate
+
+
+class CompressibilityScreen:
+    """Cheap pre-screen of a block's marginal LZMA cost.
+
+    Raw deflate at level 1, primed with the same trailing window as
+    ``LzmaSizeEstimator``, is orders of magnitude faster than an LZMA trial
+    and tracks it well up to a scale factor. The factor depends on how
+    compressible the data is, so it's calibrated from the full LZMA trials
+    with the most similar deflate ratio. A block is only decided without a
+    trial if its ratio clears ``threshold`` by ``margin`` for all of them.
+
+    Parameters
+    ----------
+    threshold : float
+        Minimum compression ratio for a block to be accepted.
+    margin : float
+        Required distance from ``threshold``, as a ratio.
+    min_samples : int
+        Number of similar full trials a decision is based on.
+    min_size : int
+        Smaller blocks are cheap to trial and too noisy to calibrate on.
+    verify : bool
+        Never skip the full trial; only measure agreement.
+    """
+
+    def __init__(
+        self, threshold, margin=1.1, min_samples=4, min_size=256, verify=False
+    ):
+        self.threshold = threshold
+        self.margin = margin
+        self.min_samples = min_samples
+        self.min_size = min_size
+        self.verify = verify
+
+        # (deflate ratio, lzma cost / deflate cost) of each full trial.
+        self._samples = []
+
+        self.n_accepted = 0
+        self.n_rejected = 0
+        self.n_trials = 0
+        self.n_agreed = 0
+
+    def price(self, block, context=b"") -> int:
+        """Deflated size of ``block`` given the preceding ``context``."""
+        if context:
+            compressor = zlib.compressobj(1, zlib.DEFLATED, -15, zdict=bytes(context))
+        else:
+            compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+        return len(compressor.compress(bytes(block)) + compressor.flush())
+
+    def _factors(self, size, zlib_cost):
+        ratio = size / max(zlib_cost, 1)
+        nearest = sorted(self._samples, key=lambda sample: abs(sample[0] - ratio))
+        return [factor for _, factor in nearest[: self.min_samples]]
+
+    def predict(self, size, zlib_cost) -> int:
+        """Estimated LZMA cost from the median calibration factor."""
+        factors = sorted(self._factors(size, zlib_cost))
+        if not factors:
+            return zlib_cost
+        return max(1, round(zlib_cost * factors[len(factors) // 2]))
+
+    def decide(self, size, zlib_cost):
+        """``True`` to accept, ``False`` to reject, ``None`` if a full trial is needed."""
+        if size < self.min_size or len(self._samples) < self.min_samples:
+            return None
+        factors = self._factors(size, zlib_cost)
+        zlib_cost = max(zlib_cost, 1)
+        worst = size / (zlib_cost * max(factors))
+        best = size / (zlib_cost * min(factors))
+        if worst >= self.threshold * self.margin:
+            decision = True
+        elif best * self.margin < self.threshold:
+            decision = False
+        else:
+            return None
+        if not self.verify:
+            if decision:
+                self.n_accepted += 1
+            else:
+                self.n_rejected += 1
+        return decision
+
+    def record(self, size, zlib_cost, lzma_cost, decision=None):
+        """Calibrate against a full trial.
+
+        ``decision`` is what ``decide`` returned for this block; if ``None``,
+        the prediction from the median factor is scored instead.
+        """
+        if decision is None:
+            decision = size / self.predict(size, zlib_cost) >= self.threshold
+        actual = size / max(lzma_cost, 1) >= self.threshold
+        self.n_trials += 1
+        self.n_agreed += decision == actual
+        if size >= self.min_size:
+            zlib_cost = max(zlib_cost, 1)
+            self._samples.append((size / zlib_cost, max(lzma_cost, 1) / zlib_cost))
+
+    def report(self) -> str:
+        agreement = 100 * self.n_agreed / self.n_trials if self.n_trials else 100.0
+        return (
+            f"pre-screen: {self.n_accepted} accepted and {self.n_rejected} rejected "
+            f"without LZMA; agreed with {self.n_agreed}/{self.n_trials} "
+            f"full trials ({agreement:.1f}%)"
+        )
+
+
 def lz77_decompress(data):
     """Decompresses rwdata used to initialize variables.
 
@@ -65,9 +556,10 @@ def lz77_decompress(data):
             index += 1
 
         # Direct Copy
-        for _ in range(direct_len):
-            out.append(data[index])
-            index += 1
+        if index + direct_len > len(data):
+            raise IndexError("lz77 literal run exceeds input length")
+        out += data[index : index + direct_len]
+        index += direct_len
 
         # Pattern
         if pattern_len > 0:
@@ -82,7 +574,13 @@ def lz77_decompress(data):
             # offset can be in range [0, 0xffff]
 
             # +2 because anything shorter wouldn't be a pattern.
-            for _ in range(pattern_len + 2):
-                out.append(out[-offset])
+            pattern_len += 2
+            if 0 < offset <= len(out) and offset >= pattern_len:
+                start = len(out) - offset
+                out += out[start : start + pattern_len]
+            else:
+                # Overlapping pattern; the copy reads bytes it just wrote.
+                for _ in range(pattern_len):
+                    out.append(out[-offset])
 
     return out
@@ -0,0 +1,149 @@
+"""Sector level deltas between flash images, for quick re-flashing.
+
+Only the erase sectors that differ from what's on the device are written
+out, along with an openocd script that erases and programs just those
+ranges.
+
+What's on the device is known from the copies every flash target of the
+Makefile records in ``FLASHED_DIR``; targets that leave the contents
+unknown (erasing) forget the record. Without a record, the whole image is
+programmed.
+"""
+
+import shutil
+from collections import namedtuple
+from pathlib import Path
+
+from .devices import (
+    EXT_FLASH_BASE,
+    EXT_FLASH_SECTOR_SIZE,
+    INT_FLASH_BASE,
+    INT_FLASH_SECTOR_SIZE,
+)
+
+# Copies of the images as last flashed.
+FLASHED_DIR = Path("build/flashed")
+
+FlashImage = namedtuple(
+    "FlashImage",
+    [
+        "name",
+        "address",  # Where ``new`` is programmed.
+        "sector_size",
+        "new",
+        "old",  # What's currently on the device.
+    ],
+)
+
+DeltaChunk = namedtuple("DeltaChunk", ["address", "path", "size"])
+
+SCRIPT_NAME = "flash_delta.cfg"
+
+
+def changed_ranges(new, old, sector_size):
+    """Sector aligned ``(start, end)`` ranges of ``new`` that differ from ``old``.
+
+    Adjacent changed sectors are merged; the last range ends at
+    ``len(new)``. Bytes past the end of ``old`` always count as changed.
+    """
+    ranges = []
+    with memoryview(new) as new, memoryview(old) as old:
+        for start in range(0, len(new), sector_size):
+            end = min(start + sector_size, len(new))
+            if new[start:end] == old[start:end]:
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+    return [tuple(r) for r in ranges]
+
+
+def flashed_image(name):
+    """Contents of the device for image ``name``; empty if unknown."""
+    try:
+        return (FLASHED_DIR / f"{name}.bin").read_bytes()
+    except FileNotFoundError:
+        return b""
+
+
+def firmware_images(internal, external):
+    """``FlashImage`` of the patched internal and (if used) external firmware."""
+    images = [
+        FlashImage(
+            "internal",
+            INT_FLASH_BASE,
+            INT_FLASH_SECTOR_SIZE,
+            internal,
+            flashed_image("internal"),
+        )
+    ]
+    if len(external):
+        images.append(
+            FlashImage(
+                "external",
+                EXT_FLASH_BASE,
+                EXT_FLASH_SECTOR_SIZE,
+                external,
+                flashed_image("external"),
+            )
+        )
+    return images
+
+
+def write_delta(images, output_dir, verify=True):
+    """Write the changed sectors of ``images`` and an openocd script to ``output_dir``.
+
+    Returns
+    -------
+    list
+        ``DeltaChunk`` per changed range, in programming order.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for stale in output_dir.glob("*_0x*.bin"):
+        stale.unlink()
+
+    chunks = []
+    for image in images:
+        for start, end in changed_ranges(image.new, image.old, image.sector_size):
+            address = image.address + start
+            path = output_dir / f"{image.name}_0x{address:08X}.bin"
+            path.write_bytes(image.new[start:end])
+            chunks.append(DeltaChunk(address, path, end - start))
+
+    (output_dir / SCRIPT_NAME).write_text(openocd_script(chunks, verify=verify))
+    return chunks
+
+
+def openocd_script(chunks, verify=True):
+    """openocd commands erasing and programming every chunk, then resetting."""
+    lines = ["init", "halt"]
+    for chunk in chunks:
+        path = chunk.path.as_posix()
+        lines.append(f'flash write_image erase "{path}" 0x{chunk.address:08X} bin')
+        if verify:
+            lines.append(f'verify_image "{path}" 0x{chunk.address:08X} bin')
+    lines += ["reset", "exit", ""]
+    return "\n".join(lines)
+
+
+def commit(images):
+    """Record ``images`` as flashed, so the next delta is against them."""
+    FLASHED_DIR.mkdir(parents=True, exist_ok=True)
+    for name, path in images.items():
+        shutil.copyfile(path, FLASHED_DIR / f"{name}.bin")
+
+
+def forget(names):
+    """Drop the record of ``names``; the next delta programs them whole."""
+    for name in names:
+        path = FLASHED_DIR / f"{name}.bin"
+        if path.exists():
+            path.unlink()
+
+
+def summary(chunks, images):
+    size = sum(chunk.size for chunk in chunks)
+    total = sum(len(image.new) for image in images)
+    return f"Delta: {len(chunks)} ranges, {size} of {total} bytes to program"
@@ -0,0 +1,69 @@
+"""Device metadata.
+
+The Makefile reads this on every invocation and ``patch.py`` needs it
+before parsing arguments, so only the standard library may be imported
+here; the patchers themselves are imported on first use through
+``DeviceRegistry``.
+"""
+
+import importlib
+from collections import namedtuple
+
+INT_FLASH_BASE = 0x0800_0000
+INT_FLASH_LEN = 0x0002_0000
+INT_FLASH_SECTOR_SIZE = 0x2000
+
+EXT_FLASH_BASE = 0x9000_0000
+EXT_FLASH_LEN = 0x0010_0000
+EXT_FLASH_SECTOR_SIZE = 0x1000
+
+DeviceInfo = namedtuple(
+    "DeviceInfo",
+    [
+        "name",
+        "module",  # Module defining the ``Device`` subclass.
+        "stock_rom_end",  # Where novel code starts in internal flash.
+        "ram_origin",  # RAM available to novel code.
+        "ram_length",
+    ],
+)
+
+DEVICES = {
+    "mario": DeviceInfo(
+        "mario",
+        "patches.mario",
+        stock_rom_end=0x18100,
+        ram_origin=0x3001_0000,
+        ram_length=64 * (1 << 10) - 8192,
+    ),
+    "zelda": DeviceInfo(
+        "zelda",
+        "patches.zelda",
+        stock_rom_end=0x1B3E0,
+        ram_origin=0x240E_C524,
+        ram_length=68308,
+    ),
+}
+
+
+def linker_script(name) -> str:
+    """Device specific linker definitions, written to ``build/device.ld``."""
+    info = DEVICES[name]
+    return f"""
+__STOCK_ROM_END__ = 0x{info.stock_rom_end:08X};
+
+__RAM_ORIGIN__ = 0x{info.ram_origin:08X};
+__RAM_LENGTH__ = {info.ram_length};
+"""
+
+
+class DeviceRegistry(dict):
+    """Maps device name to its ``Device`` subclass.
+
+    Subclasses register themselves when their module is imported; looking
+    up a known device that isn't registered yet imports its module.
+    """
+
+    def __missing__(self, name):
+        importlib.import_module(DEVICES[name].module)
+        return dict.__getitem__(self, name)
@@ -28,3 +28,7 @@ class InvalidIPSError(Exception):
 
 class InvalidAsmError(Exception):
     """Bad ASM instructions provided to keystone-engine."""
+
+
+class ExtractionError(Exception):
+    """An asset couldn't be exported."""
@@ -0,0 +1,87 @@
+"""Free (zero filled) extent detection."""
+
+import numpy as np
+
+
+def zero_runs(data, min_length=1):
+    """Find every run of zero bytes.
+
+    Parameters
+    ----------
+    data : bytes-like
+    min_length : int
+        Shorter runs are dropped.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``(n, 2)`` array of ``[start, end)`` offsets into ``data``.
+    """
+    a = np.frombuffer(data, dtype=np.uint8)
+    iszero = np.concatenate(([False], a == 0, [False])).view(np.int8)
+    edges = np.diff(iszero)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = ends - starts >= min_length
+    return np.stack((starts[keep], ends[keep]), axis=-1)
+
+
+class FreeExtents:
+    """Zero filled extents of a buffer, queryable without rescanning it.
+
+    Parameters
+    ----------
+    runs : numpy.ndarray
+        ``(n, 2)`` array of sorted, non-overlapping ``[start, end)`` offsets,
+        as returned by ``zero_runs``.
+    """
+
+    def __init__(self, runs):
+        runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+        self._starts = runs[:, 0].copy()
+        self._ends = runs[:, 1].copy()
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        """Yields ``(start, length)`` of every extent."""
+        return zip(self._starts.tolist(), (self._ends - self._starts).tolist())
+
+    def find(self, length, alignment=1, start=0, origin=0):
+        """First offset of ``length`` free bytes.
+
+        Parameters
+        ----------
+        length : int
+        alignment : int
+            Offset must be ``origin + k * alignment``.
+        start : int
+            Offset must be at least ``start``.
+
+        Returns
+        -------
+        int or None
+            ``None`` if no extent is large enough.
+        """
+        lower = np.maximum(self._starts, start)
+        offsets = origin + -((origin - lower) // alignment) * alignment
+        (fits,) = np.nonzero(offsets + length <= self._ends)
+        if not len(fits):
+            return None
+        return int(offsets[fits[0]])
+
+    def allocate(self, offset, length):
+        """Mark ``[offset, offset + length)`` as used."""
+        end = offset + length
+        i = np.searchsorted(self._ends, offset, side="right")
+        j = np.searchsorted(self._starts, end, side="left")
+        if i >= j:
+            return
+        heads = [(self._starts[i], offset)] if self._starts[i] < offset else []
+        tails = [(end, self._ends[j - 1])] if self._ends[j - 1] > end else []
+        pieces = np.array(heads + tails, dtype=np.int64).reshape(-1, 2)
+        self._starts = np.concatenate(
+            (self._starts[:i], pieces[:, 0], self._starts[j:])
+        )
+        self._ends = np.concatenate((self._ends[:i], pieces[:, 1], self._ends[j:]))
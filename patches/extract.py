@@ -0,0 +1,230 @@
+"""Export of stock assets (ROMs, tilesets, backdrops) from the firmware.
+
+Each ``Asset`` lists the byte ranges it's made from and is regenerated
+only if the hash of those bytes differs from its last extraction to the
+same file. Devices list their assets in ``Device.assets``; they're
+extracted with ``patch.py --extract``.
+
+Exports run on ``export_executor``'s process pool while patching
+continues, so an ``Asset.export`` must be picklable: a module level
+function or a ``functools.partial`` of one.
+"""
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from .exception import ExtractionError
+from .output import encode_image, output_writer, write_if_changed
+from .utils import fds_remove_crc_gaps
+
+_CACHE_VERSION = 1
+
+Asset = namedtuple(
+    "Asset",
+    [
+        "filename",
+        "sources",  # ``(start, end)`` ranges; ``end`` may be ``None``.
+        "export",  # Called with the bytes of each source; returns bytes or an image.
+    ],
+)
+
+
+class ExtractionCache:
+    """Source hash of every extracted file.
+
+    If a ``path`` is set, entries persist there across runs.
+    """
+
+    def __init__(self, path=None):
+        self.path = None
+        self._entries = {}
+        if path is not None:
+            self.set_path(path)
+
+    def set_path(self, path):
+        """Enable (or disable with ``None``) the on-disk store, loading it if valid."""
+        if path is None:
+            self.path = None
+            return
+
+        self.path = Path(path)
+        try:
+            stored = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        if isinstance(stored, dict) and stored.get("version") == _CACHE_VERSION:
+            for key, digest in stored["entries"].items():
+                self._entries.setdefault(key, digest)
+
+    def get(self, output):
+        """Source hash ``output`` was last extracted from, or ``None``."""
+        return self._entries.get(str(output))
+
+    def put(self, output, digest):
+        self._entries[str(output)] = digest
+        if self.path is not None:
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_text(
+            json.dumps({"version": _CACHE_VERSION, "entries": self._entries}, indent=0)
+        )
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self._entries.clear()
+
+
+extraction_cache = ExtractionCache()
+
+
+def nes_rom(header, rom):
+    return header + rom
+
+
+def fds_rom(*sides):
+    """Playable FDS ROM of the disk ``sides`` as stored in flash."""
+    return b"".join(fds_remove_crc_gaps(side) for side in sides)
+
+
+# NumPy and PIL are only imported once an export runs; ``patch.py`` imports
+# this module before parsing arguments.
+def tilemap(data, palette=None, bpp=8):
+    from .tileset import bytes_to_tilemap
+
+    return bytes_to_tilemap(data, palette=palette, bpp=bpp)
+
+
+def backdrop(data):
+    from .tileset import decode_backdrop
+
+    image, _ = decode_backdrop(data)
+    return image
+
+
+def _export(path, export, sources):
+    exported = export(*sources)
+    if not isinstance(exported, (bytes, bytearray)):
+        exported = encode_image(exported, path)
+    return write_if_changed(path, exported)
+
+
+class ExportExecutor:
+    """Runs asset exports on a process pool.
+
+    ``wait`` joins them and records the successful ones in
+    ``extraction_cache``.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        # (path, digest, future) per submitted export.
+        self._jobs = []
+
+    def submit(self, path, digest, asset, sources):
+        """Export ``asset`` from the ``sources`` bytes into ``path`` in the background."""
+        if self._pid != os.getpid():
+            # A forked child can't use its parent's pool.
+            self._executor, self._jobs = None, []
+            self._pid = os.getpid()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.max_workers)
+        future = self._executor.submit(_export, path, asset.export, sources)
+        self._jobs.append((path, digest, future))
+        return future
+
+    def wait_for(self, path):
+        """Block until the export to ``path``, if any, finished.
+
+        Raises
+        ------
+        ExtractionError
+            If it failed.
+        """
+        if self._pid != os.getpid():
+            return
+        path = Path(path)
+        for job_path, _, future in self._jobs:
+            if job_path != path:
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                raise ExtractionError(f"Exporting {path} failed: {e!r}") from e
+
+    def wait(self):
+        """Block until every submitted export finished.
+
+        Raises
+        ------
+        ExtractionError
+            If any export failed; the others still complete.
+        """
+        jobs, self._jobs = self._jobs, []
+        error = None
+        for path, digest, future in jobs:
+            try:
+                future.result()
+            except Exception as e:
+                if error is None:
+                    error = ExtractionError(f"Exporting {path} failed: {e!r}")
+                    error.__cause__ = e
+            else:
+                extraction_cache.put(path, digest)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if error is not None:
+            raise error
+
+
+export_executor = ExportExecutor()
+
+
+def wait_for_output(path):
+    """Block until ``path`` is complete, if this run is exporting or writing it.
+
+    Call before reading an input file that may be one of the run's outputs.
+    """
+    output_writer.flush(path)
+    export_executor.wait_for(path)
+
+
+def extract(firmware, assets, output_dir):
+    """Export every asset of ``firmware`` whose source changed into ``output_dir``.
+
+    The sources are copied, so ``firmware`` may be patched while
+    ``export_executor`` runs the exports; join them with its ``wait``.
+
+    Returns
+    -------
+    tuple
+        ``(extracted, unchanged)`` number of assets.
+    """
+    output_dir = Path(output_dir)
+    extracted = unchanged = 0
+    for asset in assets:
+        path = output_dir / asset.filename
+        sources = []
+        h = hashlib.sha256()
+        for start, end in asset.sources:
+            with firmware.view(start, end) as data:
+                sources.append(bytes(data))
+            h.update(f"{start}:{end};".encode())
+            h.update(sources[-1])
+        digest = h.hexdigest()
+        if extraction_cache.get(path) == digest and path.exists():
+            unchanged += 1
+            continue
+
+        export_executor.submit(path, digest, asset, sources)
+        extracted += 1
+    return extracted, unchanged
@@ -1,18 +1,59 @@
 import hashlib
+from bisect import bisect_right
+from collections import namedtuple
+from pathlib import Path
 
+import numpy as np
 from colorama import Fore, Style
 from Crypto.Cipher import AES
-from elftools.elf.elffile import ELFFile
 
-from .compression import lz77_decompress, lzma_compress
+from .base_state import BaseState, base_state_cache
+from .compression import (
+    CompressibilityScreen,
+    LzmaSizeEstimator,
+    lz77_decompress,
+    lzma_compress,
+    lzma_compress_many,
+)
+from .devices import (
+    EXT_FLASH_BASE,
+    EXT_FLASH_LEN,
+    EXT_FLASH_SECTOR_SIZE,
+    INT_FLASH_BASE,
+    INT_FLASH_LEN,
+    DeviceRegistry,
+)
 from .exception import (
     InvalidStockRomError,
     MissingSymbolError,
     NotEnoughSpaceError,
     ParsingError,
 )
+from .extents import FreeExtents, zero_runs
+from .extract import extract
 from .patch import FirmwarePatchMixin
-from .utils import round_down_word, round_up_word
+from .placement import (
+    COMPRESSED_MEMORY,
+    EXTERNAL,
+    INTERNAL,
+    PlacementBlock,
+    evaluate,
+    layout_blocks,
+    optimize_placement,
+    order_blocks,
+)
+from .symbols import SymbolIndex
+from .utils import printi, round_down_word, round_up_word
+
+RWDataFixup = namedtuple(
+    "RWDataFixup",
+    [
+        "index",  # RWData table element.
+        "offset",  # Byte offset of the word in the decompressed rwdata.
+        "old",
+        "new",
+    ],
+)
 
 
 def _val_to_color(val):
@@ -24,17 +65,109 @@ def _val_to_color(val):
         return ""
 
 
-class Lookup(dict):
+class Lookup:
+    """Maps original addresses to their relocated addresses.
+
+    Moves are stored as sorted, non-overlapping ``[start, end) -> dst``
+    intervals rather than one entry per byte. Like a dict, a later move of
+    the same source address overrides the earlier one.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._dsts = []
+        self._arrays = None
+
+    def add(self, src: int, dst: int, size: int):
+        """Record that ``size`` bytes at ``src`` now live at ``dst``."""
+        if size <= 0:
+            return
+        end = src + size
+
+        i = bisect_right(self._starts, src) - 1
+        if i < 0 or self._ends[i] <= src:
+            i += 1
+
+        # Trim any existing intervals overlapping [src, end). Only the first
+        # can have a head left over and only the last can have a tail.
+        head, tail = [], []
+        j = i
+        while j < len(self._starts) and self._starts[j] < end:
+            old_start, old_end, old_dst = self._starts[j], self._ends[j], self._dsts[j]
+            if old_start < src:
+                head.append((old_start, src, old_dst))
+            if old_end > end:
+                tail.append((end, old_end, old_dst + end - old_start))
+            j += 1
+        intervals = head + [(src, end, dst)] + tail
+
+        self._starts[i:j] = [x[0] for x in intervals]
+        self._ends[i:j] = [x[1] for x in intervals]
+        self._dsts[i:j] = [x[2] for x in intervals]
+        self._arrays = None
+
+    def __setitem__(self, src, dst):
+        self.add(src, dst, 1)
+
+    def __getitem__(self, addr):
+        i = bisect_right(self._starts, addr) - 1
+        if i < 0 or addr >= self._ends[i]:
+            raise KeyError(addr)
+        return self._dsts[i] + addr - self._starts[i]
+
+    def translate(self, addrs) -> np.ndarray:
+        """Vectorized ``self[addr]`` for an array of addresses.
+
+        Raises
+        ------
+        KeyError
+            With the first address that hasn't been relocated.
+        """
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.array(x, dtype=np.int64)
+                for x in (self._starts, self._ends, self._dsts)
+            )
+        starts, ends, dsts = self._arrays
+
+        addrs = np.asarray(addrs, dtype=np.int64)
+        i = np.searchsorted(starts, addrs, side="right") - 1
+        found = i >= 0
+        i = np.maximum(i, 0)
+        if len(starts):
+            found &= addrs < ends[i]
+        else:
+            found[:] = False
+        if not found.all():
+            raise KeyError(int(addrs[~found][0]))
+        return dsts[i] + addrs - starts[i]
+
+    def __contains__(self, addr):
+        try:
+            self[addr]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        """Number of relocated bytes."""
+        return sum(end - start for start, end in zip(self._starts, self._ends))
+
+    def items(self):
+        """Yields ``(src_start, src_end, dst_start)`` intervals."""
+        return zip(self._starts, self._ends, self._dsts)
+
     def __repr__(self):
         substrs = []
         substrs.append("{")
-        for k, v in sorted(self.items()):
-            k_color = _val_to_color(k)
-            v_color = _val_to_color(v)
+        for start, end, dst in self.items():
+            k_color = _val_to_color(start)
+            v_color = _val_to_color(dst)
 
             substrs.append(
-                f"    {k_color}0x{k:08X}{Style.RESET_ALL}: "
-                f"{v_color}0x{v:08X}{Style.RESET_ALL},"
+                f"    {k_color}0x{start:08X}-0x{end:08X}{Style.RESET_ALL}: "
+                f"{v_color}0x{dst:08X}{Style.RESET_ALL},"
             )
         substrs.append("}")
         return "\n".join(substrs)
@@ -48,8 +181,21 @@ class Firmware(FirmwarePatchMixin, bytearray):
     FLASH_BASE = 0x0000_0000
     FLASH_LEN = 0
 
-    def __init__(self, firmware=None):
-        if firmware:
+    # Granularity of dirty tracking; the external flash erase sector size.
+    PAGE_SIZE = EXT_FLASH_SECTOR_SIZE
+
+    def __init__(self, firmware=None, verify=True):
+        """
+        Parameters
+        ----------
+        firmware : path-like or bytes-like, optional
+            Firmware file, or its contents. Defaults to ``FLASH_LEN`` zeros.
+        verify : bool
+            Check the contents with ``_verify``.
+        """
+        if isinstance(firmware, (bytes, bytearray, memoryview)):
+            super().__init__(firmware)
+        elif firmware:
             with open(firmware, "rb") as f:
                 firmware_data = f.read()
             super().__init__(firmware_data)
@@ -57,7 +203,9 @@ class Firmware(FirmwarePatchMixin, bytearray):
             super().__init__(self.FLASH_LEN)
 
         self._lookup = Lookup()
-        self._verify()
+        self.clear_dirty()
+        if verify:
+            self._verify()
 
     def _verify(self):
         pass
@@ -104,7 +252,145 @@ class Firmware(FirmwarePatchMixin, bytearray):
                         f"firmware length {len(self)} ({hex(len(self))})"
                     ) from None
 
-        return super().__setitem__(key, new_val)
+        n = len(self)
+        super().__setitem__(key, new_val)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if len(self) != n:
+                # Everything after a resized slice moved.
+                self._clean_len = min(self._clean_len, start)
+            if step < 0:
+                start, stop = stop + 1, start + 1
+            self._mark_dirty(start, stop)
+        else:
+            key = key + n if key < 0 else key
+            self._mark_dirty(key, key + 1)
+
+    def __delitem__(self, key):
+        n = len(self)
+        super().__delitem__(key)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            start = min(start, stop + 1) if step < 0 else start
+        else:
+            start = key + n if key < 0 else key
+        self._clean_len = min(self._clean_len, start)
+
+    def _mark_dirty(self, start, end):
+        if end <= start:
+            return
+        first, last = start // self.PAGE_SIZE, -(-end // self.PAGE_SIZE)
+        if last > len(self._dirty):
+            self._dirty = np.concatenate(
+                (self._dirty, np.zeros(last - len(self._dirty), dtype=bool))
+            )
+        self._dirty[first:last] = True
+
+    def clear_dirty(self):
+        """Consider the current contents clean."""
+        self._dirty = np.zeros(-(-len(self) // self.PAGE_SIZE), dtype=bool)
+        # Bytes past this were added or moved since; they're always dirty.
+        self._clean_len = len(self)
+
+    def dirty_pages(self) -> np.ndarray:
+        """Per ``PAGE_SIZE`` page of ``self``, whether it changed since ``clear_dirty``.
+
+        Writes through ``__setitem__``, ``set_range``, ``memmove`` and the
+        patch operations, and every writable ``view``/``array``, count as
+        changes, as does anything moved by resizing.
+        """
+        n_pages = -(-len(self) // self.PAGE_SIZE)
+        pages = np.zeros(n_pages, dtype=bool)
+        tracked = min(n_pages, len(self._dirty))
+        pages[:tracked] = self._dirty[:tracked]
+        pages[self._clean_len // self.PAGE_SIZE :] = True
+        return pages
+
+    def dirty_extents(self, start: int = 0, end=None) -> list:
+        """Page aligned ``(start, end)`` ranges of ``self[start:end]`` that changed.
+
+        Ranges are clipped to ``[start, end)``.
+        """
+        start, end = self._check_range(start, end)
+        # Dirty runs are the zero runs of the clean pages.
+        runs = zero_runs(~self.dirty_pages()) * self.PAGE_SIZE
+        runs = np.clip(runs, start, end)
+        return [(lo, hi) for lo, hi in runs.tolist() if lo < hi]
+
+    def is_dirty(self, start: int = 0, end=None) -> bool:
+        return bool(self.dirty_extents(start, end))
+
+    def _check_range(self, start, end, exc=IndexError):
+        """Normalize ``start``/``end`` like a slice, but raise ``exc`` if out of range."""
+        n = len(self)
+        if end is None:
+            end = n
+        start_ = start + n if start < 0 else start
+        end_ = end + n if end < 0 else end
+        if not 0 <= start_ <= n:
+            raise exc(f"Index {start} ({hex(start)}) out of range")
+        if not start_ <= end_ <= n:
+            raise exc(f"Index {end - 1} ({hex(end - 1)}) out of range")
+        return start_, end_
+
+    def view(self, start: int = 0, end=None, readonly=True) -> memoryview:
+        """Zero-copy view of ``self[start:end]``.
+
+        The firmware can't be resized while a view is alive, so prefer using
+        it as a context manager::
+
+            with firmware.view(start, end) as data:
+                ...
+        """
+        start, end = self._check_range(start, end)
+        with memoryview(self) as whole:
+            view = whole[start:end]
+        if readonly:
+            return view.toreadonly()
+        # Writes through the view aren't seen; assume all of it changes.
+        self._mark_dirty(start, end)
+        return view
+
+    def array(self, offset: int, count: int, dtype="<u4", readonly=True) -> np.ndarray:
+        """Zero-copy NumPy view of ``count`` elements at ``offset``.
+
+        Unless ``readonly``, writes to the array go straight to the firmware
+        and its whole range counts as dirty. Like ``view``, the firmware
+        can't be resized while the array is alive.
+        """
+        dtype = np.dtype(dtype)
+        data = self.view(offset, offset + count * dtype.itemsize, readonly=readonly)
+        return np.frombuffer(data, dtype=dtype)
+
+    def u8(self, offset: int, count: int = 1, readonly=True) -> np.ndarray:
+        return self.array(offset, count, "u1", readonly=readonly)
+
+    def u16(self, offset: int, count: int = 1, readonly=True) -> np.ndarray:
+        return self.array(offset, count, "<u2", readonly=readonly)
+
+    def u32(self, offset: int, count: int = 1, readonly=True) -> np.ndarray:
+        return self.array(offset, count, "<u4", readonly=readonly)
+
+    def free_extents(self, start: int = 0, end=None, min_length=1) -> FreeExtents:
+        """Zero filled extents of ``self[start:end]``, with offsets into ``self``."""
+        start, end = self._check_range(start, end)
+        with self.view(start, end) as data:
+            runs = zero_runs(data, min_length=min_length)
+        return FreeExtents(runs + start)
+
+    def memmove(self, dst: int, src: int, size: int):
+        """Copy ``size`` bytes from ``src`` to ``dst``; the ranges may overlap."""
+        src, src_end = self._check_range(src, src + size)
+        try:
+            dst, dst_end = self._check_range(dst, dst + size)
+        except IndexError:
+            raise NotEnoughSpaceError(
+                f"Ending index {dst + size - 1} ({hex(dst + size - 1)}) exceeds "
+                f"firmware length {len(self)} ({hex(len(self))})"
+            ) from None
+        with memoryview(self) as whole:
+            whole[dst:dst_end] = whole[src:src_end]
+        self._mark_dirty(dst, dst_end)
 
     def __str__(self):
         return self.__name__
@@ -163,26 +449,22 @@ class RWData:
 
         self.firmware = firmware
         self.table_start = table_start
-        self.__compressed_len_memo = {}
 
         self.datas, self.dsts = [], []
 
-        for i in range(table_start, table_start + table_len - 4, 16):
+        rows = range(table_start, table_start + table_len - 4, 16)
+        table = firmware.u32(table_start, 4 * len(rows)).reshape(-1, 4).tolist()
+        for i, element in zip(rows, table):
             # First thing is pointer to executable, need to always replace this
             # to our lzma
-            rel_offset_to_fn = firmware.int(i)
+            rel_offset_to_fn, rel_offset_to_data, data_len, data_dst = element
             if rel_offset_to_fn > 0x8000_0000:
                 rel_offset_to_fn -= 0x1_0000_0000
             # fn_addr = i + rel_offset_to_fn
             # assert fn_addr == 0x18005  # lz_decompress function
-            i += 4
 
-            data_addr = i + firmware.int(i)
-            i += 4
-            data_len = firmware.int(i) >> 1
-            i += 4
-            data_dst = firmware.int(i)
-            i += 4
+            data_addr = i + 4 + rel_offset_to_data
+            data_len >>= 1
 
             data = lz77_decompress(firmware[data_addr : data_addr + data_len])
             print(f"    lz77 decompressed data {data_len} -> {len(data)}")
@@ -202,6 +484,27 @@ class RWData:
             table_start, table_start + 16 * self.MAX_TABLE_ELEMENTS + 4, b"\x77"
         )
 
+    @classmethod
+    def from_state(cls, firmware, table_start, datas, dsts, last_fn):
+        """Restore an ``RWData`` without parsing ``firmware``.
+
+        ``firmware`` must already have the table parsed out, i.e. be a
+        ``BaseState.internal``.
+        """
+        self = cls.__new__(cls)
+        self.firmware = firmware
+        self.table_start = table_start
+        self.datas, self.dsts = [], []
+        for data, dst in zip(datas, dsts):
+            self.append(data, dst)
+        self.last_fn = last_fn
+        return self
+
+    @property
+    def state(self):
+        """``(datas, dsts, last_fn)`` for ``from_state``."""
+        return self.datas, self.dsts, self.last_fn
+
     def __getitem__(self, k):
         return self.datas[k]
 
@@ -226,19 +529,19 @@ class RWData:
     def compressed_len(self):
         compressed_len = 0
         for data in self.datas:
-            data = bytes(data)
-            if data not in self.__compressed_len_memo:
-                compressed_data = lzma_compress(bytes(data))
-                self.__compressed_len_memo[data] = len(compressed_data)
-            compressed_len += self.__compressed_len_memo[data]
+            # The parameter search only ever shrinks the final payloads, so the
+            # default settings give a conservative, cheap estimate.
+            compressed_len += len(lzma_compress(data, search=False))
         return compressed_len
 
-    def write_table_and_data(self, end_of_table_reference, data_offset=None):
+    def write_table_and_data(self, end_of_table_reference, data_offset=None, jobs=1):
         """
         Parameters
         ----------
         data_offset : int
             Where to write the compressed data
+        jobs : int
+            Number of processes to compress the table entries with.
         """
 
         # Write Compressed Data
@@ -249,8 +552,8 @@ class RWData:
             index = data_offset
 
         total_len = 0
-        for data in self.datas:
-            compressed_data = lzma_compress(bytes(data))
+        compressed_datas = lzma_compress_many(self.datas, jobs=jobs)
+        for data, compressed_data in zip(self.datas, compressed_datas):
             print(
                 f"    compressed {len(data)}->{len(compressed_data)} bytes "
                 f"(saves {len(data)-len(compressed_data)}). "
@@ -308,38 +611,47 @@ class RWData:
         substrs.append("")
         substrs.append("RWData Table")
         substrs.append("------------")
-        for addr in range(self.table_start, self.table_end - 4 - 4, 16):
+        words = self.firmware.u32(
+            self.table_start, (self.table_end - self.table_start) // 4
+        ).tolist()
+        for row, addr in enumerate(range(self.table_start, self.table_end - 4 - 4, 16)):
             substrs.append(
                 f"0x{addr:08X}:  "
-                f"0x{self.firmware.int(addr + 0):08X}  "
-                f"0x{self.firmware.int(addr + 4):08X}  "
-                f"0x{self.firmware.int(addr + 8):08X}  "
-                f"0x{self.firmware.int(addr + 12):08X}  "
+                + "".join(f"0x{word:08X}  " for word in words[4 * row : 4 * row + 4])
             )
         addr = self.table_end - 8
-        substrs.append(f"0x{addr:08X}:  0x{self.firmware.int(addr + 0):08X}")
+        substrs.append(f"0x{addr:08X}:  0x{words[-2]:08X}")
         addr = self.table_end - 4
-        substrs.append(f"0x{addr:08X}:  0x{self.firmware.int(addr + 0):08X}")
+        substrs.append(f"0x{addr:08X}:  0x{words[-1]:08X}")
 
         substrs.append("")
         return "\n".join(substrs)
 
 
 class IntFirmware(Firmware):
-    FLASH_BASE = 0x08000000
-    FLASH_LEN = 0x00020000
+    FLASH_BASE = INT_FLASH_BASE
+    FLASH_LEN = INT_FLASH_LEN
     RWDATA_OFFSET = None
     RWDATA_LEN = 0
     RWDATA_ITCM_IDX = None
     RWDATA_DTCM_IDX = None
 
-    def __init__(self, firmware, elf):
-        super().__init__(firmware)
-        self._elf_f = open(elf, "rb")
-        self.elf = ELFFile(self._elf_f)
-        self.symtab = self.elf.get_section_by_name(".symtab")
+    def __init__(self, firmware, elf, verify=True, rwdata=None):
+        """
+        Parameters
+        ----------
+        rwdata : tuple, optional
+            ``RWData.state`` of ``firmware``, which then must have its
+            rwdata already parsed out.
+        """
+        super().__init__(firmware, verify=verify)
+        self.symbols = SymbolIndex.load(elf)
+        # Filled by ``resolve``; ``address`` looks symbols up here first.
+        self.addresses = {}
         if self.RWDATA_OFFSET is None:
             self.rwdata = None
+        elif rwdata is not None:
+            self.rwdata = RWData.from_state(self, self.RWDATA_OFFSET, *rwdata)
         else:
             self.rwdata = RWData(self, self.RWDATA_OFFSET, self.RWDATA_LEN)
 
@@ -349,17 +661,33 @@ class IntFirmware(Firmware):
             raise InvalidStockRomError
 
     def address(self, symbol_name, sub_base=False):
-        symbols = self.symtab.get_symbol_by_name(symbol_name)
-        if not symbols:
-            raise MissingSymbolError(f'Cannot find symbol "{symbol_name}"')
-        address = symbols[0]["st_value"]
-        if address == 0:
-            raise MissingSymbolError(f"{symbol_name} has address 0x0")
-        print(f"    found {symbol_name} at 0x{address:08X}")
+        address = self.addresses.get(symbol_name)
+        if address is None:
+            address = self.symbols[symbol_name].value
+            if address == 0:
+                raise MissingSymbolError(f"{symbol_name} has address 0x0")
+            print(f"    found {symbol_name} at 0x{address:08X}")
         if sub_base:
             address -= self.FLASH_BASE
         return address
 
+    def resolve(self, symbol_names, sub_base=False):
+        """Batch ``address``; reports every missing symbol at once.
+
+        The addresses are kept for later ``address`` calls.
+
+        Returns
+        -------
+        dict
+            Maps symbol name to address.
+        """
+        addresses = self.symbols.resolve(symbol_names)
+        self.addresses.update(addresses)
+        print(f"    resolved {len(addresses)} symbols")
+        if sub_base:
+            addresses = {k: v - self.FLASH_BASE for k, v in addresses.items()}
+        return addresses
+
     @property
     def empty_offset(self):
         """Detect a series of 0x00 to figure out the end of the internal firmware.
@@ -374,11 +702,11 @@ class IntFirmware(Firmware):
             search_start = self.STOCK_ROM_END
         else:
             search_start = self.rwdata.table_end
-        for addr in range(search_start, self.FLASH_LEN, 0x10):
-            if self[addr : addr + 256] == b"\x00" * 256:
-                int_pos_start = addr
-                break
-        else:
+        extents = self.free_extents(search_start, min_length=256)
+        int_pos_start = extents.find(
+            256, alignment=0x10, start=search_start, origin=search_start
+        )
+        if int_pos_start is None:
             raise ParsingError("Couldn't find end of internal code.")
         return int_pos_start
 
@@ -399,36 +727,134 @@ def _nonce_to_iv(nonce):
     return nonce + b"\x00\x00" + b"\x71\x23" + b"\x20\x00" + b"\x00\x00"
 
 
+def _otfdec_keystream(key, iv, first_counter, n_blocks):
+    """Generate ``n_blocks`` of OTFDEC keystream in a single AES call.
+
+    Each counter block is ``iv`` with its lower 28 bits replaced by the
+    block's counter (address >> 4). The returned keystream is already
+    byte-reversed per block, so it can be XOR'd directly into the firmware.
+    """
+    counters = np.arange(first_counter, first_counter + n_blocks, dtype=np.uint32)
+
+    blocks = np.tile(np.frombuffer(iv, dtype=np.uint8), (n_blocks, 1))
+    blocks[:, 12] = ((counters >> 24) & 0x0F) | (iv[12] & 0xF0)
+    blocks[:, 13] = (counters >> 16) & 0xFF
+    blocks[:, 14] = (counters >> 8) & 0xFF
+    blocks[:, 15] = counters & 0xFF
+
+    aes = AES.new(key, AES.MODE_ECB)
+    keystream = aes.encrypt(blocks.tobytes())
+    keystream = np.frombuffer(keystream, dtype=np.uint8).reshape(n_blocks, 16)
+    return keystream[:, ::-1].tobytes()
+
+
 class ExtFirmware(Firmware):
-    FLASH_BASE = 0x9000_0000
-    FLASH_LEN = 0x0010_0000
+    FLASH_BASE = EXT_FLASH_BASE
+    FLASH_LEN = EXT_FLASH_LEN
 
     ENC_START = 0
     ENC_END = 0
 
-    def crypt(self, key, nonce):
-        """Decrypts if encrypted; encrypts if in plain text."""
-        key = bytes(key[::-1])
-        iv = bytearray(_nonce_to_iv(nonce))
+    # Below this many 16-byte blocks, a process pool costs more than it saves.
+    CRYPT_PARALLEL_MIN_BLOCKS = 1 << 16
 
-        aes = AES.new(key, AES.MODE_ECB)
+    def enc_range(self):
+        """Encrypted ``(start, end)``; ``end`` rounded up to a whole AES block."""
+        n_blocks = max(0, -(-(self.ENC_END - self.ENC_START) // 16))
+        return self.ENC_START, self.ENC_START + 16 * n_blocks
 
-        for offset in range(self.ENC_START, self.ENC_END, 128 // 8):
-            counter_block = iv.copy()
+    def crypt(self, key, nonce, jobs=1, extents=None):
+        """Decrypts if encrypted; encrypts if in plain text.
 
-            counter = (self.FLASH_BASE + offset) >> 4
-            counter_block[12] = ((counter >> 24) & 0x0F) | (counter_block[12] & 0xF0)
-            counter_block[13] = (counter >> 16) & 0xFF
-            counter_block[14] = (counter >> 8) & 0xFF
-            counter_block[15] = (counter >> 0) & 0xFF
+        Parameters
+        ----------
+        jobs : int
+            Number of processes to split keystream generation across.
+        extents : list
+            ``(start, end)`` ranges to limit crypting to, e.g. from
+            ``dirty_extents``. Defaults to the whole encrypted range.
+        """
+        key = bytes(key[::-1])
+        iv = bytes(_nonce_to_iv(nonce))
+
+        enc_start, enc_end = self.enc_range()
+        if extents is None:
+            extents = [(enc_start, enc_end)]
+        # Block aligned, clipped to the encrypted range and merged; crypting
+        # a block twice would undo it.
+        pieces = []
+        for start, end in sorted(extents):
+            start = max(enc_start, start - (start - enc_start) % 16)
+            end = min(enc_end, end + (enc_start - end) % 16)
+            if start >= end:
+                continue
+            if pieces and start <= pieces[-1][1]:
+                pieces[-1][1] = max(pieces[-1][1], end)
+            else:
+                pieces.append([start, end])
+        n_blocks = sum(end - start for start, end in pieces) // 16
+        if n_blocks <= 0:
+            return
+
+        # (offset, first_counter, n_blocks) per keystream call.
+        chunk = n_blocks
+        if jobs > 1 and n_blocks >= self.CRYPT_PARALLEL_MIN_BLOCKS:
+            chunk = -(-n_blocks // jobs)
+        calls = [
+            (offset, (self.FLASH_BASE + offset) >> 4, min(chunk, (end - offset) // 16))
+            for start, end in pieces
+            for offset in range(start, end, 16 * chunk)
+        ]
+
+        if len(calls) > 1 and chunk < n_blocks:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(jobs) as executor:
+                keystreams = list(
+                    executor.map(
+                        _otfdec_keystream,
+                        [key] * len(calls),
+                        [iv] * len(calls),
+                        [call[1] for call in calls],
+                        [call[2] for call in calls],
+                    )
+                )
+        else:
+            keystreams = [_otfdec_keystream(key, iv, c, n) for _, c, n in calls]
 
-            cipher_block = aes.encrypt(bytes(counter_block))
-            for i, cipher_byte in enumerate(reversed(cipher_block)):
-                self[offset + i] ^= cipher_byte
+        for (offset, _, n), keystream in zip(calls, keystreams):
+            start, end = offset, offset + 16 * n
+            data = np.frombuffer(self[start:end], dtype=np.uint8)
+            data = data ^ np.frombuffer(keystream, dtype=np.uint8)
+            self[start:end] = data.tobytes()
 
 
 class Device:
-    registry = {}
+    # Device subclasses are imported on first lookup; see ``devices.DEVICES``.
+    registry = DeviceRegistry()
+
+    # Internal flash bytes the placement optimizer leaves unplanned to absorb
+    # compressed size estimation error.
+    PLACEMENT_MARGIN = 1024
+
+    # Relative error ``compressed_memory_estimator`` may have drifted by.
+    # Closer than this to full, ``int_free_space`` uses the exact size.
+    COMPRESSED_LEN_TOLERANCE = 1 / 16
+
+    # Patch ELF symbols every run uses; resolved up front so a stale ELF
+    # reports all of its missing symbols at once.
+    SYMBOLS = (
+        "bootloader",
+        "read_buttons",
+        "memcpy_inflate",
+        "rwdata_inflate",
+        "bss_rwdata_init",
+    )
+    # Only used with ``--debug``.
+    DEBUG_SYMBOLS = (
+        "NMI_Handler",
+        "HardFault_Handler",
+    )
 
     def __init_subclass__(cls, name, **kwargs):
         super().__init_subclass__(**kwargs)
@@ -436,9 +862,42 @@ class Device:
         cls.registry[name] = cls
 
     def __init__(self, internal_bin, internal_elf, external_bin):
-        self.internal = self.Int(internal_bin, internal_elf)
-        self.external = self.Ext(external_bin)
+        # Set if the decoded backups should be saved to ``base_state_cache``
+        # once decrypted.
+        self._base_state_key = None
+        state = None
+        if base_state_cache.directory is not None and internal_bin and external_bin:
+            internal_bin = Path(internal_bin).read_bytes()
+            external_bin = Path(external_bin).read_bytes()
+            key = base_state_cache.key(self.name, internal_bin, external_bin)
+            state = base_state_cache.load(self.name, key)
+            if state is None:
+                self._base_state_key = key
+
+        if state is None:
+            self.internal = self.Int(internal_bin, internal_elf)
+            self.external = self.Ext(external_bin)
+            self._external_decrypted = False
+            # Captured by ``crypt``.
+            self._external_ciphertext = None
+        else:
+            # The backups were verified before they were cached.
+            print("Loaded decoded stock firmware from cache")
+            self.internal = self.Int(
+                state.internal, internal_elf, verify=False, rwdata=state.rwdata
+            )
+            self.external = self.Ext(state.external, verify=False)
+            self._external_decrypted = True
+            self._external_ciphertext = external_bin
+            self._stock_crypt = (
+                self.external.enc_range(),
+                bytes(self.internal.key),
+                bytes(self.internal.nonce),
+            )
         self.compressed_memory = self.FreeMemory()
+        self.compressed_memory_estimator = LzmaSizeEstimator()
+        # Set up in ``__call__`` from ``--prescreen``.
+        self.compressibility_screen = None
 
         # Link all lookup tables to a single device instance
         self.lookup = Lookup()
@@ -450,6 +909,24 @@ class Device:
         self.int_pos = 0
         self.compressed_memory_pos = 0
 
+        # Every relocatable block seen by ``move_ext`` and
+        # ``move_to_compressed_memory``, keyed by external offset.
+        self.placement_log = {}
+        # Internal free space when the first relocatable block was placed.
+        self.placement_int_capacity = None
+        # Data of every compressed_memory candidate, keyed by external offset.
+        self.placement_data = {}
+        # Optional {ext: location} plan from ``optimize_placement``;
+        # overrides the greedy decisions.
+        self.placement = None
+        # Optional {ext: offset} into compressed_memory from
+        # ``order_compressed_memory``.
+        self.compressed_memory_layout = None
+        self._compressed_memory_layout_end = 0
+
+        # (lower, upper) external address ranges queued by ``rwdata_lookup``.
+        self._rwdata_fixups = []
+
     def _move_copy(
         self, dst, dst_offset: int, src, src_offset: int, size: int, delete: bool
     ) -> int:
@@ -457,10 +934,7 @@ class Device:
         if delete:
             src.clear_range(src_offset, src_offset + size)
 
-        for i in range(size):
-            self.lookup[src.FLASH_BASE + src_offset + i] = (
-                dst.FLASH_BASE + dst_offset + i
-            )
+        self.lookup.add(src.FLASH_BASE + src_offset, dst.FLASH_BASE + dst_offset, size)
 
         return size
 
@@ -489,7 +963,75 @@ class Device:
         )
 
     def crypt(self):
-        self.external.crypt(self.internal.key, self.internal.nonce)
+        """Decrypt the external firmware, unless it was loaded decrypted."""
+        if self._external_decrypted:
+            return
+        self._external_ciphertext = bytes(self.external)
+        self._stock_crypt = (
+            self.external.enc_range(),
+            bytes(self.internal.key),
+            bytes(self.internal.nonce),
+        )
+        self.external.crypt(self.internal.key, self.internal.nonce, jobs=self.args.jobs)
+        self.external.clear_dirty()
+        self._external_decrypted = True
+
+        if self._base_state_key is not None:
+            rwdata = (
+                None if self.internal.rwdata is None else self.internal.rwdata.state
+            )
+            base_state_cache.store(
+                self.name,
+                self._base_state_key,
+                BaseState(self.internal, self.external, rwdata),
+            )
+            self._base_state_key = None
+
+    def encrypt(self):
+        """Encrypt the patched external firmware.
+
+        Only pages changed since ``crypt`` are encrypted; the stock
+        ciphertext of the rest is copied back, as long as it was encrypted
+        with the same key, nonce and at the same address.
+        """
+        key, nonce = self.internal.key, self.internal.nonce
+        start, end = self.external.enc_range()
+        ciphertext = self._external_ciphertext
+        if ciphertext is None or self._stock_crypt[1:] != (bytes(key), bytes(nonce)):
+            self.external.crypt(key, nonce, jobs=self.args.jobs)
+            return
+        stock_range = self._stock_crypt[0]
+
+        # Per byte of the encrypted range, whether its stock ciphertext holds.
+        reuse = np.zeros(end - start, dtype=bool)
+        lo = max(start, stock_range[0])
+        hi = min(end, stock_range[1], len(ciphertext))
+        reuse[max(0, lo - start) : max(0, hi - start)] = True
+        for dirty_start, dirty_end in self.external.dirty_extents(start, end):
+            reuse[dirty_start - start : dirty_end - start] = False
+
+        for copy_start, copy_end in (zero_runs(~reuse) + start).tolist():
+            self.external[copy_start:copy_end] = ciphertext[copy_start:copy_end]
+        extents = (zero_runs(reuse) + start).tolist()
+        self.external.crypt(key, nonce, jobs=self.args.jobs, extents=extents)
+
+    def assets(self):
+        """``extract.Asset`` of the decrypted stock external firmware."""
+        return []
+
+    def extract(self, output_dir):
+        """Export ``assets`` whose source changed since they were last extracted.
+
+        Call before patching, while the external firmware is decrypted
+        stock. The exports run in the background until
+        ``extract.export_executor.wait``.
+
+        Returns
+        -------
+        tuple
+            ``(extracted, unchanged)`` number of assets.
+        """
+        return extract(self.external, self.assets(), output_dir)
 
     def show(self, show=True):
         import matplotlib.pyplot as plt
@@ -504,20 +1046,15 @@ class Device:
         if show:
             plt.show()
 
-    def compressed_memory_compressed_len(self, add_index=0):
-        index = self.compressed_memory_pos + add_index
-        if not index:
-            return 0
-
-        data = bytes(self.compressed_memory[:index])
-        if data in self.compressed_memory_compressed_len.memo:
-            return self.compressed_memory_compressed_len.memo[data]
+    def compressed_memory_compressed_len(self, exact=False):
+        """Compressed length of ``compressed_memory[:compressed_memory_pos]``.
 
-        compressed_data = lzma_compress(data)
-        self.compressed_memory_compressed_len.memo[data] = len(compressed_data)
-        return len(compressed_data)
-
-    compressed_memory_compressed_len.memo = {}
+        Estimated unless ``exact``; computing the exact length compresses
+        all of it and resynchronizes the estimate.
+        """
+        if exact:
+            return self.compressed_memory_estimator.compressed_len()
+        return self.compressed_memory_estimator.estimate
 
     @property
     def compressed_memory_free_space(self):
@@ -525,43 +1062,111 @@ class Device:
 
     @property
     def int_free_space(self):
-        out = (
-            len(self.internal) - self.int_pos - self.compressed_memory_compressed_len()
-        )
+        out = len(self.internal) - self.int_pos
         if self.internal.rwdata is not None:
             out -= self.internal.rwdata.compressed_len
-        return out
+        estimate = self.compressed_memory_compressed_len()
+        if out - estimate < estimate * self.COMPRESSED_LEN_TOLERANCE:
+            # The estimate may be off by more than what's left.
+            return out - self.compressed_memory_compressed_len(exact=True)
+        return out - estimate
 
     def rwdata_lookup(self, lower, size):
-        lower += self.external.FLASH_BASE
-        upper = lower + size
+        """Queue relocating rwdata pointers into ``[lower, lower + size)`` of external flash.
 
-        for i in range(0, len(self.internal.rwdata[self.internal.RWDATA_DTCM_IDX]), 4):
-            val = int.from_bytes(
-                self.internal.rwdata[self.internal.RWDATA_DTCM_IDX][i : i + 4], "little"
-            )
-            if lower <= val < upper:
-                new_val = self.lookup[val]
-                print(f"    updating rwdata 0x{val:08X} -> 0x{new_val:08X}")
-                self.internal.rwdata[self.internal.RWDATA_DTCM_IDX][
-                    i : i + 4
-                ] = new_val.to_bytes(4, "little")
+        Applied by ``rwdata_fixup``.
+        """
+        lower += self.external.FLASH_BASE
+        self._rwdata_fixups.append((lower, lower + size))
 
     def rwdata_erase(self, lower, size):
+        """Erase rwdata pointers into ``[lower, lower + size)`` of external flash.
+
+        Erasing no longer used references makes it compress better. Unlike
+        ``rwdata_lookup`` this applies right away, so the smaller rwdata
+        is accounted for in ``int_free_space`` during placement.
+
+        Returns
+        -------
+        list of RWDataFixup
+            Every word that was erased.
         """
-        Erasing no longer used references makes it compress better.
+        lower += self.external.FLASH_BASE
+        return self._apply_rwdata_fixups([(lower, lower + size)], erase=True)
+
+    def rwdata_fixup(self):
+        """Apply all queued ``rwdata_lookup`` requests.
+
+        Pointers are relocated with the lookup table as it is when this is
+        called, so call it after the moves and before writing the rwdata
+        table.
+
+        Returns
+        -------
+        list of RWDataFixup
+            Every word that was changed.
         """
-        lower += 0x9000_0000
-        upper = lower + size
+        fixups, self._rwdata_fixups = self._rwdata_fixups, []
+        return self._apply_rwdata_fixups(fixups, erase=False)
+
+    def _apply_rwdata_fixups(self, fixups, erase):
+        """Relocate (or zero) every DTCM rwdata word in any of the ``fixups`` ranges.
 
-        for i in range(0, len(self.internal.rwdata[self.internal.RWDATA_DTCM_IDX]), 4):
-            val = int.from_bytes(
-                self.internal.rwdata[self.internal.RWDATA_DTCM_IDX][i : i + 4], "little"
+        All words are matched against all ranges in a single vectorized
+        pass. Only DTCM holds pointer data; the ITCM entry is Thumb code
+        where matching words are just instructions, so hits there are
+        reported but never written.
+        """
+        if not fixups:
+            return []
+
+        fixups.sort()
+        lowers = np.array([f[0] for f in fixups], dtype=np.int64)
+        uppers = np.array([f[1] for f in fixups], dtype=np.int64)
+        if np.any(lowers[1:] < uppers[:-1]):
+            raise ValueError("Overlapping rwdata fixup ranges.")
+
+        def matches(index):
+            data = self.internal.rwdata[index]
+            words = np.frombuffer(data, dtype="<u4", count=len(data) // 4)
+            vals = words.astype(np.int64)
+            i = np.searchsorted(lowers, vals, side="right") - 1
+            hit = (i >= 0) & (vals < uppers[np.maximum(i, 0)])
+            (offsets,) = np.nonzero(hit)
+            return words, offsets, vals[offsets]
+
+        itcm = self.internal.RWDATA_ITCM_IDX
+        if itcm is not None and itcm != self.internal.RWDATA_DTCM_IDX:
+            _, offsets, _ = matches(itcm)
+            if len(offsets):
+                print(
+                    f"    {len(offsets)} ITCM rwdata words are in rwdata fixup "
+                    "ranges; left alone as it's code"
+                )
+
+        dtcm = self.internal.RWDATA_DTCM_IDX
+        if dtcm is None:
+            return []
+        words, offsets, old = matches(dtcm)
+        if erase:
+            new = np.zeros_like(old)
+        else:
+            new = self.lookup.translate(old)
+        words[offsets] = new
+        del words
+
+        report = [
+            RWDataFixup(dtcm, 4 * offset, old_val, new_val)
+            for offset, old_val, new_val in zip(
+                offsets.tolist(), old.tolist(), new.tolist()
             )
-            if lower <= val < upper:
-                self.internal.rwdata[self.internal.RWDATA_DTCM_IDX][
-                    i : i + 4
-                ] = b"\x00\x00\x00\x00"
+        ]
+        for fixup in report:
+            if fixup.new:
+                print(f"    updating rwdata 0x{fixup.old:08X} -> 0x{fixup.new:08X}")
+        if erase and report:
+            print(f"    erased {len(report)} rwdata references")
+        return report
 
     def move_to_int(self, ext, size, reference):
         if self.int_free_space < size:
@@ -595,6 +1200,26 @@ class Device:
 
         return new_loc
 
+    def _record_placement(self, ext, size, reference, location, compressed_size=None):
+        if not isinstance(ext, int):
+            return
+        if reference is None:
+            n_references = 0
+        elif isinstance(reference, list):
+            n_references = len(reference)
+        else:
+            n_references = 1
+        self.placement_log[ext] = PlacementBlock(
+            ext, size, n_references, compressed_size, location
+        )
+
+    def _planned_location(self, ext):
+        if self.placement_int_capacity is None:
+            self.placement_int_capacity = self.int_free_space
+        if self.placement is None or not isinstance(ext, int):
+            return None
+        return self.placement.get(ext)
+
     def move_ext(self, ext, size, reference):
         """Attempt to relocate in priority order:
         1. Internal
@@ -603,16 +1228,38 @@ class Device:
         This is the primary moving function for data that is already compressed
         or is incompressible.
         """
+        if self._planned_location(ext) != EXTERNAL:
+            try:
+                new_loc = self.move_to_int(ext, size, reference)
+            except NotEnoughSpaceError:
+                print(
+                    f"        {Fore.RED}Not Enough Internal space. Using external flash{Style.RESET_ALL}"
+                )
+            else:
+                if isinstance(ext, int):
+                    self.ext_offset -= round_down_word(size)
+                self._record_placement(ext, size, reference, INTERNAL)
+                return new_loc
+
+        self._record_placement(ext, size, reference, EXTERNAL)
+        return self.move_ext_external(ext, size, reference)
+
+    def _move_ext_compressible(self, ext, size, reference, compressed_size):
+        """``move_ext`` for a block that was a compressed_memory candidate."""
+        new_loc = self.move_ext(ext, size, reference)
+        self._record_placement(
+            ext, size, reference, self.placement_log[ext].location, compressed_size
+        )
+        return new_loc
+
+    def _compressed_memory_offset(self, ext):
+        if self.compressed_memory_layout is None:
+            return self.compressed_memory_pos
         try:
-            new_loc = self.move_to_int(ext, size, reference)
-            if isinstance(ext, int):
-                self.ext_offset -= round_down_word(size)
-            return new_loc
-        except NotEnoughSpaceError:
-            print(
-                f"        {Fore.RED}Not Enough Internal space. Using external flash{Style.RESET_ALL}"
-            )
-            return self.move_ext_external(ext, size, reference)
+            return self.compressed_memory_layout[ext]
+        except KeyError:
+            # Unplanned blocks go after all planned ones.
+            return max(self.compressed_memory_pos, self._compressed_memory_layout_end)
 
     def move_to_compressed_memory(self, ext, size, reference):
         """Attempt to relocate in priority order:
@@ -622,61 +1269,161 @@ class Device:
 
         This is the primary moving method for any compressible data.
         """
-        current_len = self.compressed_memory_compressed_len()
+        self.placement_data[ext] = bytes(self.external[ext : ext + size])
+        planned = self._planned_location(ext)
+        if planned in (INTERNAL, EXTERNAL):
+            compressed_size = self.compressed_memory_estimator.price(
+                self.external[ext : ext + size]
+            )
+            return self._move_ext_compressible(ext, size, reference, compressed_size)
 
+        offset = self._compressed_memory_offset(ext)
         try:
-            self.compressed_memory[
-                self.compressed_memory_pos : self.compressed_memory_pos + size
-            ] = self.external[ext : ext + size]
+            self.compressed_memory[offset : offset + size] = self.external[
+                ext : ext + size
+            ]
         except NotEnoughSpaceError:
             print(
                 f"        {Fore.RED}compressed_memory full. Attempting to put in internal{Style.RESET_ALL}"
             )
-            return self.move_ext(ext, size, reference)
-
-        new_len = self.compressed_memory_compressed_len(size)
-        diff = new_len - current_len
-        compression_ratio = size / diff
+            compressed_size = self.compressed_memory_estimator.price(
+                self.external[ext : ext + size]
+            )
+            return self._move_ext_compressible(ext, size, reference, compressed_size)
+
+        # Include the word-alignment padding so the estimator tracks
+        # exactly ``compressed_memory[:compressed_memory_pos]``. With a
+        # ``compressed_memory_layout`` it tracks call order instead, which
+        # is still a fair estimate.
+        estimator = self.compressed_memory_estimator
+        block = self.compressed_memory[offset : offset + round_up_word(size)]
+        screen = self.compressibility_screen if planned != COMPRESSED_MEMORY else None
+        decision = None
+        if screen is not None:
+            zlib_cost = screen.price(block, estimator.data[-estimator.window :])
+            decision = screen.decide(size, zlib_cost)
+
+        checkpoint = estimator.checkpoint()
+        if decision is None or screen.verify:
+            diff = estimator.push(block)
+            if screen is not None:
+                screen.record(size, zlib_cost, diff, decision)
+        else:
+            diff = estimator.push(block, cost=screen.predict(size, zlib_cost))
+        compression_ratio = size / max(diff, 1)
 
         print(
             f"    {Fore.YELLOW}compression_ratio: {compression_ratio}{Style.RESET_ALL}"
         )
 
-        if diff > self.int_free_space:
+        if self.int_free_space < 0:
             print(
                 f"        {Fore.RED}not putting into free memory due not enough free "
                 f"internal storage for compressed data.{Style.RESET_ALL}"
             )
-            self.compressed_memory.clear_range(
-                self.compressed_memory_pos, self.compressed_memory_pos + size
-            )
+            estimator.rollback(checkpoint)
+            self.compressed_memory.clear_range(offset, offset + size)
+            self._record_placement(ext, size, reference, EXTERNAL, diff)
             return self.move_ext_external(ext, size, reference)
-        elif compression_ratio < self.args.compression_ratio:
+        elif (
+            planned != COMPRESSED_MEMORY
+            and compression_ratio < self.args.compression_ratio
+        ):
             # Revert putting this data into compressed_memory due to poor space_savings
             print(
                 f"        {Fore.RED}not putting in free memory due to poor compression.{Style.RESET_ALL}"
             )
-            self.compressed_memory.clear_range(
-                self.compressed_memory_pos, self.compressed_memory_pos + size
-            )
-            return self.move_ext(ext, size, reference)
+            estimator.rollback(checkpoint)
+            self.compressed_memory.clear_range(offset, offset + size)
+            return self._move_ext_compressible(ext, size, reference, diff)
         # Even though the data is already moved, this builds the reference lookup
-        self._move_to_compressed_memory(ext, self.compressed_memory_pos, size=size)
+        self._move_to_compressed_memory(ext, offset, size=size)
+        self._record_placement(ext, size, reference, COMPRESSED_MEMORY, diff)
 
-        print(
-            f"    move_to_compressed_memory {hex(ext)} -> {hex(self.compressed_memory_pos)}"
-        )
+        print(f"    move_to_compressed_memory {hex(ext)} -> {hex(offset)}")
         if reference is not None:
             self.internal.lookup(reference)
-        new_loc = self.compressed_memory_pos
-        self.compressed_memory_pos += round_up_word(size)
+        new_loc = offset
+        self.compressed_memory_pos = max(
+            self.compressed_memory_pos, offset + round_up_word(size)
+        )
         self.ext_offset -= round_down_word(size)
 
         return new_loc
 
+    def optimize_placement(self, placement_log, int_capacity, **kwargs):
+        """Plan block placement from the ``placement_log`` of a greedy run.
+
+        Parameters
+        ----------
+        int_capacity : int
+            ``placement_int_capacity`` of the greedy run.
+        **kwargs
+            Forwarded to ``patches.placement.optimize_placement``.
+        """
+        blocks = list(placement_log.values())
+        # Compressed sizes are estimates; leave some headroom.
+        int_capacity -= self.PLACEMENT_MARGIN
+        self.placement = optimize_placement(
+            blocks, int_capacity, len(self.compressed_memory), **kwargs
+        )
+
+        greedy = evaluate(blocks, [block.location for block in blocks])
+        if self.placement is None:
+            printi(
+                f"Placement optimizer found nothing better than greedy "
+                f"(internal {greedy[0]}, external {greedy[2]} bytes)."
+            )
+            return
+        optimized = evaluate(blocks, [self.placement[block.ext] for block in blocks])
+        printi(
+            f"Placement optimizer: internal {greedy[0]} -> {optimized[0]} bytes, "
+            f"external {greedy[2]} -> {optimized[2]} bytes (estimated)."
+        )
+
+    def order_compressed_memory(self, placement_log, placement_data):
+        """Plan the order of blocks in compressed_memory for better compression.
+
+        Uses ``self.placement`` if set, otherwise the greedy locations in
+        ``placement_log``. Blocks are then written to their planned offsets,
+        so all relocations and reference rewrites remain correct.
+        """
+        if self.placement is None:
+            self.placement = {
+                block.ext: block.location for block in placement_log.values()
+            }
+
+        datas = {
+            block.ext: placement_data[block.ext]
+            for block in placement_log.values()
+            if self.placement.get(block.ext) == COMPRESSED_MEMORY
+        }
+        order, insertion_len, ordered_len = order_blocks(datas)
+        sizes = {k: len(v) for k, v in datas.items()}
+        self.compressed_memory_layout = layout_blocks(order, sizes)
+        self._compressed_memory_layout_end = sum(
+            round_up_word(size) for size in sizes.values()
+        )
+        printi(
+            f"Reordering {len(order)} compressed_memory blocks: "
+            f"{insertion_len} -> {ordered_len} bytes "
+            f"(saves {insertion_len - ordered_len})."
+        )
+
     def __call__(self):
+        symbols = self.SYMBOLS
+        if self.args.debug:
+            symbols += self.DEBUG_SYMBOLS
+        self.internal.resolve(symbols)
         self.int_pos = self.internal.empty_offset
-        return self.patch()
+        if self.args.prescreen != "off":
+            self.compressibility_screen = CompressibilityScreen(
+                self.args.compression_ratio, verify=self.args.prescreen == "verify"
+            )
+        result = self.patch()
+        if self.compressibility_screen is not None:
+            print(self.compressibility_screen.report())
+        return result
 
     def patch(self):
         """Device specific argument parsing and patching routine.
@@ -1,15 +1,17 @@
+from functools import partial
 from pathlib import Path
 
 from PIL import Image
 
 import patches
 
-from .compression import lzma_compress
+from .compression import lzma_compress, lzma_compress_many
+from .devices import DEVICES
 from .exception import BadImageError, InvalidStockRomError
+from .extract import Asset, backdrop, fds_rom, nes_rom, tilemap, wait_for_output
 from .firmware import Device, ExtFirmware, Firmware, IntFirmware
-from .tileset import bytes_to_tilemap, decode_backdrop, tilemap_to_bytes
+from .tileset import tilemap_to_bytes
 from .utils import (
-    fds_remove_crc_gaps,
     printd,
     printe,
     printi,
@@ -18,7 +20,15 @@ from .utils import (
     seconds_to_frames,
 )
 
-build_dir = Path("build")  # TODO: expose this properly or put in better location
+
+def _read_smb1_graphics(file_path):
+    """Extract the graphics bank used by the clock from an SMB1 ROM."""
+    rom = file_path.read_bytes()
+    if len(rom) == 40976:
+        # Remove the NES header
+        rom = rom[16:]
+    assert len(rom) == 40960
+    return rom[0x8000:0x9EC0]
 
 
 class MarioGnW(Device, name="mario"):
@@ -29,7 +39,7 @@ class MarioGnW(Device, name="mario"):
         # pointing to where some rwdata is, but this data will be relocated
         # and compressed. This variable is used in the linker scripts as to
         # where to start putting novel code.
-        STOCK_ROM_END = 0x18100
+        STOCK_ROM_END = DEVICES["mario"].stock_rom_end
         KEY_OFFSET = 0x106F4
         NONCE_OFFSET = 0x106E4
         RWDATA_OFFSET = 0x180A4
@@ -42,7 +52,7 @@ class MarioGnW(Device, name="mario"):
         ENC_END = 0xF_E000
 
         def _verify(self):
-            h = self.hash(self[:-8192])
+            h = self.hash(self.view(end=-8192))
             if h != self.STOCK_ROM_SHA1_HASH:
                 raise InvalidStockRomError
 
@@ -50,7 +60,15 @@ class MarioGnW(Device, name="mario"):
         FLASH_BASE = 0x240F2124
         FLASH_LEN = 0x24100000 - FLASH_BASE
 
-    def argparse(self, parser):
+    # External ``(offset, size)`` ranges ``patch`` compresses in place.
+    COMPRESSED_IN_PLACE = {
+        # Dst expects only 7772 bytes, not 7776
+        "header": (0x0, 7772),
+        "tileset": (0x9_8B84, 0x1_0000),
+        "smb2": (0xA_EC58, 0x1_0000),
+    }
+
+    def argparse(self, parser, argv=None):
         group = parser.add_argument_group("Timeout patches")
 
         mgroup = group.add_mutually_exclusive_group()
@@ -83,8 +101,9 @@ class MarioGnW(Device, name="mario"):
         group.add_argument(
             "--smb1",
             type=Path,
-            default="build/smb1.nes",
-            help="Override SMB1 ROM with your own file.",
+            default=None,
+            help="Override SMB1 ROM with your own file. Defaults to the stock ROM; "
+            "dump it to build/smb1.nes with --extract.",
         )
         mgroup = group.add_mutually_exclusive_group()
         mgroup.add_argument(
@@ -156,7 +175,7 @@ class MarioGnW(Device, name="mario"):
             help="Configuration so no external flash is used.",
         )
 
-        self.args = parser.parse_args()
+        self.args = parser.parse_args(argv)
 
         ############
         # Validate #
@@ -193,7 +212,43 @@ class MarioGnW(Device, name="mario"):
 
         return self.args
 
+    def assets(self):
+        tileset = (0x9_8B84, 0x9_8B84 + 0x1_0000)
+        iconset = (0xA_ACE4, 0xA_ACE4 + 0x3F00)
+        palette = (0xB_EC68, 0xB_EC68 + 320)
+        assets = [
+            Asset("tileset.png", [tileset, palette], tilemap),
+            Asset("tileset_index.png", [tileset], tilemap),
+            Asset("iconset.png", [iconset, palette], partial(tilemap, bpp=4)),
+            # Adding the header for patching convenience.
+            Asset(
+                "smb1.nes",
+                [(0x1E60, 0x1E60 + 40960)],
+                partial(
+                    nes_rom, b"NES\x1a\x02\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+                ),
+            ),
+            # A playable version of SMB2
+            Asset("smb2.fds", [(0xA_EC58, 0xA_EC58 + 0x1_0000)], fds_rom),
+        ]
+        # The sleeping images; ends are from the image notes in ``patch``.
+        backdrops = [
+            ("mario_sleeping", 0xC_58F8, 0xC_D840),
+            ("mario_juggling", 0xC_D858, 0xD_6C66),
+            ("bowser_sleeping", 0xD_6C78, 0xE_16E3),
+            ("pizza", 0xE_16F8, 0xE_C302),
+            ("minions_sleeping", 0xE_C318, 0xF_4D05),
+        ]
+        for name, start, end in backdrops:
+            assets.append(Asset(f"backdrop_{name}.png", [(start, end)], backdrop))
+        return assets
+
     def patch(self):
+        # Inputs may be dumps --extract is still writing, e.g. build/smb1.nes.
+        for path in [self.args.smb1, self.args.clock_tileset, *self.args.smb1_graphics]:
+            if path is not None:
+                wait_for_output(path)
+
         printi("Invoke custom bootloader prior to calling stock Reset_Handler.")
         self.internal.replace(0x4, "bootloader")
 
@@ -235,15 +290,9 @@ class MarioGnW(Device, name="mario"):
             self.internal.nop(0x10688, 2)
             self.internal.nop(0x1068E, 1)
 
-        # Dump the tileset
-        tileset_addr, tileset_size = 0x9_8B84, 0x1_0000
+        tileset_addr, tileset_size = self.COMPRESSED_IN_PLACE["tileset"]
         palette_addr = 0xB_EC68
         palette = self.external[palette_addr : palette_addr + 320]
-        tileset_bytes = self.external[tileset_addr : tileset_addr + tileset_size]
-        tileset = bytes_to_tilemap(tileset_bytes, palette=palette)
-        tileset.save(build_dir / "tileset.png")
-        tileset_index = bytes_to_tilemap(tileset_bytes)
-        tileset_index.save(build_dir / "tileset_index.png")
 
         # Override tileset
         if self.args.clock_tileset:
@@ -261,17 +310,6 @@ class MarioGnW(Device, name="mario"):
                     tileset_addr : tileset_addr + tileset_size
                 ] = tilemap_to_bytes(tileset, palette)
 
-        # Dump the iconset
-        iconset_addr, iconset_size = 0xAACE4, 0x3F00
-        palette_addr = 0xB_EC68
-        palette = self.external[palette_addr : palette_addr + 320]
-        iconset = bytes_to_tilemap(
-            self.external[iconset_addr : iconset_addr + iconset_size],
-            palette=palette,
-            bpp=4,
-        )
-        iconset.save(build_dir / "iconset.png")
-
         # Override iconset
         # with Image.open(self.args.iconset) as iconset:
         #    if iconset.height != 128 or iconset.width !=256:
@@ -294,6 +332,23 @@ class MarioGnW(Device, name="mario"):
         # )
         # ball_logo.save(build_dir / "ball_logo.png")
 
+        smb1_graphics = {
+            file_path: _read_smb1_graphics(file_path)
+            for file_path in self.args.smb1_graphics
+            if file_path.suffix.lower() == ".nes"
+        }
+
+        # These payloads are independent of each other and of the moves below,
+        # so compress them together up front. The serial compressions below
+        # are then served from the compression cache.
+        payloads = [
+            self.external[offset : offset + size]
+            for name, (offset, size) in self.COMPRESSED_IN_PLACE.items()
+            if not (name == "smb2" and self.args.no_smb2)
+        ]
+        payloads.extend(smb1_graphics.values())
+        lzma_compress_many(payloads, jobs=self.args.jobs)
+
         if self.args.smb1_graphics:
             printi("Intercept prepare_clock_rom")
             self.internal.bl(0x690E, "prepare_clock_rom")
@@ -302,12 +357,7 @@ class MarioGnW(Device, name="mario"):
             table = self.internal.address("SMB1_GRAPHIC_MODS", sub_base=True)
             for file_path in self.args.smb1_graphics:
                 if file_path.suffix.lower() == ".nes":
-                    rom = file_path.read_bytes()
-                    if len(rom) == 40976:
-                        # Remove the NES header
-                        rom = rom[16:]
-                    assert len(rom) == 40960
-                    graphics = rom[0x8000:0x9EC0]
+                    graphics = smb1_graphics[file_path]
                     graphics_compressed = lzma_compress(graphics)
                     loc = self.move_to_int(
                         graphics_compressed, len(graphics_compressed), None
@@ -327,9 +377,7 @@ class MarioGnW(Device, name="mario"):
                 table += 4
 
         printd("Compressing and moving stuff stuff to internal firmware.")
-        compressed_len = self.external.compress(
-            0x0, 7772
-        )  # Dst expects only 7772 bytes, not 7776
+        compressed_len = self.external.compress(*self.COMPRESSED_IN_PLACE["header"])
         self.internal.bl(0x665C, "memcpy_inflate")
         self.move_ext(0x0, compressed_len, 0x7204)
         # Note: the 4 bytes between 7772 and 7776 is padding.
@@ -338,18 +386,14 @@ class MarioGnW(Device, name="mario"):
         # SMB1 ROM (plus loading custom ROM)
         printd("Compressing and moving SMB1 ROM to compressed_memory.")
         smb1_addr, smb1_size = 0x1E60, 40960
-        # Adding the header for patching convenience.
-        (build_dir / "smb1.nes").write_bytes(
-            b"NES\x1a\x02\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            + self.external[smb1_addr : smb1_addr + smb1_size]
-        )
-        smb1 = self.args.smb1.read_bytes()
-        if len(smb1) == 40976:
-            # Remove the NES header
-            smb1 = smb1[16:]
-        if len(smb1) != smb1_size:
-            raise ValueError(f"Unknown length {len(smb1)} of file {self.args.smb1}")
-        self.external[smb1_addr : smb1_addr + smb1_size] = smb1
+        if self.args.smb1:
+            smb1 = self.args.smb1.read_bytes()
+            if len(smb1) == 40976:
+                # Remove the NES header
+                smb1 = smb1[16:]
+            if len(smb1) != smb1_size:
+                raise ValueError(f"Unknown length {len(smb1)} of file {self.args.smb1}")
+            self.external[smb1_addr : smb1_addr + smb1_size] = smb1
         patch_smb1_refr = self.internal.address("SMB1_ROM", sub_base=True)
         self.move_to_compressed_memory(
             smb1_addr, smb1_size, [0x7368, 0x10954, 0x7218, patch_smb1_refr]
@@ -463,12 +507,12 @@ class MarioGnW(Device, name="mario"):
         # Each tile is 16x16 pixels, stored as 256 bytes in row-major form.
         # These index into one of the palettes starting at 0xbec68.
         printe("Compressing clock graphics")
-        compressed_len = self.external.compress(0x9_8B84, 0x1_0000)
+        compressed_len = self.external.compress(tileset_addr, tileset_size)
         self.internal.bl(0x678E, "memcpy_inflate")
 
         printe("Moving clock graphics")
-        self.move_ext(0x9_8B84, compressed_len, 0x7350)
-        self.ext_offset -= 0x1_0000 - round_down_word(compressed_len)
+        self.move_ext(tileset_addr, compressed_len, 0x7350)
+        self.ext_offset -= tileset_size - round_down_word(compressed_len)
 
         # Note: the clock uses a different palette; this palette only applies
         # to ingame Super Mario Bros 1 & 2
@@ -494,13 +538,7 @@ class MarioGnW(Device, name="mario"):
         ]
         self.move_to_compressed_memory(0xA_EBE4, 116, references)
 
-        # Dump a playable version of SMB2
-        smb2_addr, smb2_size = 0xA_EC58, 0x1_0000
-        smb2_end = smb2_addr + smb2_size
-        smb2 = self.external[smb2_addr:smb2_end].copy()
-        smb2 = fds_remove_crc_gaps(smb2)
-        (build_dir / "smb2.fds").write_bytes(smb2)
-
+        smb2_addr, smb2_size = self.COMPRESSED_IN_PLACE["smb2"]
         if self.args.no_smb2:
             printe("Erasing SMB2 ROM")
             self.external.replace(
@@ -563,8 +601,7 @@ class MarioGnW(Device, name="mario"):
         lookup_table_start = 0xB_F4A0
         lookup_table_end = 0xB_F838
         lookup_table_len = lookup_table_end - lookup_table_start  # 46 * 5 * 4 = 920
-        for addr in range(lookup_table_start, lookup_table_end, 4):
-            self.external.lookup(addr)
+        self.external.lookup_table(lookup_table_start, lookup_table_len // 4)
 
         # Now move the table
         self.move_to_compressed_memory(lookup_table_start, lookup_table_len, 0xDF88)
@@ -606,8 +643,7 @@ class MarioGnW(Device, name="mario"):
             0x00D398,
             0x00D328,
         ]
-        for reference in references:
-            self.internal.lookup(reference)
+        self.internal.lookup(references)
 
         references = [  # external references to external functions
             0xC_1174,
@@ -639,16 +675,6 @@ class MarioGnW(Device, name="mario"):
             0x1097C + 12,
             0x1097C + 16,
         ]
-        for name, index in [
-            ("mario_sleeping", 0xC_58F8),
-            ("mario_juggling", 0xC_D858),
-            ("bowser_sleeping", 0xD_6C78),
-            ("pizza", 0xE_16F8),
-            ("minions_sleeping", 0xE_C318),
-        ]:
-            img, _ = decode_backdrop(self.external[index:])
-            img.save(build_dir / f"backdrop_{name}.png")
-
         if self.args.no_sleep_images:
             # Images Notes:
             #    * In-between images are just zeros.
@@ -683,9 +709,11 @@ class MarioGnW(Device, name="mario"):
                 self.compressed_memory.FLASH_BASE,
             )
 
+        self.rwdata_fixup()
+
         # Compress, insert, and reference the modified rwdata
         self.int_pos += self.internal.rwdata.write_table_and_data(
-            0x17DB4, data_offset=self.int_pos
+            0x17DB4, data_offset=self.int_pos, jobs=self.args.jobs
         )
 
         # Shorten the external firmware
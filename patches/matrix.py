@@ -0,0 +1,164 @@
+"""Build many patch configurations from one decoded base.
+
+Decoding the stock firmware is shared by every configuration, so it's
+done once in the parent process; each configuration is then patched in
+its own fork, getting a copy-on-write copy of the decoded devices.
+"""
+
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import shlex
+import traceback
+from collections import namedtuple
+from pathlib import Path
+
+# Without fork, workers can't inherit the decoded base.
+FORK = "fork" in multiprocessing.get_all_start_methods()
+
+MatrixConfig = namedtuple("MatrixConfig", ["name", "argv"])
+
+MatrixResult = namedtuple(
+    "MatrixResult",
+    [
+        "name",
+        "device",
+        "int_used",
+        "int_free",
+        "compressed_memory_free",
+        "ext_used",
+        "error",  # ``None`` on success.
+    ],
+)
+
+
+def read_matrix(path):
+    """Parse a matrix file.
+
+    Every line is ``name: PATCH_PARAMS``. Blank lines and lines starting
+    with ``#`` are ignored.
+
+    Raises
+    ------
+    ValueError
+        On malformed lines or duplicate names.
+    """
+    configs = {}
+    for lineno, line in enumerate(Path(path).read_text().splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, sep, params = line.partition(":")
+        name = name.strip()
+        if not sep or not name or Path(name).name != name:
+            raise ValueError(f"{path}:{lineno}: expected 'name: PATCH_PARAMS'")
+        if name in configs:
+            raise ValueError(f'{path}:{lineno}: duplicate configuration "{name}"')
+        configs[name] = MatrixConfig(name, shlex.split(params))
+    return list(configs.values())
+
+
+def jobs_per_config(jobs, n_configs):
+    """Share of ``jobs`` processes each of the concurrent ``run_matrix`` builds gets."""
+    n_concurrent = max(1, min(jobs, n_configs))
+    return max(1, jobs // n_concurrent)
+
+
+def _run(build, config, output_dir):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / "patch.log", "w") as log, contextlib.redirect_stdout(
+        log
+    ), contextlib.redirect_stderr(log):
+        try:
+            return build(config, output_dir)
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            return _failed(
+                config, f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            )
+
+
+def _failed(config, error):
+    return MatrixResult(config.name, None, None, None, None, None, error)
+
+
+def _worker(build, config, output_dir, conn):
+    conn.send(_run(build, config, output_dir))
+    conn.close()
+
+
+def run_matrix(configs, build, output_root, jobs=1):
+    """Run ``build(config, output_dir)`` for every configuration.
+
+    Each configuration runs in a fresh fork of this process, so state
+    ``build`` modifies never leaks into another configuration. Output of
+    each configuration goes to ``output_root/<name>/patch.log``.
+
+    Parameters
+    ----------
+    build : callable
+        Returns a ``MatrixResult``.
+    jobs : int
+        Maximum number of configurations built concurrently.
+
+    Returns
+    -------
+    list
+        ``MatrixResult`` per configuration, in order.
+    """
+    output_root = Path(output_root)
+    if not FORK:
+        return [_run(build, config, output_root / config.name) for config in configs]
+
+    # Plain processes rather than a pool: pool workers are daemonic, so
+    # they couldn't start the compression process pools.
+    context = multiprocessing.get_context("fork")
+    results = [None] * len(configs)
+    pending = list(enumerate(configs))
+    running = {}  # sentinel: (index, process, connection)
+    while pending or running:
+        while pending and len(running) < max(jobs, 1):
+            i, config = pending.pop(0)
+            recv, send = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_worker, args=(build, config, output_root / config.name, send)
+            )
+            process.start()
+            send.close()
+            running[process.sentinel] = (i, process, recv)
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            i, process, recv = running.pop(sentinel)
+            try:
+                results[i] = recv.recv()
+            except EOFError:
+                results[i] = _failed(
+                    configs[i], f"worker exited with code {process.exitcode}"
+                )
+            process.join()
+            recv.close()
+    return results
+
+
+def format_summary(results):
+    """Table of used and free space per configuration."""
+    header = ("Configuration", "Device", "Int used", "Int free", "CM free", "Ext used")
+    table = [header]
+    for result in results:
+        if result.error is None:
+            sizes = result[2:6]
+            table.append((result.name, result.device, *(str(x) for x in sizes)))
+        else:
+            table.append((result.name, f"FAILED: {result.error}"))
+
+    full_rows = [row for row in table if len(row) == len(header)]
+    widths = [max(len(row[i]) for row in full_rows) for i in range(len(header))]
+    widths[0] = max(len(row[0]) for row in table)
+    lines = []
+    for row in table:
+        cells = [
+            x.ljust(w) if i < 2 else x.rjust(w)
+            for i, (x, w) in enumerate(zip(row, widths))
+        ]
+        lines.append("  ".join(cells).rstrip())
+    return "\n".join(lines)
@@ -0,0 +1,130 @@
+"""Background writer for the files a patch run produces.
+
+Writes happen on a thread pool, atomically through a temporary file, and
+files whose content didn't change are left alone so their mtime (and so
+make's view of them) only moves when there's something new.
+
+A file the same run reads back must be ``flush``-ed first; better still,
+use the data it was written from.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def _same_content(path, data) -> bool:
+    try:
+        if path.stat().st_size != len(data):
+            return False
+        with open(path, "rb") as f:
+            existing = hashlib.sha256(f.read()).digest()
+    except FileNotFoundError:
+        return False
+    return existing == hashlib.sha256(data).digest()
+
+
+def encode_image(image, path) -> bytes:
+    """PIL ``image`` encoded in the format of ``path``'s suffix."""
+    buffer = io.BytesIO()
+    image.save(buffer, format=Path(path).suffix[1:].upper())
+    return buffer.getvalue()
+
+
+def write_if_changed(path, data) -> bool:
+    """Atomically write ``data`` to ``path`` unless it already holds it.
+
+    Returns
+    -------
+    bool
+        ``True`` if the file was written.
+    """
+    path = Path(path)
+    if _same_content(path, data):
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    return True
+
+
+class OutputWriter:
+    """Queues output files for ``write_if_changed`` on a thread pool.
+
+    Data is copied when queued, so the caller may keep modifying it.
+    Debug dumps are only written if ``debug`` is set.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.debug = False
+        self._executor = None
+        self._pid = None
+        self._futures = []
+        # Latest queued write per path; a later write waits for it.
+        self._pending = {}
+
+    def _submit(self, fn, path, *args):
+        if self._pid != os.getpid():
+            # A forked child can't use its parent's threads.
+            self._executor = ThreadPoolExecutor(self.max_workers)
+            self._pid = os.getpid()
+            self._futures, self._pending = [], {}
+
+        path = Path(path)
+        future = self._executor.submit(fn, path, self._pending.get(path), *args)
+        self._pending[path] = future
+        self._futures.append(future)
+        return future
+
+    def write(self, path, data, debug=False):
+        """Queue writing ``data`` to ``path``."""
+        if debug and not self.debug:
+            return None
+        return self._submit(self._write, path, bytes(data))
+
+    def save_image(self, path, image, debug=False):
+        """Queue saving a PIL ``image``, encoded in the format of ``path``'s suffix."""
+        if debug and not self.debug:
+            return None
+        return self._submit(self._save_image, path, image.copy())
+
+    @staticmethod
+    def _write(path, previous, data):
+        if previous is not None:
+            previous.result()
+        return write_if_changed(path, data)
+
+    @classmethod
+    def _save_image(cls, path, previous, image):
+        return cls._write(path, previous, encode_image(image, path))
+
+    def flush(self, path):
+        """Block until the queued writes to ``path`` finished, re-raising their error."""
+        future = self._pending.get(Path(path)) if self._pid == os.getpid() else None
+        if future is not None:
+            future.result()
+
+    def wait(self):
+        """Block until every queued write finished, re-raising the first error.
+
+        Returns
+        -------
+        tuple
+            ``(written, unchanged)`` number of files.
+        """
+        futures, self._futures, self._pending = self._futures, [], {}
+        results = [future.result() for future in futures]
+        return results.count(True), results.count(False)
+
+
+output_writer = OutputWriter()
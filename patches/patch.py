@@ -1,3 +1,6 @@
+import numpy as np
+
+from .assembler import asm_cache, encode
 from .compression import lzma_compress
 from .exception import InvalidAsmError
 
@@ -46,6 +49,14 @@ class FirmwarePatchMixin:
 
         return n_bytes_patched
 
+    def replace_table(self, offset: int, values, size=4) -> int:
+        """Batch ``replace`` of consecutive ``size``-byte ints starting at ``offset``."""
+        if size not in (1, 2, 4):
+            raise ValueError(f"Size must be one of {1, 2, 4}; got {size}")
+        data = np.asarray(values, dtype=np.int64).astype(f"<u{size}").tobytes()
+        self[offset : offset + len(data)] = data
+        return len(data)
+
     def relative(self, offset, data, size=None) -> int:
         """
         data
@@ -160,6 +171,35 @@ class FirmwarePatchMixin:
             self._ks_inst = Ks(KS_ARCH_ARM, KS_MODE_THUMB)
         return self._ks_inst
 
+    def _assemble(self, offset: int, data: str) -> bytes:
+        """Encoding of ``data`` at ``offset``.
+
+        The built-in encoder handles most patches; anything else comes from
+        ``asm_cache`` or, failing that, keystone.
+        """
+        if data.startswith(("b.w")):
+            address = self.FLASH_BASE + offset
+        else:
+            # Everything else is assembled position independently.
+            address = None
+
+        encoding = encode(data, 0 if address is None else address)
+        if encoding is not None:
+            return encoding
+
+        key = asm_cache.key(data, address)
+        encoding = asm_cache.get(key)
+        if encoding is None:
+            if address is None:
+                encoding, _ = self._ks.asm(data)
+            else:
+                encoding, _ = self._ks.asm(data, address)
+            if encoding is None:
+                raise InvalidAsmError(data)
+            encoding = bytes(encoding)
+            asm_cache.put(key, encoding)
+        return encoding
+
     def asm(self, offset: int, data: str, size=None) -> int:
         """
         Parameters
@@ -168,19 +208,45 @@ class FirmwarePatchMixin:
             Assembly instructions
         """
         data = data.strip()
-        if data.startswith(("b.w")):
-            encoding, _ = self._ks.asm(data, self.FLASH_BASE + offset)
-            if encoding is None:
-                raise InvalidAsmError
-        else:
-            encoding, _ = self._ks.asm(data)
+        encoding = self._assemble(offset, data)
         print(f'    "{data}" -> {[hex(x) for x in encoding]}')
         if size:
             assert len(encoding) == size
-        for i, val in enumerate(encoding):
-            self[offset + i] = val
+        self[offset : offset + len(encoding)] = encoding
         return len(encoding)
 
+    def asm_many(self, instructions) -> int:
+        """Batch ``asm``.
+
+        Nothing is written unless every instruction assembles to its
+        expected size; all mismatches are reported together.
+
+        Parameters
+        ----------
+        instructions : list
+            ``(offset, data)`` or ``(offset, data, size)`` tuples.
+        """
+        encodings, mismatches = [], []
+        for offset, data, *size in instructions:
+            data = data.strip()
+            encoding = self._assemble(offset, data)
+            if size and size[0] and len(encoding) != size[0]:
+                mismatches.append(
+                    f'    0x{offset:08X} "{data}": expected {size[0]} bytes, '
+                    f"got {len(encoding)}"
+                )
+            encodings.append((offset, data, encoding))
+
+        if mismatches:
+            raise InvalidAsmError("Size mismatch:\n" + "\n".join(mismatches))
+
+        n_bytes = 0
+        for offset, data, encoding in encodings:
+            print(f'    "{data}" -> {[hex(x) for x in encoding]}')
+            self[offset : offset + len(encoding)] = encoding
+            n_bytes += len(encoding)
+        return n_bytes
+
     def nop(self, offset: int, data: int) -> int:
         """Insert N NOP operations (each 2 bytes long)."""
         size = data * 2
@@ -198,7 +264,7 @@ class FirmwarePatchMixin:
         new_start = offset + data
         new_end = new_start + size
         print(f"    moving {size} bytes from 0x{old_start:08X} to 0x{new_start:08X}")
-        self[new_start:new_end] = self[old_start:old_end]
+        self.memmove(new_start, old_start, size)
 
         # Erase old copy
         if delete:
@@ -213,10 +279,7 @@ class FirmwarePatchMixin:
                 else:
                     self.clear_range(old_start, old_end)
 
-        for i in range(size):
-            self._lookup[self.FLASH_BASE + old_start + i] = (
-                self.FLASH_BASE + new_start + i
-            )
+        self._lookup.add(self.FLASH_BASE + old_start, self.FLASH_BASE + new_start, size)
 
         return size
 
@@ -241,10 +304,8 @@ class FirmwarePatchMixin:
         self.ENC_END -= data
         if self.ENC_END < self.ENC_START:
             self.ENC_END = self.ENC_START
-        if len(self) == data:
-            self[:] = bytearray()
-        else:
-            self[:] = self[:-data]
+        # Truncate in place rather than rebuilding the buffer.
+        del self[max(len(self) - data, 0) :]
 
         return data
 
@@ -265,17 +326,26 @@ class FirmwarePatchMixin:
 
         return len(compressed_data)
 
+    def _translate(self, offsets, vals):
+        try:
+            return self._lookup.translate(vals)
+        except KeyError as e:
+            (val,) = e.args
+            offset = offsets[list(vals).index(val)]
+            raise KeyError(f"0x{val:08X} at offset 0x{offset:08X}") from None
+
     def lookup(self, offsets):
         size = 4
 
         if not isinstance(offsets, list):
             offsets = [offsets]
 
-        for offset in offsets:
-            val = self.int(offset, size)
-            try:
-                new_val = self._lookup[val]
-            except KeyError:
-                raise KeyError(f"0x{val:08X} at offset 0x{offset:08X}")
+        vals = [self.int(offset, size) for offset in offsets]
+        new_vals = self._translate(offsets, vals).tolist()
+        for offset, new_val in zip(offsets, new_vals):
             self[offset : offset + size] = new_val.to_bytes(size, "little")
-            # print(f"    lookup 0x{val:08X}->0x{new_val:08x}")
+
+    def lookup_table(self, offset: int, count: int):
+        """Batch ``lookup`` of ``count`` consecutive pointers starting at ``offset``."""
+        table = self.u32(offset, count, readonly=False)
+        table[:] = self._translate(range(offset, offset + 4 * count, 4), table)
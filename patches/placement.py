@@ -0,0 +1,268 @@
+"""Global placement of relocatable external flash blocks.
+
+``Device.move_to_compressed_memory`` and ``Device.move_ext`` place blocks
+greedily in call order, so a poor early choice can push a later, more
+compressible block out to external flash. ``optimize_placement`` instead
+sees every block at once and searches for a better assignment.
+
+Blocks also enter compressed_memory in call order, so similar data can end
+up further apart than the LZMA window. ``order_blocks`` finds a better
+order for the blocks planned for compressed_memory.
+"""
+
+import random
+import time
+from collections import namedtuple
+
+from .compression import LzmaSizeEstimator, lzma_compress
+from .utils import round_up_word
+
+COMPRESSED_MEMORY = "compressed_memory"
+INTERNAL = "internal"
+EXTERNAL = "external"
+
+PlacementBlock = namedtuple(
+    "PlacementBlock",
+    [
+        "ext",  # Original offset into the external firmware; identifies the block.
+        "size",
+        "n_references",
+        "compressed_size",  # Estimated cost in internal flash; None if incompressible.
+        "location",  # Where the greedy placement put it.
+    ],
+)
+
+
+def _locations(block):
+    if block.compressed_size is None:
+        return (INTERNAL, EXTERNAL)
+    return (COMPRESSED_MEMORY, INTERNAL, EXTERNAL)
+
+
+def _cost(block, location):
+    """Returns (internal, compressed_memory, external) bytes used."""
+    if location == COMPRESSED_MEMORY:
+        return block.compressed_size, round_up_word(block.size), 0
+    elif location == INTERNAL:
+        return round_up_word(block.size), 0, 0
+    else:
+        return 0, 0, block.size
+
+
+def evaluate(blocks, assignment):
+    """Total (internal, compressed_memory, external) bytes used by ``assignment``."""
+    totals = [0, 0, 0]
+    for block, location in zip(blocks, assignment):
+        for i, cost in enumerate(_cost(block, location)):
+            totals[i] += cost
+    return tuple(totals)
+
+
+def optimize_placement(
+    blocks,
+    int_capacity,
+    compressed_memory_capacity,
+    objective="external",
+    max_iterations=200_000,
+    time_budget=5.0,
+    seed=0,
+):
+    """Search for a better assignment of ``blocks`` than the greedy one.
+
+    Parameters
+    ----------
+    blocks : list of PlacementBlock
+    int_capacity : int
+        Internal flash bytes available to these blocks.
+    compressed_memory_capacity : int
+        Uncompressed bytes available in compressed_memory.
+    objective : str
+        ``"external"`` minimizes external flash usage (then internal).
+        ``"internal"`` maximizes free internal flash without using more
+        external flash than the greedy placement.
+    max_iterations : int
+        Local search steps. The search is deterministic for a given ``seed``
+        unless ``time_budget`` expires first.
+    time_budget : float
+        Maximum seconds to spend searching.
+
+    Returns
+    -------
+    dict or None
+        Mapping of ``block.ext`` to location, or ``None`` if nothing better
+        than the greedy placement was found.
+    """
+    if not blocks:
+        return None
+
+    greedy = [block.location for block in blocks]
+    greedy_external = evaluate(blocks, greedy)[2]
+
+    def feasible(totals):
+        return totals[0] <= int_capacity and totals[1] <= compressed_memory_capacity
+
+    def key(totals):
+        if objective == "external":
+            return totals[2], totals[0]
+        elif objective == "internal":
+            return max(0, totals[2] - greedy_external), totals[0]
+        raise ValueError(f"Unknown placement objective {objective}")
+
+    candidates = [greedy]
+
+    # Constructive start: best compression ratios into compressed_memory,
+    # then fill internal flash largest block first.
+    order = sorted(
+        (i for i, b in enumerate(blocks) if b.compressed_size is not None),
+        key=lambda i: blocks[i].size / max(blocks[i].compressed_size, 1),
+        reverse=True,
+    )
+    assignment = [EXTERNAL] * len(blocks)
+    totals = [0, 0, 0]
+    for i in order:
+        int_cost, cm_cost, _ = _cost(blocks[i], COMPRESSED_MEMORY)
+        if (
+            totals[0] + int_cost <= int_capacity
+            and totals[1] + cm_cost <= compressed_memory_capacity
+            and int_cost < round_up_word(blocks[i].size)
+        ):
+            assignment[i] = COMPRESSED_MEMORY
+            totals[0] += int_cost
+            totals[1] += cm_cost
+    for i in sorted(range(len(blocks)), key=lambda i: blocks[i].size, reverse=True):
+        if assignment[i] != EXTERNAL:
+            continue
+        int_cost = _cost(blocks[i], INTERNAL)[0]
+        if objective == "external" and totals[0] + int_cost <= int_capacity:
+            assignment[i] = INTERNAL
+            totals[0] += int_cost
+    candidates.append(assignment)
+
+    feasible_candidates = [c for c in candidates if feasible(evaluate(blocks, c))]
+    if not feasible_candidates:
+        return None
+    current = min(feasible_candidates, key=lambda c: key(evaluate(blocks, c)))[:]
+    current_totals = list(evaluate(blocks, current))
+    best, best_key = current[:], key(current_totals)
+
+    # Local search: move one block, or swap the locations of two blocks.
+    rng = random.Random(seed)
+    t_end = time.monotonic() + time_budget
+    for iteration in range(max_iterations):
+        if not iteration % 1024 and time.monotonic() > t_end:
+            break
+
+        if rng.random() < 0.5:
+            i = rng.randrange(len(blocks))
+            moves = [(i, rng.choice(_locations(blocks[i])))]
+        else:
+            i, j = rng.randrange(len(blocks)), rng.randrange(len(blocks))
+            if current[j] not in _locations(blocks[i]):
+                continue
+            if current[i] not in _locations(blocks[j]):
+                continue
+            moves = [(i, current[j]), (j, current[i])]
+
+        new_totals = current_totals[:]
+        for i, location in moves:
+            old_cost = _cost(blocks[i], current[i])
+            new_cost = _cost(blocks[i], location)
+            for k in range(3):
+                new_totals[k] += new_cost[k] - old_cost[k]
+
+        if not feasible(new_totals) or key(new_totals) > key(current_totals):
+            continue
+
+        for i, location in moves:
+            current[i] = location
+        current_totals = new_totals
+        if key(current_totals) < best_key:
+            best, best_key = current[:], key(current_totals)
+
+    if best_key >= key(evaluate(blocks, greedy)):
+        return None
+
+    return {block.ext: location for block, location in zip(blocks, best)}
+
+
+def _sketch(data, n=4):
+    """Set of n-grams; a cheap similarity sketch."""
+    data = bytes(data)
+    return {data[i : i + n] for i in range(len(data) - n + 1)}
+
+
+def _pad(data):
+    return bytes(data) + bytes(round_up_word(len(data)) - len(data))
+
+
+def order_blocks(datas, shortlist=4):
+    """Order blocks so that similar data is within the LZMA window.
+
+    Greedy nearest neighbour: the next block is chosen from the
+    ``shortlist`` remaining blocks whose n-gram sketch best matches the
+    trailing window, picking the one whose marginal compressed size saves
+    the most over compressing it on its own.
+
+    Parameters
+    ----------
+    datas : dict
+        Maps block key to block data, in insertion order.
+
+    Returns
+    -------
+    list
+        Block keys in the new order; the insertion order if reordering
+        doesn't reduce the compressed size.
+    int
+        Compressed size in insertion order.
+    int
+        Compressed size in returned order.
+    """
+    keys = list(datas)
+    padded = {k: _pad(datas[k]) for k in keys}
+    insertion_len = len(
+        lzma_compress(b"".join(padded.values()), search=False, persist=False)
+    )
+    if len(keys) < 3:
+        return keys, insertion_len, insertion_len
+
+    index = {k: i for i, k in enumerate(keys)}
+    sketches = {k: _sketch(padded[k]) for k in keys}
+    standalone = {
+        k: len(lzma_compress(padded[k], search=False, persist=False)) for k in keys
+    }
+
+    estimator = LzmaSizeEstimator()
+    remaining = keys[1:]
+    order = keys[:1]
+    estimator.push(padded[keys[0]])
+    while remaining:
+        context = _sketch(estimator.data[-estimator.window :])
+
+        def similarity(k):
+            return len(sketches[k] & context) / max(len(sketches[k]), 1)
+
+        candidates = sorted(remaining, key=lambda k: (-similarity(k), index[k]))
+        candidates = candidates[:shortlist]
+        best = min(
+            candidates,
+            key=lambda k: (estimator.price(padded[k]) - standalone[k], index[k]),
+        )
+
+        order.append(best)
+        remaining.remove(best)
+        estimator.push(padded[best])
+
+    ordered_len = estimator.compressed_len()
+    if ordered_len >= insertion_len:
+        return keys, insertion_len, insertion_len
+    return order, insertion_len, ordered_len
+
+
+def layout_blocks(order, sizes):
+    """Word aligned offsets for blocks placed back to back in ``order``."""
+    layout, offset = {}, 0
+    for k in order:
+        layout[k] = offset
+        offset += round_up_word(sizes[k])
+    return layout
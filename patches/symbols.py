@@ -0,0 +1,116 @@
+"""Compact, cached symbol index of the patch ELF."""
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+from pathlib import Path
+
+from .exception import MissingSymbolError
+
+Symbol = namedtuple("Symbol", ["value", "size", "section"])
+
+# Bump when the cached index format changes.
+_INDEX_VERSION = 1
+
+
+def _parse_elf(path):
+    from elftools.elf.elffile import ELFFile
+
+    symbols = {}
+    with open(path, "rb") as f:
+        elf = ELFFile(f)
+        symtab = elf.get_section_by_name(".symtab")
+        if symtab is None:
+            return symbols
+        section_names = [section.name for section in elf.iter_sections()]
+        for symbol in symtab.iter_symbols():
+            if not symbol.name or symbol.name in symbols:
+                # Like ``get_symbol_by_name(...)[0]``, the first one wins.
+                continue
+            shndx = symbol["st_shndx"]
+            section = section_names[shndx] if isinstance(shndx, int) else shndx
+            symbols[symbol.name] = Symbol(
+                symbol["st_value"], symbol["st_size"], section
+            )
+    return symbols
+
+
+class SymbolIndex:
+    """Maps symbol name to ``Symbol(value, size, section)``.
+
+    Parsing the ELF with pyelftools is slow, so the index is saved next to
+    the ELF, keyed by the ELF's content hash, and loaded without importing
+    pyelftools while it's valid.
+    """
+
+    def __init__(self, symbols):
+        self._symbols = symbols
+
+    @staticmethod
+    def cache_path(elf):
+        elf = Path(elf)
+        return elf.with_name(elf.name + ".symbols.json")
+
+    @classmethod
+    def load(cls, elf):
+        """Load the index of ``elf``, parsing and caching it if necessary."""
+        elf = Path(elf)
+        digest = hashlib.sha256(elf.read_bytes()).hexdigest()
+        cache_path = cls.cache_path(elf)
+
+        try:
+            cached = json.loads(cache_path.read_text())
+        except (OSError, ValueError):
+            cached = None
+        if (
+            isinstance(cached, dict)
+            and cached.get("version") == _INDEX_VERSION
+            and cached.get("sha256") == digest
+        ):
+            return cls({k: Symbol(*v) for k, v in cached["symbols"].items()})
+
+        symbols = _parse_elf(elf)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(
+                json.dumps(
+                    {
+                        "version": _INDEX_VERSION,
+                        "sha256": digest,
+                        "symbols": {k: list(v) for k, v in symbols.items()},
+                    }
+                )
+            )
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # The cache is only an optimization.
+            tmp_path.unlink(missing_ok=True)
+        return cls(symbols)
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __contains__(self, name):
+        return name in self._symbols
+
+    def __getitem__(self, name):
+        try:
+            return self._symbols[name]
+        except KeyError:
+            raise MissingSymbolError(f'Cannot find symbol "{name}"') from None
+
+    def resolve(self, names):
+        """Addresses of all ``names``.
+
+        Raises
+        ------
+        MissingSymbolError
+            Listing every symbol that's missing or has address 0x0.
+        """
+        missing = [name for name in names if not self._symbols.get(name, (0,))[0]]
+        if missing:
+            raise MissingSymbolError(
+                "Cannot find symbols " + ", ".join(f'"{name}"' for name in missing)
+            )
+        return {name: self._symbols[name].value for name in names}
@@ -33,35 +33,22 @@ def bytes_to_tilemap(data, palette=None, bpp=8, width=256):
 
     # assert bpp in [4, 8]
 
+    pixels = np.frombuffer(data, dtype=np.uint8)
     if bpp < 8:
-        nibbles = bytearray()
-        # offset = 0x0
-        for b in data:
-            shift = 8 - bpp
-            while shift >= 0:
-                nibbles.append(b >> shift & (2**bpp - 1))
-                shift -= bpp
-            # nibbles.append((b >> 4) | (offset << 4))
-            # nibbles.append((b & 0xF) | (offset << 4))
-        data = bytes(nibbles)
-        del nibbles
+        # Unpack most significant pixel first.
+        shifts = np.arange(8 - bpp, -1, -bpp, dtype=np.uint8)
+        pixels = ((pixels[:, None] >> shifts) & (2**bpp - 1)).astype(np.uint8).ravel()
 
     # Assemble bytes into an index-image
-    h, w = int(ceil(len(data) / width / _BLOCK_SIZE) * _BLOCK_SIZE), width
-    canvas = np.zeros((h, w), dtype=np.uint8)
-    i_sprite = 0
-    for i in range(0, len(data), _BLOCK_PIXEL):
-        sprite = data[i : i + _BLOCK_PIXEL]
-
-        x = i_sprite * _BLOCK_SIZE % w
-        y = _BLOCK_SIZE * (i_sprite * _BLOCK_SIZE // w)
-        view = canvas[y : y + _BLOCK_SIZE, x : x + _BLOCK_SIZE]
-        sprite_block = np.frombuffer(sprite, dtype=np.uint8).reshape(
-            _BLOCK_SIZE, _BLOCK_SIZE
-        )
-        view[:] = sprite_block
-
-        i_sprite += 1
+    h, w = int(ceil(len(pixels) / width / _BLOCK_SIZE) * _BLOCK_SIZE), width
+    tiles_per_row = w // _BLOCK_SIZE
+    tiles = np.zeros(h * w, dtype=np.uint8)
+    tiles[: len(pixels)] = pixels
+    canvas = (
+        tiles.reshape(h // _BLOCK_SIZE, tiles_per_row, _BLOCK_SIZE, _BLOCK_SIZE)
+        .swapaxes(1, 2)
+        .reshape(h, w)
+    )
 
     if palette is None:
         return Image.fromarray(canvas, "L")
@@ -51,20 +51,21 @@ Start      End        Description
 """
 
 
+from functools import partial
 from pathlib import Path
 
+from .devices import DEVICES
 from .exception import InvalidStockRomError
+from .extract import Asset, backdrop, fds_rom, nes_rom
 from .firmware import Device, ExtFirmware, Firmware, IntFirmware
-from .tileset import decode_backdrop
-from .utils import fds_remove_crc_gaps, printd, printi
-
-build_dir = Path("build")  # TODO: expose this properly or put in better location
+from .utils import printd, printi
 
 
 class ZeldaGnW(Device, name="zelda"):
     class Int(IntFirmware):
         STOCK_ROM_SHA1_HASH = "ac14bcea6e4ff68c88fd2302c021025a2fb47940"
-        STOCK_ROM_END = 0x1B3E0  # Used for generating linker script.
+        # Used for generating linker script.
+        STOCK_ROM_END = DEVICES["zelda"].stock_rom_end
         KEY_OFFSET = 0x165A4
         NONCE_OFFSET = 0x16590
         RWDATA_OFFSET = 0x1B390
@@ -77,7 +78,7 @@ class ZeldaGnW(Device, name="zelda"):
         ENC_END = 0x3254A0
 
         def _verify(self):
-            h = self.hash(self[self.ENC_START : self.ENC_END])
+            h = self.hash(self.view(self.ENC_START, self.ENC_END))
             if h != self.STOCK_ROM_SHA1_HASH:
                 raise InvalidStockRomError
 
@@ -85,7 +86,7 @@ class ZeldaGnW(Device, name="zelda"):
         FLASH_BASE = 0x240F2124
         FLASH_LEN = 0  # 0x24100000 - FLASH_BASE
 
-    def argparse(self, parser):
+    def argparse(self, parser, argv=None):
         group = parser.add_argument_group("Low level flash savings flags")
         group.add_argument(
             "--no-la",
@@ -126,7 +127,7 @@ class ZeldaGnW(Device, name="zelda"):
             action="store_true",
             help="Remove the hour tune in TIME/CLOCK.",
         )
-        self.args = parser.parse_args()
+        self.args = parser.parse_args(argv)
         return self.args
 
     def _flash_roms(self):
@@ -157,60 +158,68 @@ class ZeldaGnW(Device, name="zelda"):
                 loz2 = loz2[16:]
             self.external[loz2_addr : loz2_addr + loz2_size] = loz2
 
-    def _dump_roms(self):
-        # English Zelda 1
-        rom_addr = 0x3_0000
-        rom_size = 0x2_0000
-        (build_dir / "Legend of Zelda, The (USA).nes").write_bytes(
-            b"NES\x1a\x08\x00\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            + self.external[rom_addr : rom_addr + rom_size]
-        )
-
-        # Japanse Zelda 1
-        # This rom doesn't work :(
-        rom_addr = 0x5_0000
-        rom_size = 0x1_0000
-        rom1 = bytearray(self.external[rom_addr : rom_addr + rom_size])
-        # bios = self.external[0x5_E000:0x6_0000]
-        rom1 = fds_remove_crc_gaps(rom1)
-        rom_addr = 0x6_0000
-        rom_size = 0x1_0000
-        rom2 = fds_remove_crc_gaps(self.external[rom_addr : rom_addr + rom_size])
-        (build_dir / "Zelda no Densetsu: The Hyrule Fantasy (J).fds").write_bytes(
-            rom1 + rom2
-        )
-
-        # English Zelda 2
-        rom_addr = 0x7_0000
-        rom_size = 0x4_0000
-        (build_dir / "Zelda II - Adventure of Link (USA).nes").write_bytes(
-            b"NES\x1a\x08\x10\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            + self.external[rom_addr : rom_addr + rom_size]
-        )
-
-        # Japanse Zelda 2
-        # This rom doesn't work :(
-        rom_addr = 0xB_0000
-        rom_size = 0x1_0000
-        rom1 = bytearray(self.external[rom_addr : rom_addr + rom_size])
-        # bios = self.external[0xB_E000:0xC_0000]
-        rom1 = fds_remove_crc_gaps(rom1)
-        rom_addr = 0xC_0000
-        rom_size = 0x1_0000
-        rom2 = fds_remove_crc_gaps(self.external[rom_addr : rom_addr + rom_size])
-        (build_dir / "Link no Bouken - The Legend of Zelda 2 (J).fds").write_bytes(
-            rom1 + rom2
-        )
-
-        # I Believe 0xD_0000 ~ 0xD_2000 are LoZ2-JP tweaks... or maybe just the timer?
+    def assets(self):
+        assets = [
+            # English Zelda 1
+            Asset(
+                "Legend of Zelda, The (USA).nes",
+                [(0x3_0000, 0x5_0000)],
+                partial(
+                    nes_rom, b"NES\x1a\x08\x00\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+                ),
+            ),
+            # Japanse Zelda 1
+            # This rom doesn't work :(
+            # bios = self.external[0x5_E000:0x6_0000]
+            Asset(
+                "Zelda no Densetsu: The Hyrule Fantasy (J).fds",
+                [(0x5_0000, 0x6_0000), (0x6_0000, 0x7_0000)],
+                fds_rom,
+            ),
+            # English Zelda 2
+            Asset(
+                "Zelda II - Adventure of Link (USA).nes",
+                [(0x7_0000, 0xB_0000)],
+                partial(
+                    nes_rom, b"NES\x1a\x08\x10\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+                ),
+            ),
+            # Japanse Zelda 2
+            # This rom doesn't work :(
+            # bios = self.external[0xB_E000:0xC_0000]
+            Asset(
+                "Link no Bouken - The Legend of Zelda 2 (J).fds",
+                [(0xB_0000, 0xC_0000), (0xC_0000, 0xD_0000)],
+                fds_rom,
+            ),
+            # I Believe 0xD_0000 ~ 0xD_2000 are LoZ2-JP tweaks... or maybe just the timer?
+            # English Link's Awakening
+            # This rom doesn't work :(
+            Asset(
+                "Legend of Zelda, The - Link's Awakening (en).gb",
+                [(0xD_2000, 0x15_2000)],
+                bytes,
+            ),
+        ]
 
-        # English Link's Awakening
-        # This rom doesn't work :(
-        rom_addr = 0xD_2000
-        rom_size = 0x8_0000
-        (build_dir / "Legend of Zelda, The - Link's Awakening (en).gb").write_bytes(
-            self.external[rom_addr : rom_addr + rom_size]
-        )
+        # The 11 backdrop images.
+        # Overall length: 603,424 bytes
+        backdrops = [
+            ("0", 0x1F4C00, 0x205A7D),
+            ("1", 0x205A80, 0x211913),
+            ("2", 0x211920, 0x213840),
+            ("3", 0x213840, 0x222500),
+            ("4", 0x222500, 0x234128),
+            ("5", 0x234140, 0x24247E),
+            ("6", 0x242480, 0x253949),
+            ("7", 0x253960, 0x25CF1F),
+            ("8", 0x25CF20, 0x26AAF8),
+            ("9", 0x26AB00, 0x279F98),
+            ("10", 0x279FA0, 0x28811D),
+        ]
+        for name, start, end in backdrops:
+            assets.append(Asset(f"backdrop_{name}.png", [(start, end)], backdrop))
+        return assets
 
     def _erase_roms(self):
         """Temporary for debugging, just seeing which roms impact the clock."""
@@ -250,48 +259,15 @@ class ZeldaGnW(Device, name="zelda"):
         # is all unused space. Extra 764,768 bytes free
         # More data at 0x3e_8000...
 
-    def _dump_backdrops(self):
-        """Dump the 11 backdrop images.
-
-        Overall length: 603,424 bytes
-
-        Start       End
-        --------    --------
-        0x1F4C00    0x205a7d
-        0x205A80    0x211913
-        0x211920    0x213840
-        0x213840    0x222500
-        0x222500    0x234128
-        0x234140    0x24247e
-        0x242480    0x253949
-        0x253960    0x25cf1f
-        0x25CF20    0x26aaf8
-        0x26AB00    0x279f98
-        0x279FA0    0x28811d
-        """
-        bytes_starts = [
-            ("0", 0x1F4C00),
-            ("1", 0x205A80),
-            ("2", 0x211920),
-            ("3", 0x213840),
-            ("4", 0x222500),
-            ("5", 0x234140),
-            ("6", 0x242480),
-            ("7", 0x253960),
-            ("8", 0x25CF20),
-            ("9", 0x26AB00),
-            ("10", 0x279FA0),
-        ]
-        for name, start in bytes_starts:
-            img, consumed = decode_backdrop(self.external[start:])
-            img.save(build_dir / f"backdrop_{name}.png")
-            # print(hex(start + consumed))
-
     def _disable_save_encryption(self):
         # Skip ingame save encryption
         self.internal.nop(0xF222, 1)
-        self.internal.asm(0xF228, "add.w r2,r1,#0x10")
-        self.internal.asm(0xF22C, "sub.w r1,r8,#0x10")
+        self.internal.asm_many(
+            [
+                (0xF228, "add.w r2,r1,#0x10"),
+                (0xF22C, "sub.w r1,r8,#0x10"),
+            ]
+        )
 
         # Skip LA save state encryption
         self.internal.b(0x13ED8, 0x13F06)
@@ -302,16 +278,24 @@ class ZeldaGnW(Device, name="zelda"):
         self.internal.nop(0xB5CC, 1)
 
         # Skip ingame save decryption
-        self.internal.asm(0xF12C, "add.w r7,r0,#0x10")
-        self.internal.asm(0xF130, "mov   r5,r1")
-        self.internal.asm(0xF132, "sub.w r6,r2,#0x10")
-        self.internal.asm(0xF136, "sub   sp,#0x10")
-        self.internal.asm(0xF138, "mov   r1,r6")
-        self.internal.asm(0xF13A, "mov   r0,r7")
+        self.internal.asm_many(
+            [
+                (0xF12C, "add.w r7,r0,#0x10"),
+                (0xF130, "mov   r5,r1"),
+                (0xF132, "sub.w r6,r2,#0x10"),
+                (0xF136, "sub   sp,#0x10"),
+                (0xF138, "mov   r1,r6"),
+                (0xF13A, "mov   r0,r7"),
+            ]
+        )
         self.internal.replace(0xF13C, b"\xf4\xf7\xbc\xfc")
-        self.internal.asm(0xF140, "mov   r2,r7")
-        self.internal.asm(0xF142, "mov   r1,r6")
-        self.internal.asm(0xF144, "mov   r0,r5")
+        self.internal.asm_many(
+            [
+                (0xF140, "mov   r2,r7"),
+                (0xF142, "mov   r1,r6"),
+                (0xF144, "mov   r0,r5"),
+            ]
+        )
         self.internal.replace(0xF146, b"\xfc\xf7\x29\xfc")
         self.internal.b(0xF14A, 0xF172)
 
@@ -332,9 +316,6 @@ class ZeldaGnW(Device, name="zelda"):
             0xFFFFFFFE & self.internal.address("memcpy_inflate")
         )
 
-        self._dump_roms()
-        self._dump_backdrops()
-
         if False:
             self._erase_roms()
 
@@ -348,10 +329,6 @@ class ZeldaGnW(Device, name="zelda"):
             self.internal.replace(0x8, "NMI_Handler")
             self.internal.replace(0xC, "HardFault_Handler")
 
-        from .tileset import bytes_to_tilemap
-
-        _ = bytes_to_tilemap(self.external[0x20000:0x30000])
-
         self._disable_save_encryption()
 
         printi("Invoke custom bootloader prior to calling stock Reset_Handler.")
@@ -368,7 +345,8 @@ class ZeldaGnW(Device, name="zelda"):
 
         if self.args.no_hour_tune:
             # Disable TIME/CLOCK hour tune
-            self.external[0x320025] = 0xE0  # Change 'bne' to 'b'. Will replace the 'hour tune' with a 'second beep'
+            # Change 'bne' to 'b'. Will replace the 'hour tune' with a 'second beep'
+            self.external[0x320025] = 0xE0
 
         if self.args.no_second_beep:
             # Disable TIME/CLOCK second beep
@@ -407,9 +385,11 @@ class ZeldaGnW(Device, name="zelda"):
             # TODO: make this work with moving stuff around, currently just
             # removing to free up an island of space.
 
+        self.rwdata_fixup()
+
         # Compress, insert, and reference the modified rwdata
         self.int_pos += self.internal.rwdata.write_table_and_data(
-            0x1B070, data_offset=self.int_pos
+            0x1B070, data_offset=self.int_pos, jobs=self.args.jobs
         )
 
         internal_remaining_free = len(self.internal) - self.int_pos
@@ -0,0 +1,67 @@
+""" Writes the sectors of the patched images that changed since they were last
+flashed, plus an openocd script programming just those; see ``flash_patched_delta``
+in the Makefile.
+
+The other flash targets keep the record of what's on the device current with
+``--record`` and ``--forget``.
+"""
+import argparse
+from pathlib import Path
+
+from patches import delta
+
+
+def _record(text):
+    name, _, path = text.partition("=")
+    if name not in ("internal", "external") or not path:
+        raise argparse.ArgumentTypeError("expected internal=PATH or external=PATH")
+    return name, Path(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--int-output", type=Path, default="build/internal_flash_patched.bin"
+    )
+    parser.add_argument(
+        "--ext-output", type=Path, default="build/external_flash_patched.bin"
+    )
+    parser.add_argument("--delta-dir", type=Path, default="build/delta")
+    parser.add_argument("--no-verify", action="store_true")
+    parser.add_argument(
+        "--commit",
+        action="store_true",
+        help="Record the patched images as flashed, after the script succeeded.",
+    )
+    parser.add_argument(
+        "--record",
+        type=_record,
+        action="append",
+        default=[],
+        metavar="NAME=PATH",
+        help="Record PATH as flashed to the internal or external flash.",
+    )
+    parser.add_argument(
+        "--forget",
+        choices=["internal", "external"],
+        action="append",
+        default=[],
+        help="Forget what's on the internal or external flash, e.g. after erasing.",
+    )
+    args, _ = parser.parse_known_args()
+
+    if args.record or args.forget:
+        delta.commit(dict(args.record))
+        delta.forget(args.forget)
+    elif args.commit:
+        paths = {"internal": args.int_output}
+        if args.ext_output.exists() and args.ext_output.stat().st_size:
+            paths["external"] = args.ext_output
+        delta.commit(paths)
+    else:
+        images = delta.firmware_images(
+            args.int_output.read_bytes(),
+            args.ext_output.read_bytes() if args.ext_output.exists() else b"",
+        )
+        chunks = delta.write_delta(images, args.delta_dir, verify=not args.no_verify)
+        print(delta.summary(chunks, images))
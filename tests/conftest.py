@@ -0,0 +1,74 @@
+import random
+import types
+from argparse import Namespace
+
+import pytest
+
+from patches.firmware import Device, Firmware
+
+
+def _skip_verify(self):
+    pass
+
+
+@pytest.fixture
+def firmware_class():
+    """Factory of small ``Firmware`` subclasses without the stock ROM check.
+
+    ``firmware_class(base=Firmware, **attrs)`` subclasses ``base`` with the
+    class attributes ``attrs``, e.g. ``FLASH_LEN``.
+    """
+
+    def make(base=Firmware, **attrs):
+        namespace = {"_verify": _skip_verify, **attrs}
+        return type(f"_Test{base.__name__}", (base,), namespace)
+
+    return make
+
+
+@pytest.fixture
+def device_class(firmware_class):
+    """Factory of ``Device`` subclasses registered as ``name``.
+
+    ``device_class(name, Int=None, Ext=None, FreeMemory=None, **attrs)``
+    defaults to empty firmwares for the parts that aren't given.
+    """
+
+    def make(name, Int=None, Ext=None, FreeMemory=None, **attrs):
+        empty = firmware_class(FLASH_LEN=0)
+        namespace = {
+            "Int": Int or empty,
+            "Ext": Ext or empty,
+            "FreeMemory": FreeMemory or empty,
+            **attrs,
+        }
+        return types.new_class(
+            f"_{name}", (Device,), {"name": name}, lambda ns: ns.update(namespace)
+        )
+
+    return make
+
+
+@pytest.fixture
+def make_device(firmware_class, device_class):
+    """Factory of devices with 4 KiB flashes.
+
+    External flash holds incompressible data at 0x000 and compressible
+    data at 0x200.
+    """
+    cls = device_class(
+        "small_test",
+        Int=firmware_class(FLASH_BASE=0x0800_0000, FLASH_LEN=0x1000, rwdata=None),
+        Ext=firmware_class(FLASH_BASE=0x9000_0000, FLASH_LEN=0x1000),
+        FreeMemory=firmware_class(FLASH_BASE=0x2400_0000, FLASH_LEN=0x1000),
+    )
+
+    def make():
+        device = cls(None, None, None)
+        device.args = Namespace(compression_ratio=1.4)
+        rng = random.Random(0)
+        device.external[0x000:0x200] = rng.randbytes(0x200)
+        device.external[0x200:0x400] = bytes(0x100) + b"\x01" * 0x100
+        return device
+
+    return make
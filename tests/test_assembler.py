@@ -0,0 +1,245 @@
+import random
+import struct
+
+import pytest
+
+import patches.patch
+from patches.assembler import AsmCache, encode, modified_immediate
+from patches.exception import InvalidAsmError
+
+
+def _no_keystone(self):
+    raise AssertionError("keystone shouldn't be loaded")
+
+
+@pytest.fixture
+def int_firmware(firmware_class):
+    return firmware_class(FLASH_BASE=0x0800_0000, FLASH_LEN=0x1000)
+
+
+@pytest.fixture
+def no_keystone(firmware_class, int_firmware):
+    return firmware_class(int_firmware, _ks=property(_no_keystone))
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    """Cache in ``tmp_path``, with the built-in encoder disabled."""
+    cache = AsmCache(tmp_path / "asm.json")
+    monkeypatch.setattr(patches.patch, "asm_cache", cache)
+    monkeypatch.setattr(patches.patch, "encode", lambda data, address: None)
+    return cache
+
+
+@pytest.fixture(scope="module")
+def ks():
+    keystone = pytest.importorskip("keystone")
+    return keystone.Ks(keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB)
+
+
+def _ks_encode(ks, text, address=0):
+    try:
+        encoding, _ = ks.asm(text, address)
+    except Exception:
+        return None
+    return None if encoding is None else bytes(encoding)
+
+
+def test_asm_cache_persists(cache, tmp_path, int_firmware, no_keystone):
+    firmware = int_firmware()
+    assert firmware.asm(0x100, "add.w r2,r1,#0x10") == 4
+    assert firmware.asm(0x200, "b.w #0x08000400") == 4
+    assert cache.misses == 2
+    assert not (tmp_path / "asm.json").exists()
+    cache.save()
+
+    # A fresh process only has the on-disk store.
+    patches.patch.asm_cache = AsmCache(tmp_path / "asm.json")
+    cached = no_keystone()
+    cached.asm(0x100, "add.w   r2,r1,#0x10")
+    cached.asm(0x200, "b.w #0x08000400")
+    assert cached[0x100:0x104] == firmware[0x100:0x104]
+    assert cached[0x200:0x204] == firmware[0x200:0x204]
+
+    # PC relative encodings depend on the address.
+    with pytest.raises(AssertionError, match="keystone"):
+        cached.asm(0x300, "b.w #0x08000400")
+
+
+def test_asm_cache_merges_concurrent_saves(tmp_path):
+    path = tmp_path / "asm.json"
+    first, second = AsmCache(path), AsmCache(path)
+    first.put(first.key("nop"), b"\x00\xbf")
+    second.put(second.key("bx lr"), b"\x70\x47")
+    first.save()
+    second.save()
+
+    cache = AsmCache(path)
+    assert cache.get(cache.key("nop")) == b"\x00\xbf"
+    assert cache.get(cache.key("bx lr")) == b"\x70\x47"
+
+
+def test_asm_cache_ignores_bad_store(tmp_path):
+    path = tmp_path / "asm.json"
+    path.write_text("garbage")
+    cache = AsmCache(path)
+    assert cache.get(cache.key("nop")) is None
+
+
+def test_asm_many(cache, int_firmware):
+    firmware, reference = int_firmware(), int_firmware()
+    instructions = [
+        (0x10, "add.w r7,r0,#0x10", 4),
+        (0x14, "mov r5,r1"),
+        (0x16, "sub sp,#0x10", 2),
+    ]
+    assert firmware.asm_many(instructions) == 8
+    for offset, data, *size in instructions:
+        reference.asm(offset, data, *size)
+    assert firmware == reference
+
+
+def test_asm_many_reports_all_mismatches(cache, int_firmware):
+    firmware = int_firmware()
+    with pytest.raises(InvalidAsmError) as e:
+        firmware.asm_many(
+            [
+                (0x10, "add.w r7,r0,#0x10", 2),
+                (0x14, "mov r5,r1", 2),
+                (0x16, "mov r1,r6", 4),
+            ]
+        )
+    assert "0x00000010" in str(e.value)
+    assert "0x00000016" in str(e.value)
+    assert "0x00000014" not in str(e.value)
+    assert firmware == bytes(len(firmware))
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "nop",
+        "mov r1,r2",
+        "mov r8,r1",
+        "mov.w r1,r2",
+        "mov r1,#5",
+        "mov r9,#5",
+        "mov r1,#300",
+        "mov r1,#0x10000",
+        "mov.w r1, #0x00000",
+        "mov.w r2,#0xff00ff",
+        "mov.w r2,#0xab00ab00",
+        "mov.w r2,#0xabababab",
+        "mov.w r2,#0x1fe",
+        "movw r1,#3000",
+        "movw r1,#0xffff",
+        "cmp r0,#5",
+        "cmp r8,#5",
+        "cmp.w r0,#5",
+        "cmp.w r0, #2640",
+        "add.w r2,r1,#0x10",
+        "add.w r2,sp,#0x10",
+        "sub.w r3,r3,#0x2000",
+        "sub sp,#0x10",
+        "add sp,#0x20",
+        "sub sp,#0x3",
+        "it eq; moveq r1,#5",
+        "it eq; moveq.w r1,#5",
+        "it eq; moveq r9,#5",
+        "it eq; subeq sp,#0x10",
+        "ite eq; moveq r1,#5; movne r1,#300",
+        "ite ne; movne.w r4,#0xff000; moveq.w r4,#0xfe000",
+        "itt eq; moveq r1,r2; moveq r2,r3",
+        "itete gt; movgt r1,r2; movle r1,r2; movgt r1,r2; movle r1,r2",
+        "it eq; beq 0x40",
+        "b 0x1c",
+        "b #0x1c",
+        "b.n 0x1c",
+        "b 0x1000",
+        "beq 0x40",
+        "bl 0x1000",
+    ],
+)
+def test_encode_matches_keystone(ks, text):
+    assert encode(text) == _ks_encode(ks, text)
+
+
+@pytest.mark.parametrize(
+    "text, address",
+    [
+        ("b.w #0x08000000", 0x0800_F430),
+        ("b #0x08000040", 0x0800_0000),
+        ("b #0x08000000", 0x0800_0040),
+        ("b #0x07f00000", 0x0800_0000),
+        ("bl #0x08100000", 0x0800_0100),
+        ("bl #0x08000000", 0x0810_0040),
+    ],
+)
+def test_encode_branch_matches_keystone(ks, text, address):
+    assert encode(text, address) == _ks_encode(ks, text, address)
+
+
+def test_modified_immediate_matches_keystone(ks):
+    rng = random.Random(0)
+    for _ in range(500):
+        value = rng.choice(
+            [
+                rng.getrandbits(32),
+                rng.getrandbits(8) << rng.randrange(25),
+                rng.getrandbits(8) * 0x0101_0101,
+            ]
+        )
+        for text in (f"mov.w r3,#{value:#x}", f"add.w r1,r2,#{value:#x}"):
+            assert encode(text) == _ks_encode(ks, text), text
+
+
+def test_encode_conditional_wide_branch():
+    # Keystone mis-encodes T3 (it ignores the PC), so decode it instead.
+    hw1, hw2 = struct.unpack("<HH", encode("bne.w #0x200", 0x100))
+    assert hw1 >> 11 == 0b11110 and hw2 >> 14 == 0b10 and not hw2 & 0x1000
+    assert (hw1 >> 6) & 0xF == 1  # ne
+    s, j1, j2 = (hw1 >> 10) & 1, (hw2 >> 13) & 1, (hw2 >> 11) & 1
+    offset = s << 20 | j2 << 19 | j1 << 18 | (hw1 & 0x3F) << 12 | (hw2 & 0x7FF) << 1
+    offset -= s << 21
+    assert offset == 0x200 - (0x100 + 4)
+
+    hw1, hw2 = struct.unpack("<HH", encode("beq.w #0x0", 0x1000))
+    assert (hw1 >> 10) & 1  # negative
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "ldr r0,[r1]",
+        "mov.w r2,#0x1234",
+        "movw r1,#0x10000",
+        "cmp.w r0,#0x1001",
+        "add r0,r1,#1",
+        "movne.w r4,#1",
+        "it eq; movne r1,r2",
+        "itt eq; moveq r1,r2",
+        "itt eq; beq 0x40; moveq r1,r2",
+        "b 0x1d",
+        "b.n 0x1000",
+    ],
+)
+def test_encode_unsupported(text):
+    assert encode(text) is None
+
+
+def test_modified_immediate():
+    assert modified_immediate(0xFF) == 0xFF
+    assert modified_immediate(0x0012_0012) == 0x112
+    assert modified_immediate(0x1200_1200) == 0x212
+    assert modified_immediate(0x1212_1212) == 0x312
+    assert modified_immediate(0x8000_0000) == 0x400
+    assert modified_immediate(0x1234) is None
+
+
+def test_asm_uses_encoder(monkeypatch, no_keystone):
+    monkeypatch.setattr(patches.patch, "asm_cache", AsmCache())
+    firmware = no_keystone()
+    assert firmware.asm(0x10, "cmp.w r0, #2640") == 4
+    assert firmware.asm(0x20, "b.w #0x08000000") == 4
+    assert firmware[0x10:0x14] == bytes.fromhex("b0f5256f")
+    assert patches.patch.asm_cache.misses == 0
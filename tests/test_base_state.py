@@ -0,0 +1,169 @@
+import hashlib
+import random
+from argparse import Namespace
+
+import pytest
+
+import patches.base_state
+import patches.firmware
+import patches.symbols
+from patches.base_state import BaseStateCache, read_container, write_container
+from patches.exception import InvalidStockRomError
+from patches.firmware import Device, ExtFirmware, Firmware, IntFirmware
+
+RWDATA = [bytes(range(200)), b"\xaa" * 100]
+
+
+def _lz77_literals(data):
+    """lz77 stream of only literal runs."""
+    out = bytearray()
+    for i in range(0, len(data), 200):
+        chunk = data[i : i + 200]
+        out += bytes([0, len(chunk) - 2]) + chunk
+    return bytes(out)
+
+
+def _internal_image():
+    rng = random.Random(0)
+    image = bytearray(rng.randbytes(0x1000))
+    table, data_addr = 0x800, 0x900
+    for i, data in enumerate(RWDATA):
+        compressed = _lz77_literals(data)
+        row = table + 16 * i
+        image[row : row + 16] = (
+            (0).to_bytes(4, "little")
+            + (data_addr - (row + 4)).to_bytes(4, "little")
+            + (len(compressed) << 1).to_bytes(4, "little")
+            + (0x2000_0000 + 0x1000 * i).to_bytes(4, "little")
+        )
+        image[data_addr : data_addr + len(compressed)] = compressed
+        data_addr += len(compressed)
+    image[table + 32 : table + 36] = (0x100).to_bytes(4, "little")
+    return bytes(image)
+
+
+INTERNAL = _internal_image()
+EXTERNAL = random.Random(1).randbytes(0x8000)
+
+
+class _BaseStateTestDevice(Device, name="base_state_test"):
+    class Int(IntFirmware):
+        FLASH_LEN = 0x1000
+        STOCK_ROM_SHA1_HASH = hashlib.sha1(INTERNAL).hexdigest()
+        KEY_OFFSET = 0x10
+        NONCE_OFFSET = 0x20
+        RWDATA_OFFSET = 0x800
+        RWDATA_LEN = 36
+        RWDATA_ITCM_IDX = 0
+        RWDATA_DTCM_IDX = 1
+
+    class Ext(ExtFirmware):
+        FLASH_LEN = 0x8000
+        STOCK_ROM_SHA1_HASH = hashlib.sha1(EXTERNAL).hexdigest()
+        ENC_START = 0x1000
+        ENC_END = 0x6010
+
+        def _verify(self):
+            if self.hash(self) != self.STOCK_ROM_SHA1_HASH:
+                raise InvalidStockRomError
+
+    class FreeMemory(Firmware):
+        FLASH_LEN = 0
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(patches.symbols, "_parse_elf", lambda path: {})
+    monkeypatch.setattr(
+        patches.firmware, "base_state_cache", BaseStateCache(tmp_path / "cache")
+    )
+    internal, external, elf = (
+        tmp_path / "int.bin",
+        tmp_path / "ext.bin",
+        tmp_path / "patch.elf",
+    )
+    internal.write_bytes(INTERNAL)
+    external.write_bytes(EXTERNAL)
+    elf.write_bytes(b"\x7fELF")
+    return internal, elf, external
+
+
+def _device(paths):
+    device = _BaseStateTestDevice(*paths)
+    device.args = Namespace(jobs=1)
+    device.crypt()
+    return device
+
+
+def test_base_state_cache(paths, monkeypatch):
+    reference = _device(paths)
+    assert reference.internal.rwdata.datas == RWDATA
+    assert patches.firmware.base_state_cache.misses == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("should be cached")
+
+    monkeypatch.setattr(patches.firmware, "lz77_decompress", fail)
+    monkeypatch.setattr(ExtFirmware, "crypt", fail)
+    monkeypatch.setattr(_BaseStateTestDevice.Ext, "_verify", fail)
+    cached = _device(paths)
+    assert patches.firmware.base_state_cache.hits == 1
+
+    assert cached.internal == reference.internal
+    assert cached.external == reference.external
+    assert cached.internal.rwdata.datas == RWDATA
+    assert cached.internal.rwdata.dsts == reference.internal.rwdata.dsts
+    assert cached.internal.rwdata.last_fn == reference.internal.rwdata.last_fn
+    assert isinstance(cached.internal.rwdata[0], bytearray)
+
+    # Different backups miss, so they're verified again.
+    paths[2].write_bytes(EXTERNAL[::-1])
+    monkeypatch.setattr(_BaseStateTestDevice.Ext, "_verify", ExtFirmware._verify)
+    monkeypatch.setattr(patches.firmware, "lz77_decompress", lambda data: b"")
+    _BaseStateTestDevice(*paths)
+    assert patches.firmware.base_state_cache.misses == 2
+
+
+def test_container_roundtrip(tmp_path):
+    path = tmp_path / "state.bin"
+    sections = {"a": b"\x01" * 5000, "empty": b"", "b": b"xyz"}
+    write_container(path, sections, {"key": 1})
+    loaded, meta = read_container(path)
+    assert loaded == sections
+    assert meta == {"key": 1}
+    assert len(path.read_bytes()) % patches.base_state._ALIGN == 0
+
+
+def test_container_corrupt(tmp_path):
+    path = tmp_path / "base_mario.bin"
+    path.write_bytes(b"garbage")
+    cache = BaseStateCache(tmp_path)
+    assert cache.load("mario", "key") is None
+    with pytest.raises(ValueError):
+        read_container(path)
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_encrypt_incremental(paths, monkeypatch, cached):
+    device = _device(paths)
+    if cached:
+        device = _device(paths)
+        assert patches.firmware.base_state_cache.hits == 1
+    device.external[0x2100] ^= 1
+    device.external.shorten(0x1000)
+
+    expected = _BaseStateTestDevice.Ext(bytes(device.external), verify=False)
+    expected.ENC_END = device.external.ENC_END
+    expected.crypt(device.internal.key, device.internal.nonce)
+
+    n_blocks = []
+    keystream = patches.firmware._otfdec_keystream
+
+    def count(key, iv, first_counter, n):
+        n_blocks.append(n)
+        return keystream(key, iv, first_counter, n)
+
+    monkeypatch.setattr(patches.firmware, "_otfdec_keystream", count)
+    device.encrypt()
+    assert device.external == expected
+    assert sum(n_blocks) == 0x1000 // 16
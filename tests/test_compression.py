@@ -0,0 +1,302 @@
+import random
+
+import pytest
+
+import patches.compression
+from patches.compression import (
+    LZMA_BUF_SIZE,
+    LZMA_FILTERS,
+    CompressibilityScreen,
+    CompressionCache,
+    LzmaSizeEstimator,
+    _lzma_compress,
+    compression_cache,
+    lz77_decompress,
+    lzma_compress,
+    lzma_compress_many,
+    lzma_decompress,
+    lzma_probs_size,
+    lzma_properties,
+)
+from patches.placement import INTERNAL
+
+
+def _blocks():
+    rng = random.Random(0)
+    blocks = []
+    for _ in range(20):
+        size = rng.choice([32, 64, 192, 320, 384, 1100, 2880])
+        if rng.random() < 0.3:
+            blocks.append(rng.randbytes(size))
+        else:
+            blocks.append(
+                bytes(rng.choice(b"\x00\x01\x02\x10\xff") for _ in range(size))
+            )
+    return blocks
+
+
+def test_lzma_size_estimator_exact():
+    estimator = LzmaSizeEstimator()
+    blob = bytearray()
+    for block in _blocks():
+        estimator.push(block)
+        blob.extend(block)
+        # Tracks the real size of the growing blob without resyncing.
+        exact = len(lzma_compress(bytes(blob), search=False))
+        assert abs(estimator.estimate - exact) <= 0.05 * exact + 16
+
+    assert bytes(estimator.data) == blob
+    assert estimator.compressed_len() == len(lzma_compress(bytes(blob)))
+
+
+def test_lzma_size_estimator_rollback():
+    blocks = _blocks()
+    estimator = LzmaSizeEstimator()
+    for block in blocks[:10]:
+        estimator.push(block)
+    state = (bytes(estimator.data), estimator.estimate)
+
+    checkpoint = estimator.checkpoint()
+    estimator.push(random.Random(1).randbytes(4096))
+    estimator.rollback(checkpoint)
+
+    assert (bytes(estimator.data), estimator.estimate) == state
+    assert estimator.compressed_len() == len(lzma_compress(b"".join(blocks[:10])))
+
+
+def test_lzma_size_estimator_estimate_close():
+    estimator = LzmaSizeEstimator()
+    for block in _blocks():
+        estimator.push(block)
+    estimate = estimator.estimate
+    exact = estimator.compressed_len()
+
+    assert abs(estimate - exact) <= 0.05 * exact
+
+
+def test_lzma_size_estimator_push_cost():
+    blocks = _blocks()
+    estimator = LzmaSizeEstimator()
+    reference = LzmaSizeEstimator()
+    for block in blocks[:10]:
+        estimator.push(block, cost=100)
+        reference.push(block)
+
+    assert estimator.estimate == 1000
+    assert estimator.price(blocks[10]) == reference.price(blocks[10])
+    assert estimator.compressed_len() == reference.compressed_len()
+
+
+def test_int_free_space_exact_when_nearly_full(make_device):
+    device = make_device()
+    estimator = device.compressed_memory_estimator
+    # Pretend the estimate drifted far below the real size.
+    estimator.push(random.Random(2).randbytes(0x800), cost=0x100)
+    exact = len(lzma_compress(bytes(estimator.data), search=False))
+
+    device.int_pos = len(device.internal) - 0x101
+    assert device.int_free_space == 0x101 - exact
+    assert estimator.estimate == exact
+
+    # Far from full, the estimate is used as is.
+    device.int_pos = 0
+    estimator.push(b"\x00" * 0x100, cost=1)
+    assert device.int_free_space == len(device.internal) - exact - 1
+
+
+def test_compressibility_screen():
+    screen = CompressibilityScreen(1.4)
+    estimator = LzmaSizeEstimator()
+    blocks = _blocks()
+    for block in blocks:
+        zlib_cost = screen.price(block, estimator.data[-estimator.window :])
+        screen.record(len(block), zlib_cost, estimator.push(block))
+
+    assert screen.n_trials == len(blocks)
+    assert screen.n_agreed >= 0.8 * len(blocks)
+
+    rng = random.Random(1)
+    noise = rng.randbytes(2048)
+    assert screen.decide(len(noise), screen.price(noise)) is False
+    zeros = bytes(2048)
+    assert screen.decide(len(zeros), screen.price(zeros)) is True
+    assert (screen.n_accepted, screen.n_rejected) == (1, 1)
+    assert "1 accepted and 1 rejected" in screen.report()
+
+
+def test_device_prescreen(make_device):
+    device = make_device()
+    device.compressibility_screen = CompressibilityScreen(1.4, min_samples=1)
+    rng = random.Random(1)
+    device.external[0x400:0x800] = rng.randbytes(0x400)
+    device.external[0x800:0xC00] = rng.randbytes(0x400)
+
+    # The first block is trialled and calibrates the screen, which then
+    # rejects the second without running LZMA.
+    device.move_to_compressed_memory(0x400, 0x400, None)
+    device.move_to_compressed_memory(0x800, 0x400, None)
+    screen = device.compressibility_screen
+    assert (screen.n_trials, screen.n_rejected) == (1, 1)
+    assert device.placement_log[0x800].location == INTERNAL
+    assert device.compressed_memory_pos == 0
+
+
+def test_compressibility_screen_uncalibrated():
+    screen = CompressibilityScreen(1.4, min_samples=1)
+    assert screen.decide(2048, screen.price(bytes(2048))) is None
+    assert screen.predict(2048, 50) == 50
+
+    # Small blocks always get a full trial, and aren't calibrated on.
+    screen.record(64, 10, 10)
+    assert screen.decide(2048, screen.price(bytes(2048))) is None
+    assert screen.n_trials == 1
+
+
+def _legacy_lz77_decompress(data):
+    """Original byte-at-a-time decoder."""
+    index = 0
+    out = bytearray()
+    while index < len(data):
+        opcode = data[index]
+        index += 1
+        direct_len = opcode & 0x03
+        offset_256 = (opcode >> 2) & 0x03
+        pattern_len = opcode >> 4
+        if direct_len == 0:
+            direct_len = data[index] + 3
+            index += 1
+        direct_len -= 1
+        if pattern_len == 0xF:
+            pattern_len += data[index]
+            index += 1
+        for _ in range(direct_len):
+            out.append(data[index])
+            index += 1
+        if pattern_len > 0:
+            offset_add = data[index]
+            index += 1
+            if offset_256 == 0x03:
+                offset_256 = data[index]
+                index += 1
+            offset = offset_add + offset_256 * 256
+            for _ in range(pattern_len + 2):
+                out.append(out[-offset])
+    return out
+
+
+def _random_lz77_stream(rng, n_ops):
+    """Generate a valid stock rwdata lz77 stream."""
+    stream = bytearray()
+    out_len = 0
+    for _ in range(n_ops):
+        n_literals = rng.choice([0, 1, 2, rng.randrange(2, 258)])
+        pattern_len = 0 if out_len + n_literals == 0 else rng.randrange(0, 271)
+        offset = (
+            rng.randrange(1, min(out_len + n_literals, 0xFFFF) + 1)
+            if pattern_len
+            else 0
+        )
+        if pattern_len and rng.random() < 0.3:
+            # Exercise overlapping (run-length style) patterns
+            offset = rng.randrange(1, min(out_len + n_literals, pattern_len + 2) + 1)
+
+        direct_field = n_literals + 1 if n_literals < 3 else 0
+        offset_256 = offset >> 8
+        offset_field = offset_256 if offset_256 < 3 else 3
+
+        stream.append((min(pattern_len, 0xF) << 4) | (offset_field << 2) | direct_field)
+        if direct_field == 0:
+            stream.append(n_literals - 2)
+        if pattern_len >= 0xF:
+            stream.append(pattern_len - 0xF)
+        stream += rng.randbytes(n_literals)
+        if pattern_len:
+            stream.append(offset & 0xFF)
+            if offset_field == 3:
+                stream.append(offset_256)
+
+        out_len += n_literals + (pattern_len + 2 if pattern_len else 0)
+    return bytes(stream)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_lz77_decompress_fuzz(seed):
+    rng = random.Random(seed)
+    stream = _random_lz77_stream(rng, rng.randrange(1, 500))
+    assert lz77_decompress(stream) == _legacy_lz77_decompress(stream)
+
+
+def test_compression_cache_lru():
+    cache = CompressionCache(max_size=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"  # "a" is now most recently used
+    cache.put("c", b"12345")
+
+    assert cache.get("a") == b"12345"
+    assert cache.get("b") is None
+    assert cache.get("c") == b"12345"
+
+
+def test_compression_cache_disk(tmp_path):
+    data = bytes(range(256)) * 16
+    key = CompressionCache.key(data, LZMA_FILTERS)
+
+    cache = CompressionCache(directory=tmp_path)
+    cache.put(key, b"compressed")
+
+    cache = CompressionCache(directory=tmp_path)
+    assert cache.get(key) == b"compressed"
+    assert cache.get(CompressionCache.key(data + b"\x00", LZMA_FILTERS)) is None
+
+
+def test_compression_cache_key_liblzma_version(monkeypatch):
+    key = CompressionCache.key(b"data", LZMA_FILTERS)
+    monkeypatch.setattr(patches.compression, "LIBLZMA_VERSION", "0.0.0")
+    assert CompressionCache.key(b"data", LZMA_FILTERS) != key
+
+
+def test_size_probes_not_persisted(tmp_path, monkeypatch):
+    cache = CompressionCache(directory=tmp_path)
+    monkeypatch.setattr(patches.compression, "compression_cache", cache)
+    estimator = LzmaSizeEstimator()
+    for block in _blocks()[:4]:
+        estimator.push(block)
+    estimator.compressed_len()
+    assert not list(tmp_path.iterdir())
+
+    lzma_compress(bytes(estimator.data))
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_lzma_compress_many_matches_serial():
+    blocks = _blocks()
+    blocks.append(blocks[0])  # Duplicate payloads are only compressed once
+    expected = [_lzma_compress(block) for block in blocks]
+    compression_cache.clear()
+    assert lzma_compress_many(blocks, jobs=4) == expected
+    assert lzma_compress_many(blocks, jobs=1) == expected
+
+
+def test_lzma_compress_roundtrip():
+    data = b"".join(_blocks())
+    compressed = lzma_compress(data)
+    assert lzma_properties(compressed) == {
+        "lc": 3,
+        "lp": 0,
+        "pb": 2,
+        "dict_size": 16 * 1024,
+    }
+    assert lzma_decompress(compressed) == data
+
+
+def test_lzma_compress_search():
+    data = b"".join(_blocks()[:6])
+    compressed = lzma_compress(data, search=True)
+    props = lzma_properties(compressed)
+
+    assert len(compressed) <= len(lzma_compress(data, search=False))
+    assert lzma_probs_size(props["lc"], props["lp"]) <= LZMA_BUF_SIZE
+    assert lzma_decompress(compressed) == data
+    compression_cache.clear()
+    assert lzma_compress_many([data], jobs=2, search=True) == [compressed]
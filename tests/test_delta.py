@@ -0,0 +1,100 @@
+import pytest
+
+import patches.delta
+from patches import delta
+
+
+@pytest.fixture
+def flashed_dir(tmp_path, monkeypatch):
+    path = tmp_path / "flashed"
+    monkeypatch.setattr(patches.delta, "FLASHED_DIR", path)
+    return path
+
+
+def test_changed_ranges():
+    old = bytes(0x5000)
+    new = bytearray(old)
+    new[0x0010] = 1
+    new[0x2000] = 1
+    new[0x2FFF] = 1
+    new[0x3000] = 1
+    assert delta.changed_ranges(new, old, 0x1000) == [
+        (0x0000, 0x1000),
+        (0x2000, 0x4000),
+    ]
+    assert delta.changed_ranges(old, old, 0x1000) == []
+
+
+def test_changed_ranges_lengths():
+    # A partial last sector ends with the image; bytes past ``old`` differ.
+    assert delta.changed_ranges(bytes(0x1800), bytes(0x1000), 0x1000) == [
+        (0x1000, 0x1800)
+    ]
+    assert delta.changed_ranges(bytes(0x1000), bytes(0x3000), 0x1000) == []
+
+
+def test_write_delta(tmp_path, flashed_dir):
+    stock_int, stock_ext = tmp_path / "int.bin", tmp_path / "ext.bin"
+    stock_int.write_bytes(bytes(0x4000))
+    stock_ext.write_bytes(bytes(0x3000))
+    delta.commit({"internal": stock_int, "external": stock_ext})
+
+    internal = bytearray(0x4000)
+    internal[0x2100] = 0xAA
+    external = bytearray(0x3000)
+    external[0x1000] = 0xBB
+    images = delta.firmware_images(internal, external)
+
+    out = tmp_path / "delta"
+    out.mkdir()
+    (out / "internal_0x08000000.bin").write_bytes(b"stale")
+    chunks = delta.write_delta(images, out)
+
+    assert chunks == [
+        delta.DeltaChunk(0x0800_2000, out / "internal_0x08002000.bin", 0x2000),
+        delta.DeltaChunk(0x9000_1000, out / "external_0x90001000.bin", 0x1000),
+    ]
+    assert sorted(p.name for p in out.iterdir()) == [
+        "external_0x90001000.bin",
+        "flash_delta.cfg",
+        "internal_0x08002000.bin",
+    ]
+    assert chunks[0].path.read_bytes() == internal[0x2000:0x4000]
+    script = (out / "flash_delta.cfg").read_text()
+    assert (
+        f'flash write_image erase "{chunks[1].path.as_posix()}" 0x90001000 bin'
+        in script
+    )
+    assert script.count("verify_image") == 2
+    assert "verify_image" not in delta.openocd_script(chunks, verify=False)
+
+    # Once flashed, the next delta is against the flashed images.
+    int_output, ext_output = tmp_path / "int_out.bin", tmp_path / "ext_out.bin"
+    int_output.write_bytes(internal)
+    ext_output.write_bytes(external)
+    delta.commit({"internal": int_output, "external": ext_output})
+    images = delta.firmware_images(internal, external)
+    assert delta.write_delta(images, out) == []
+    assert sorted(p.name for p in out.iterdir()) == ["flash_delta.cfg"]
+
+
+def test_firmware_images_without_external(flashed_dir):
+    images = delta.firmware_images(bytes(16), b"")
+    assert [image.name for image in images] == ["internal"]
+
+
+def test_unknown_contents(tmp_path, flashed_dir):
+    # Without a record of what's on the device, everything is programmed.
+    image = tmp_path / "int.bin"
+    image.write_bytes(bytes(0x4000))
+    images = delta.firmware_images(bytes(0x4000), b"")
+    assert delta.write_delta(images, tmp_path / "delta") == [
+        delta.DeltaChunk(
+            0x0800_0000, tmp_path / "delta" / "internal_0x08000000.bin", 0x4000
+        )
+    ]
+
+    delta.commit({"internal": image})
+    assert delta.write_delta(delta.firmware_images(bytes(0x4000), b""), tmp_path) == []
+    delta.forget(["internal", "external"])
+    assert delta.flashed_image("internal") == b""
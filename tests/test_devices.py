@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from patches.devices import DEVICES, DeviceRegistry, linker_script
+
+REPO = Path(__file__).parent.parent
+
+HEAVY_MODULES = ("numpy", "PIL", "Crypto", "elftools", "keystone", "patches.firmware")
+
+
+def _run(argv, cwd):
+    """Run python with ``argv`` from ``cwd`` (``build/`` is written there)."""
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    return subprocess.run(
+        [sys.executable, *argv],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def _imported_modules(argv, cwd):
+    """Modules imported by running ``python -X importtime *argv``."""
+    result = _run(["-X", "importtime", *argv], cwd)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return modules
+
+
+def _assert_light(modules):
+    for heavy in HEAVY_MODULES:
+        assert not any(m == heavy or m.startswith(heavy + ".") for m in modules), heavy
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["-m", "scripts.device_from_patch_params", "--device", "zelda"],
+        [str(REPO / "patch.py"), "--help"],
+    ],
+)
+def test_startup_is_light(argv, tmp_path):
+    _assert_light(_imported_modules(argv, tmp_path))
+
+
+def test_device_from_patch_params(tmp_path):
+    argv = ["-m", "scripts.device_from_patch_params", "--device=mario"]
+    _assert_light(_imported_modules(argv, tmp_path))
+    assert (tmp_path / "build" / "device.ld").read_text() == linker_script("mario")
+
+
+def test_linker_script():
+    script = linker_script("mario")
+    assert "__STOCK_ROM_END__ = 0x00018100;" in script
+    assert "__RAM_ORIGIN__ = 0x30010000;" in script
+    assert "__RAM_LENGTH__ = 57344;" in script
+
+
+def test_registry_imports_lazily():
+    registry = DeviceRegistry()
+    with pytest.raises(KeyError):
+        registry["nope"]
+
+    from patches.firmware import Device
+
+    for name, info in DEVICES.items():
+        device = Device.registry[name]
+        assert device.name == name
+        assert device.__module__ == info.module
+        assert device.Int.STOCK_ROM_END == info.stock_rom_end
@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import pytest
+
+from patches.extents import FreeExtents, zero_runs
+
+
+def _sparse(seed, n=0x4000):
+    rng = random.Random(seed)
+    data = bytearray(n)
+    for _ in range(40):
+        start = rng.randrange(n)
+        size = rng.choice([1, 7, 64, 300, 900])
+        data[start : start + size] = rng.randbytes(len(data[start : start + size]))
+    for i in range(0, n, 97):
+        data[i] |= 1
+    return bytes(data)
+
+
+def _legacy_empty_offset(data, search_start):
+    for addr in range(search_start, len(data) - 255, 0x10):
+        if data[addr : addr + 256] == b"\x00" * 256:
+            return addr
+    return None
+
+
+def test_zero_runs():
+    data = b"\x00\x00\x01\x00\x02\x02" + bytes(5) + b"\x03"
+    assert zero_runs(data).tolist() == [[0, 2], [3, 4], [6, 11]]
+    assert zero_runs(data, min_length=2).tolist() == [[0, 2], [6, 11]]
+    assert zero_runs(b"").shape == (0, 2)
+    assert zero_runs(bytes(3)).tolist() == [[0, 3]]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_find_matches_legacy_empty_offset(seed):
+    data = bytes(_sparse(seed))
+    rng = random.Random(seed)
+    # Keep some long zero runs around.
+    data = data[:0x1000] + bytes(rng.randrange(200, 400)) + data[0x1200:]
+    search_start = rng.randrange(0, 0x2000)
+
+    extents = FreeExtents(zero_runs(data, min_length=256))
+    offset = extents.find(256, alignment=0x10, start=search_start, origin=search_start)
+    assert offset == _legacy_empty_offset(data, search_start)
+
+
+def test_firmware_free_extents(firmware_class):
+    firmware = firmware_class(FLASH_LEN=0x4000)()
+    firmware[:] = _sparse(0)
+    extents = firmware.free_extents(0x1000, 0x3000, min_length=8)
+
+    expected = zero_runs(firmware[0x1000:0x3000], min_length=8) + 0x1000
+    assert list(extents) == [(s, e - s) for s, e in expected.tolist()]
+    with pytest.raises(IndexError):
+        firmware.free_extents(0x1000, 0x4001)
+
+
+def test_allocate():
+    extents = FreeExtents(np.array([[0, 100], [200, 300], [400, 500]]))
+    assert extents.find(100, alignment=8, start=1) == 200
+
+    extents.allocate(10, 20)
+    assert list(extents) == [(0, 10), (30, 70), (200, 100), (400, 100)]
+    extents.allocate(250, 200)
+    assert list(extents) == [(0, 10), (30, 70), (200, 50), (450, 50)]
+    extents.allocate(0, 1000)
+    assert list(extents) == []
+    assert extents.find(1) is None
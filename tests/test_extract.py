@@ -0,0 +1,127 @@
+import pickle
+import time
+
+import pytest
+from PIL import Image
+
+import patches.extract
+from patches import Device
+from patches.exception import ExtractionError
+from patches.extract import (
+    Asset,
+    ExtractionCache,
+    export_executor,
+    extract,
+    wait_for_output,
+)
+from patches.firmware import ExtFirmware
+
+
+@pytest.fixture
+def ext_firmware(firmware_class):
+    return firmware_class(ExtFirmware, FLASH_LEN=0x100)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ExtractionCache(tmp_path / "cache" / "extract.json")
+    monkeypatch.setattr(patches.extract, "extraction_cache", cache)
+    return cache
+
+
+def _rom(header, data):
+    return header + data
+
+
+def _image(data):
+    return Image.new("L", (4, 4), data[0])
+
+
+def _fail(data):
+    raise ValueError("corrupt")
+
+
+def test_extract(tmp_path, cache, ext_firmware):
+    firmware = ext_firmware(bytes(range(256)))
+    assets = [
+        Asset("rom.bin", [(0x00, 0x04), (0x80, None)], _rom),
+        Asset("image.png", [(0x10, 0x20)], _image),
+    ]
+    out = tmp_path / "out"
+    assert extract(firmware, assets, out) == (2, 0)
+    # Sources were copied when submitted.
+    firmware[0x00] = 0xFF
+    export_executor.wait()
+    assert (out / "rom.bin").read_bytes() == bytes(range(4)) + bytes(range(0x80, 256))
+    with Image.open(out / "image.png") as image:
+        assert image.getpixel((0, 0)) == 0x10
+
+    firmware[0x00] = 0x00
+    assert extract(firmware, assets, out) == (0, 2)
+
+    # Changes outside the sources don't matter.
+    firmware[0x40] = 0
+    assert extract(firmware, assets, out) == (0, 2)
+    firmware[0xFF] = 0
+    assert extract(firmware, assets, out) == (1, 1)
+    export_executor.wait()
+    assert (out / "rom.bin").read_bytes()[-1] == 0
+
+    # Persisted; deleted outputs are extracted again.
+    reloaded = ExtractionCache(cache.path)
+    assert reloaded.get(out / "rom.bin") == cache.get(out / "rom.bin")
+    (out / "image.png").unlink()
+    assert extract(firmware, assets, out) == (1, 1)
+    export_executor.wait()
+    assert (out / "image.png").exists()
+
+
+def _slow_rom(data):
+    time.sleep(0.2)
+    return bytes(data)
+
+
+def test_wait_for_output(tmp_path, cache, ext_firmware):
+    firmware = ext_firmware(bytes(range(256)))
+    assets = [
+        Asset("slow.bin", [(0x00, 0x10)], _slow_rom),
+        Asset("bad.bin", [(0x00, 0x10)], _fail),
+    ]
+    extract(firmware, assets, tmp_path)
+    wait_for_output(tmp_path / "slow.bin")
+    assert (tmp_path / "slow.bin").read_bytes() == bytes(range(16))
+    wait_for_output(tmp_path / "unrelated.bin")
+    with pytest.raises(ExtractionError, match="bad.bin"):
+        wait_for_output(tmp_path / "bad.bin")
+    with pytest.raises(ExtractionError):
+        export_executor.wait()
+
+
+def test_extract_failure(tmp_path, cache, ext_firmware):
+    firmware = ext_firmware(bytes(range(256)))
+    assets = [
+        Asset("bad.png", [(0x10, 0x20)], _fail),
+        Asset("image.png", [(0x10, 0x20)], _image),
+    ]
+    assert extract(firmware, assets, tmp_path) == (2, 0)
+    with pytest.raises(ExtractionError, match="bad.png"):
+        export_executor.wait()
+    # The other exports still completed; only they are cached.
+    assert (tmp_path / "image.png").exists()
+    assert cache.get(tmp_path / "bad.png") is None
+    assert extract(firmware, assets, tmp_path) == (1, 1)
+    with pytest.raises(ExtractionError):
+        export_executor.wait()
+
+
+@pytest.mark.parametrize("name", ["mario", "zelda"])
+def test_device_assets(name):
+    cls = Device.registry[name]
+    assets = cls.assets(None)
+    assert len({asset.filename for asset in assets}) == len(assets)
+    # Exports run in a process pool.
+    pickle.dumps([asset.export for asset in assets])
+    for asset in assets:
+        for start, end in asset.sources:
+            # Bounded, so an asset is only keyed on its own bytes.
+            assert end is not None and 0 <= start < end
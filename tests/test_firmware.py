@@ -0,0 +1,282 @@
+import random
+
+import pytest
+from Crypto.Cipher import AES
+
+from patches.exception import NotEnoughSpaceError
+from patches.firmware import ExtFirmware, Lookup, _nonce_to_iv
+
+
+def test_lookup_matches_dict():
+    rng = random.Random(0)
+    lookup, reference = Lookup(), {}
+    for _ in range(200):
+        src = rng.randrange(0, 4096)
+        dst = rng.randrange(0x9000_0000, 0x9001_0000)
+        size = rng.randrange(1, 256)
+        lookup.add(src, dst, size)
+        for i in range(size):
+            reference[src + i] = dst + i
+
+    for addr in range(-1, 4096 + 256):
+        if addr in reference:
+            assert lookup[addr] == reference[addr]
+        else:
+            assert addr not in lookup
+            with pytest.raises(KeyError):
+                lookup[addr]
+    assert len(lookup) == len(reference)
+
+
+def test_lookup_setitem():
+    lookup = Lookup()
+    lookup.add(0x100, 0x9000_0000, 16)
+    lookup[0x104] = 0x0800_0000
+
+    assert lookup[0x103] == 0x9000_0003
+    assert lookup[0x104] == 0x0800_0000
+    assert lookup[0x105] == 0x9000_0005
+    assert len(list(lookup.items())) == 3
+
+
+class _SmallExt(ExtFirmware):
+    FLASH_LEN = 0x1_0000
+    ENC_START = 0x1000
+    ENC_END = 0xF010
+    CRYPT_PARALLEL_MIN_BLOCKS = 16
+
+
+def _legacy_crypt(firmware, key, nonce):
+    """Original per-block OTFDEC routine."""
+    key = bytes(key[::-1])
+    iv = bytearray(_nonce_to_iv(nonce))
+    aes = AES.new(key, AES.MODE_ECB)
+    for offset in range(firmware.ENC_START, firmware.ENC_END, 128 // 8):
+        counter_block = iv.copy()
+        counter = (firmware.FLASH_BASE + offset) >> 4
+        counter_block[12] = ((counter >> 24) & 0x0F) | (counter_block[12] & 0xF0)
+        counter_block[13] = (counter >> 16) & 0xFF
+        counter_block[14] = (counter >> 8) & 0xFF
+        counter_block[15] = (counter >> 0) & 0xFF
+        cipher_block = aes.encrypt(bytes(counter_block))
+        for i, cipher_byte in enumerate(reversed(cipher_block)):
+            firmware[offset + i] ^= cipher_byte
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_ext_crypt_matches_legacy(jobs):
+    rng = random.Random(0)
+    key, nonce = rng.randbytes(16), rng.randbytes(8)
+
+    expected = _SmallExt()
+    expected[:] = rng.randbytes(len(expected))
+    actual = _SmallExt()
+    actual[:] = expected
+
+    _legacy_crypt(expected, key, nonce)
+    actual.crypt(key, nonce, jobs=jobs)
+    assert actual == expected
+
+    actual.crypt(key, nonce, jobs=jobs)
+    _legacy_crypt(expected, key, nonce)
+    assert actual == expected
+
+
+def test_ext_crypt_extents():
+    rng = random.Random(0)
+    key, nonce = rng.randbytes(16), rng.randbytes(8)
+    expected = _firmware(rng.randbytes(0x1_0000))
+    actual = _firmware(expected)
+
+    expected.crypt(key, nonce)
+    # Unaligned, overlapping and out of range extents are all fine.
+    extents = [(0, 0x1008), (0x1008, 0x8003), (0x8000, 0xF000), (0xEFF0, 0x1_0000)]
+    actual.crypt(key, nonce, jobs=3, extents=extents)
+    assert actual == expected
+
+    actual.crypt(key, nonce, extents=[(0x2005, 0x2006)])
+    assert actual[0x2000:0x2010] != expected[0x2000:0x2010]
+    assert actual[:0x2000] == expected[:0x2000]
+    assert actual[0x2010:] == expected[0x2010:]
+
+
+def test_dirty_tracking():
+    firmware = _firmware(bytes(0x1_0000))
+    firmware.clear_dirty()
+    assert not firmware.is_dirty()
+
+    firmware[0x1010] = 1
+    firmware[-1] = 1
+    firmware.set_range(0x3FFF, 0x4001, b"\xff")
+    firmware.u32(0x6000, readonly=False)[0] = 1
+    with firmware.view(0x8000, 0x8010) as data:
+        bytes(data)
+    firmware.u32(0xA000, 4).tolist()
+    firmware.memmove(0x9000, 0x1000, 0x10)
+    assert firmware.dirty_extents() == [
+        (0x1000, 0x2000),
+        (0x3000, 0x5000),
+        (0x6000, 0x7000),
+        (0x9000, 0xA000),
+        (0xF000, 0x1_0000),
+    ]
+    assert firmware.dirty_extents(0x3800, 0x6800) == [
+        (0x3800, 0x5000),
+        (0x6000, 0x6800),
+    ]
+    assert firmware.is_dirty(0x1FFF, 0x2001)
+    assert not firmware.is_dirty(0x2000, 0x3000)
+
+    # Everything past a resize moved.
+    firmware.clear_dirty()
+    del firmware[0x8800:0x8900]
+    firmware += bytes(0x100)
+    assert firmware.dirty_extents() == [(0x8000, 0x1_0000)]
+    firmware.clear_dirty()
+    firmware.shorten(0x1800)
+    assert firmware.dirty_extents() == [(0xE000, 0xE800)]
+
+
+def _firmware(data):
+    firmware = _SmallExt()
+    firmware[:] = data
+    return firmware
+
+
+def test_view():
+    firmware = _firmware(bytes(range(256)) * 16)
+    with firmware.view(0x10, 0x20) as data:
+        assert data.readonly
+        assert bytes(data) == firmware[0x10:0x20]
+    assert bytes(firmware.view(end=-16)) == firmware[:-16]
+    assert len(firmware.view(len(firmware))) == 0
+
+    with firmware.view(0x10, 0x20, readonly=False) as data:
+        data[0] = 0xAA
+    assert firmware[0x10] == 0xAA
+
+    with pytest.raises(IndexError):
+        firmware.view(0x10, len(firmware) + 1)
+    with pytest.raises(IndexError):
+        firmware.view(len(firmware) + 1)
+
+
+@pytest.mark.parametrize("delta", [-100, -3, 3, 100, 2000])
+def test_move_matches_slices(delta):
+    data = random.Random(0).randbytes(4096)
+    firmware, reference = _firmware(data), bytearray(data)
+    firmware.move(1000, delta, 50)
+
+    reference[1000 + delta : 1050 + delta] = data[1000:1050]
+    if delta < 0:
+        reference[max(1050 + delta, 1000) : 1050] = bytes(min(-delta, 50))
+    else:
+        reference[1000 : min(1000 + delta, 1050)] = bytes(min(delta, 50))
+    assert firmware == reference
+
+
+def test_move_out_of_range():
+    firmware = _firmware(bytes(4096))
+    with pytest.raises(NotEnoughSpaceError):
+        firmware.move(4000, 90, 10)
+
+
+def test_shorten():
+    data = random.Random(0).randbytes(4096)
+    firmware = _firmware(data)
+    firmware.shorten(96)
+    assert firmware == data[:-96]
+    firmware.shorten(len(firmware))
+    assert firmware == b""
+
+
+def test_lookup_translate():
+    rng = random.Random(0)
+    lookup = Lookup()
+    for _ in range(50):
+        lookup.add(rng.randrange(0, 4096), rng.randrange(0x9000_0000, 0x9001_0000), 64)
+    addrs = [addr for addr in range(4096 + 64) if addr in lookup]
+
+    assert lookup.translate(addrs).tolist() == [lookup[addr] for addr in addrs]
+    missing = next(addr for addr in range(4096) if addr not in lookup)
+    with pytest.raises(KeyError):
+        lookup.translate(addrs + [missing])
+    with pytest.raises(KeyError):
+        Lookup().translate([0])
+
+
+def test_typed_accessors():
+    firmware = _firmware(bytes(range(256)) * 256)
+    assert firmware.u8(0x10, 4).tolist() == [0x10, 0x11, 0x12, 0x13]
+    assert firmware.u16(0x10, 2).tolist() == [0x1110, 0x1312]
+    assert firmware.u32(0x10).tolist() == [firmware.int(0x10)]
+
+    with pytest.raises(ValueError):
+        firmware.u32(0x21)[0] = 0
+    words = firmware.u32(0x21, 2, readonly=False)
+    words[:] = [0xDEADBEEF, 0x12345678]
+    del words
+    assert firmware.int(0x21) == 0xDEADBEEF
+    assert firmware.int(0x25) == 0x12345678
+
+    with pytest.raises(IndexError):
+        firmware.u32(len(firmware) - 2)
+
+
+def test_replace_table():
+    firmware = _firmware(bytes(4096))
+    assert firmware.replace_table(0x100, [1, 0xFFFF_FFFF, -1]) == 12
+    assert firmware.u32(0x100, 3).tolist() == [1, 0xFFFF_FFFF, 0xFFFF_FFFF]
+    assert firmware.replace_table(0x200, [1, 2], size=2) == 4
+    assert firmware[0x200:0x204] == b"\x01\x00\x02\x00"
+    with pytest.raises(ValueError):
+        firmware.replace_table(0x200, [1], size=3)
+
+
+def test_lookup_table_matches_lookup():
+    rng = random.Random(0)
+    pointers = [_SmallExt.FLASH_BASE + rng.randrange(0, 0x4000) for _ in range(64)]
+    batch, reference = _firmware(bytes(0x1_0000)), _firmware(bytes(0x1_0000))
+    for firmware in (batch, reference):
+        firmware.replace_table(0x8000, pointers)
+        firmware.move(0, 0x9000, 0x2000)
+        firmware.move(0x2000, 0x8000, 0x2000)
+
+    batch.lookup_table(0x8000, 32)
+    batch.lookup(list(range(0x8080, 0x8100, 4)))
+    for offset in range(0x8000, 0x8100, 4):
+        reference.lookup(offset)
+    assert batch[0x8000:0x8100] == reference[0x8000:0x8100]
+
+    with pytest.raises(KeyError, match="at offset 0x00008000"):
+        batch.lookup_table(0x8000, 2)
+
+
+def test_rwdata_fixup(make_device):
+    device = make_device()
+    device.internal.RWDATA_ITCM_IDX, device.internal.RWDATA_DTCM_IDX = 0, 1
+    rng = random.Random(0)
+    itcm = bytearray(rng.randbytes(64))
+    itcm[8:12] = (0x9000_0010).to_bytes(4, "little")
+    itcm[12:16] = (0x9000_0304).to_bytes(4, "little")
+    original_itcm = bytes(itcm)
+    dtcm = bytearray(bytes(64))
+    for i, val in enumerate([0x9000_0000, 0x9000_01FC, 0x9000_0200, 0x9000_0300]):
+        dtcm[4 * i : 4 * i + 4] = val.to_bytes(4, "little")
+
+    device.move_to_int(0x000, 0x200, None)
+    device.internal.rwdata = [itcm, dtcm]
+    # Erasing applies right away.
+    assert device.rwdata_erase(0x300, 0x10) == [(1, 12, 0x9000_0300, 0)]
+    assert dtcm[12:16] == bytes(4)
+    device.rwdata_lookup(0x000, 0x200)
+    report = device.rwdata_fixup()
+
+    assert report == [
+        (1, 0, 0x9000_0000, 0x0800_0000),
+        (1, 4, 0x9000_01FC, 0x0800_01FC),
+    ]
+    assert int.from_bytes(dtcm[8:12], "little") == 0x9000_0200
+    # ITCM is code; words that look like pointers are left alone.
+    assert itcm == original_itcm
+    assert device.rwdata_fixup() == []
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from patches.matrix import (
+    MatrixConfig,
+    MatrixResult,
+    format_summary,
+    jobs_per_config,
+    read_matrix,
+    run_matrix,
+)
+
+# Stands in for a decoded base; workers must each see it unmodified.
+_BASE = bytearray(16)
+
+
+def _build(config, output_dir):
+    assert _BASE == bytearray(16)
+    _BASE[:] = b"\xff" * 16
+    if "--fail" in config.argv:
+        raise ValueError("bad configuration")
+    if "--exit" in config.argv:
+        os._exit(3)
+    print("patched", config.name)
+    (output_dir / "out.bin").write_bytes(config.name.encode())
+    return MatrixResult(config.name, "mario", 100, 28, 5, len(config.argv), None)
+
+
+def test_read_matrix(tmp_path):
+    path = tmp_path / "matrix.txt"
+    path.write_text(
+        "# release\n"
+        "\n"
+        "slim: --device=mario --slim\n"
+        "graphics: --smb1-graphics 'ips/a b.ips'\n"
+    )
+    assert read_matrix(path) == [
+        MatrixConfig("slim", ["--device=mario", "--slim"]),
+        MatrixConfig("graphics", ["--smb1-graphics", "ips/a b.ips"]),
+    ]
+
+
+@pytest.mark.parametrize(
+    "text", ["--slim\n", "../escape: --slim\n", "a: --slim\na: --no-save\n"]
+)
+def test_read_matrix_invalid(tmp_path, text):
+    path = tmp_path / "matrix.txt"
+    path.write_text(text)
+    with pytest.raises(ValueError, match=":[12]:"):
+        read_matrix(path)
+
+
+def test_run_matrix(tmp_path):
+    configs = [
+        MatrixConfig("a", []),
+        MatrixConfig("b", ["--slim"]),
+        MatrixConfig("c", ["--fail"]),
+        MatrixConfig("d", ["--exit"]),
+        MatrixConfig("e", []),
+    ]
+    results = run_matrix(configs, _build, tmp_path, jobs=2)
+
+    assert [r.name for r in results] == ["a", "b", "c", "d", "e"]
+    assert results[1] == MatrixResult("b", "mario", 100, 28, 5, 1, None)
+    assert results[2].error == "ValueError: bad configuration"
+    assert "exited with code" in results[3].error
+    assert _BASE == bytearray(16)
+
+    assert (tmp_path / "a" / "out.bin").read_bytes() == b"a"
+    assert "patched a" in (tmp_path / "a" / "patch.log").read_text()
+    assert "bad configuration" in (tmp_path / "c" / "patch.log").read_text()
+
+
+def test_format_summary():
+    summary = format_summary(
+        [
+            MatrixResult("mario-slim", "mario", 100, 28, 5, 1024, None),
+            MatrixResult("zelda-no-la", None, None, None, None, None, "Oops"),
+        ]
+    )
+    lines = summary.splitlines()
+    assert lines[0].split() == [
+        "Configuration",
+        "Device",
+        "Int",
+        "used",
+        "Int",
+        "free",
+        "CM",
+        "free",
+        "Ext",
+        "used",
+    ]
+    assert lines[1].split() == ["mario-slim", "mario", "100", "28", "5", "1024"]
+    assert lines[2].split() == ["zelda-no-la", "FAILED:", "Oops"]
+
+
+def test_jobs_per_config():
+    assert jobs_per_config(16, 2) == 8
+    assert jobs_per_config(16, 40) == 1
+    assert jobs_per_config(6, 4) == 1
+    assert jobs_per_config(1, 1) == 1
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+from PIL import Image
+
+from patches.output import OutputWriter, write_if_changed
+
+
+def test_write_if_changed(tmp_path):
+    path = tmp_path / "out" / "firmware.bin"
+    assert write_if_changed(path, b"abc")
+    os.utime(path, (0, 0))
+
+    assert not write_if_changed(path, b"abc")
+    assert path.stat().st_mtime == 0
+
+    assert write_if_changed(path, b"abd")
+    assert path.read_bytes() == b"abd"
+    assert path.stat().st_mtime != 0
+    assert os.listdir(path.parent) == ["firmware.bin"]
+
+
+def test_output_writer(tmp_path):
+    writer = OutputWriter()
+    data = bytearray(b"first")
+    writer.write(tmp_path / "a.bin", data)
+    # Queued data is a snapshot.
+    data[:] = b"changed"
+    assert writer.write(tmp_path / "decrypt.bin", data, debug=True) is None
+    # Writes to the same path land in order.
+    for i in range(20):
+        writer.write(tmp_path / "b.bin", bytes([i]) * 1000)
+    writer.save_image(tmp_path / "c.png", Image.new("RGB", (4, 4), (255, 0, 0)))
+
+    assert writer.wait() == (22, 0)
+    assert (tmp_path / "a.bin").read_bytes() == b"first"
+    assert not (tmp_path / "decrypt.bin").exists()
+    assert (tmp_path / "b.bin").read_bytes() == bytes([19]) * 1000
+    with Image.open(tmp_path / "c.png") as image:
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+
+    writer.debug = True
+    writer.write(tmp_path / "a.bin", b"first")
+    writer.write(tmp_path / "decrypt.bin", data, debug=True)
+    assert writer.wait() == (1, 1)
+    assert (tmp_path / "decrypt.bin").read_bytes() == b"changed"
+
+
+def test_output_writer_error(tmp_path):
+    writer = OutputWriter()
+    (tmp_path / "dir").mkdir()
+    writer.write(tmp_path / "dir", b"not a file")
+    with pytest.raises(OSError):
+        writer.wait()
+    assert writer.wait() == (0, 0)
+
+
+def test_output_writer_flush(tmp_path):
+    writer = OutputWriter()
+    writer.flush(tmp_path / "a.bin")
+    for i in range(20):
+        writer.write(tmp_path / "a.bin", bytes([i]) * 100_000)
+    writer.flush(tmp_path / "a.bin")
+    assert (tmp_path / "a.bin").read_bytes() == bytes([19]) * 100_000
+    writer.wait()
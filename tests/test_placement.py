@@ -0,0 +1,87 @@
+import random
+
+from patches.placement import (
+    COMPRESSED_MEMORY,
+    EXTERNAL,
+    INTERNAL,
+    PlacementBlock,
+    evaluate,
+    layout_blocks,
+    optimize_placement,
+    order_blocks,
+)
+
+
+def test_optimize_placement_beats_greedy():
+    # Greedy filled internal flash with an early, large block so that a
+    # later compressible block had to go to external flash.
+    blocks = [
+        PlacementBlock(0x000, 1000, 1, None, INTERNAL),
+        PlacementBlock(0x400, 600, 1, 100, EXTERNAL),
+        PlacementBlock(0x700, 400, 1, None, EXTERNAL),
+    ]
+    plan = optimize_placement(blocks, 1100, 1000, max_iterations=1000)
+
+    assert plan is not None
+    assert plan[0x400] == COMPRESSED_MEMORY
+    optimized = evaluate(blocks, [plan[b.ext] for b in blocks])
+    assert optimized[0] <= 1100
+    assert optimized[2] < evaluate(blocks, [b.location for b in blocks])[2]
+
+
+def test_optimize_placement_keeps_optimal_greedy():
+    blocks = [
+        PlacementBlock(0x000, 100, 1, 10, COMPRESSED_MEMORY),
+        PlacementBlock(0x100, 100, 1, None, INTERNAL),
+    ]
+    assert optimize_placement(blocks, 1000, 1000, max_iterations=1000) is None
+
+
+def test_device_follows_placement(make_device):
+    greedy = make_device()
+    greedy.move_to_compressed_memory(0x000, 0x200, None)
+    greedy.move_to_compressed_memory(0x200, 0x200, None)
+    assert greedy.placement_log[0x000].location == INTERNAL
+    assert greedy.placement_log[0x200].location == COMPRESSED_MEMORY
+    assert greedy.placement_log[0x000].compressed_size is not None
+
+    planned = make_device()
+    planned.placement = {0x000: EXTERNAL, 0x200: INTERNAL}
+    planned.move_to_compressed_memory(0x000, 0x200, None)
+    planned.move_to_compressed_memory(0x200, 0x200, None)
+    assert planned.placement_log[0x000].location == EXTERNAL
+    assert planned.placement_log[0x200].location == INTERNAL
+    assert planned.lookup[0x9000_0200] == 0x0800_0000
+
+
+def test_order_blocks_groups_similar_data():
+    rng = random.Random(0)
+    palette = rng.randbytes(4096)
+    datas = {
+        0: palette,
+        1: rng.randbytes(10000),
+        2: rng.randbytes(10000),
+        3: palette[:-10] + rng.randbytes(10),
+    }
+    order, insertion_len, ordered_len = order_blocks(datas)
+
+    assert order.index(3) == order.index(0) + 1
+    assert ordered_len < insertion_len - 3000
+
+
+def test_layout_blocks():
+    assert layout_blocks([2, 0, 1], {0: 5, 1: 8, 2: 3}) == {2: 0, 0: 4, 1: 12}
+
+
+def test_device_follows_layout(make_device):
+    device = make_device()
+    device.placement = {0x200: COMPRESSED_MEMORY, 0x300: COMPRESSED_MEMORY}
+    device.compressed_memory_layout = {0x300: 0, 0x200: 0x100}
+    device._compressed_memory_layout_end = 0x200
+    device.move_to_compressed_memory(0x200, 0x100, None)
+    device.move_to_compressed_memory(0x300, 0x100, None)
+
+    assert device.compressed_memory[0:0x100] == b"\x01" * 0x100
+    assert device.lookup[0x9000_0200] == 0x2400_0100
+    assert device.lookup[0x9000_0300] == 0x2400_0000
+    assert device.compressed_memory_pos == 0x200
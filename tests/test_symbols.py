@@ -0,0 +1,113 @@
+import shutil
+import subprocess
+import sys
+from argparse import Namespace
+
+import pytest
+
+import patches.symbols
+from patches.exception import MissingSymbolError
+from patches.firmware import Device, IntFirmware
+from patches.symbols import Symbol, SymbolIndex
+
+
+@pytest.fixture
+def elf(tmp_path):
+    path = tmp_path / "gw_patch.elf"
+    path.write_bytes(b"\x7fELF fake")
+    return path
+
+
+@pytest.fixture
+def parse_calls(monkeypatch):
+    calls = []
+
+    def fake_parse(path):
+        calls.append(path)
+        return {
+            "bootloader": Symbol(0x0801_0001, 12, ".text"),
+            "zero": Symbol(0, 0, "SHN_UNDEF"),
+        }
+
+    monkeypatch.setattr(patches.symbols, "_parse_elf", fake_parse)
+    return calls
+
+
+def test_symbol_index_cache(elf, parse_calls):
+    index = SymbolIndex.load(elf)
+    assert index["bootloader"] == (0x0801_0001, 12, ".text")
+    assert SymbolIndex.cache_path(elf).exists()
+    assert len(parse_calls) == 1
+
+    # Valid cache; not parsed again.
+    index = SymbolIndex.load(elf)
+    assert index["bootloader"] == Symbol(0x0801_0001, 12, ".text")
+    assert len(parse_calls) == 1
+
+    # New ELF content invalidates the cache.
+    elf.write_bytes(b"\x7fELF other")
+    SymbolIndex.load(elf)
+    assert len(parse_calls) == 2
+
+
+def test_symbol_index_corrupt_cache(elf, parse_calls):
+    SymbolIndex.cache_path(elf).write_text("{not json")
+    assert "bootloader" in SymbolIndex.load(elf)
+    assert len(parse_calls) == 1
+
+
+def test_symbol_index_resolve(elf, parse_calls):
+    index = SymbolIndex.load(elf)
+    assert index.resolve(["bootloader"]) == {"bootloader": 0x0801_0001}
+    with pytest.raises(MissingSymbolError, match='"zero", "nope"'):
+        index.resolve(["bootloader", "zero", "nope"])
+    with pytest.raises(MissingSymbolError):
+        index["nope"]
+
+
+@pytest.mark.skipif(shutil.which("cc") is None, reason="needs a C compiler")
+def test_symbol_index_parses_elf(tmp_path):
+    src = tmp_path / "patch.c"
+    src.write_text("int table[4] = {1};\nint read_buttons(void) { return 0; }\n")
+    obj = tmp_path / "patch.o"
+    subprocess.run(["cc", "-c", str(src), "-o", str(obj)], check=True)
+
+    index = SymbolIndex.load(obj)
+    assert index["table"].size == 16
+    assert index["table"].section == ".data"
+    assert index["read_buttons"].section == ".text"
+
+    # The cached index is loaded without pyelftools.
+    sys.modules.pop("elftools.elf.elffile", None)
+    cached = SymbolIndex.load(obj)
+    assert "elftools.elf.elffile" not in sys.modules
+    assert cached["table"] == index["table"]
+
+
+def _patch(self):
+    return self.internal.address("bootloader")
+
+
+def test_resolved_addresses(elf, monkeypatch, firmware_class, device_class):
+    symbols = {
+        name: Symbol(0x0801_0000 + i, 4, ".text")
+        for i, name in enumerate(Device.SYMBOLS)
+    }
+    monkeypatch.setattr(patches.symbols, "_parse_elf", lambda path: symbols)
+    int_firmware = firmware_class(IntFirmware, FLASH_LEN=0x1000, STOCK_ROM_END=0x100)
+    device_cls = device_class("symbols_test", Int=int_firmware, patch=_patch)
+    device = device_cls(None, elf, None)
+    device.args = Namespace(debug=False, prescreen="off")
+
+    # Debug-only symbols aren't required without --debug.
+    assert device() == symbols["bootloader"].value
+    assert set(device.internal.addresses) == set(Device.SYMBOLS)
+    device.args.debug = True
+    with pytest.raises(MissingSymbolError, match="NMI_Handler"):
+        device()
+
+    # Later lookups use the resolved addresses.
+    firmware = int_firmware(None, elf)
+    firmware.resolve(["bootloader"])
+    firmware.symbols = None
+    assert firmware.address("bootloader", sub_base=True) == 0x1_0000
@@ -6,6 +6,7 @@ So you should never really need to use this script.
 
 import argparse
 import sys
+import time
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -17,6 +18,13 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("src", type=Path)
     parser.add_argument("dst", type=Path)
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Decompress N times and report throughput.",
+    )
     args = parser.parse_args()
     return args
 
@@ -27,6 +35,17 @@ def main():
     decompressed = lz77_decompress(data)
     args.dst.write_bytes(decompressed)
 
+    if args.benchmark:
+        t_start = time.perf_counter()
+        for _ in range(args.benchmark):
+            lz77_decompress(data)
+        t_elapsed = time.perf_counter() - t_start
+        mb = args.benchmark * len(decompressed) / (1 << 20)
+        print(
+            f"{len(data)} -> {len(decompressed)} bytes; "
+            f"{t_elapsed / args.benchmark * 1000:.3f} ms/iter; {mb / t_elapsed:.1f} MB/s"
+        )
+
 
 if __name__ == "__main__":
     main()